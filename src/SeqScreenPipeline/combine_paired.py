@@ -3,8 +3,8 @@
 import argparse
 import os
 import pandas as pd
-import subprocess
 import glob
+from taxonomy_service import connect_taxonomy
 
 
 def run_lca(pipeline:str, database:str):
@@ -12,9 +12,7 @@ def run_lca(pipeline:str, database:str):
 
     Args:
         pipeline (str): pipeline file locations
-        database (str): database for taxonkit
-        sensitive (bool): process sensitive output instead 
-        split_files (bool): processes merged split files instead
+        database (str): taxonkit data directory (compiled once with taxonomy.py)
     """
         
         
@@ -22,6 +20,7 @@ def run_lca(pipeline:str, database:str):
     combined_dir = os.path.join(pipeline, 'taxonkit', 'fast', 'combined')
     
     reports = glob.glob(f'{lca_dir}/*R1.tsv')
+    taxonomy = connect_taxonomy(database)
         
     for i, r1 in enumerate(reports): ## paired end reads
         print(f'[{i+1}] {r1}')
@@ -31,9 +30,9 @@ def run_lca(pipeline:str, database:str):
         
         if os.path.exists(r2):  ### if paired end-read exists, combine using LCA
             
-            tmp_out = os.path.join(combined_dir, f'{filename}_tmp.tsv') ## file for temporary combined tsv file containing taxa from both reads
-            
-            if not os.path.exists(tmp_out):
+            ## read and combine two into final file with just read and final taxid
+            final_out = os.path.join(combined_dir, f'{filename}.tsv')
+            if not os.path.exists(final_out):
                 r1_df = pd.read_csv(r1, delimiter='\t', index_col=0)
                 r2_df = pd.read_csv(r2, delimiter='\t', index_col=0)
                 
@@ -43,32 +42,12 @@ def run_lca(pipeline:str, database:str):
                 
                 merged = pd.merge(r1_df, r2_df, on='query', how='outer')
                 merged['combined_taxids'] = merged['final_taxid_x'].astype(str) + ',' + merged['final_taxid_y'].astype(str)
-
-                ## write to a tmp tsv file to be used by taxonkit
-                merged.to_csv(tmp_out, sep='\t')
-
-            
-            ## run taxonkit on tmp file (if not alreaady done)
-            taxonkit_out = os.path.join(combined_dir, f'{filename}_taxonkit.tsv')
-            if not os.path.exists(taxonkit_out):
-                subprocess.run([
-                    'taxonkit', 'lca',
-                    tmp_out,
-                    '-i', '5',
-                    '--data-dir', database,
-                    '-o', taxonkit_out,
-                    '-s', ','
-                ], check=True, stdout=subprocess.DEVNULL)
-            
-            ## read and combine two into final file with just read and final taxid
-            final_out = os.path.join(combined_dir, f'{filename}.tsv')
-            if not os.path.exists(final_out):
-                full_df = pd.read_csv(tmp_out, delimiter='\t', index_col=0)
-                lca_df = pd.read_csv(taxonkit_out, delimiter='\t', header=None, index_col=0, names=['query', 'taxid1','taxid2','combined','lca'])
+                ## lca of the two reads, a read without a taxid ('-') takes the taxid of its mate
+                merged['lca'] = taxonomy.lca_strings(merged['combined_taxids'])
             
-                final = pd.merge(full_df, lca_df, how='left', on='query')[['query', 'lca']]
+                final = merged[['query', 'lca']].copy()
                 final['lca'] = final['lca'].astype(str).str.replace('\.0$', '', regex=True)
-                final['lca'].replace(['nan', 'NaN', 'None', '', ' '], '-', inplace=True)
+                final['lca'] = final['lca'].replace(['nan', 'NaN', 'None', '', ' '], '-')
                 
                 final.to_csv(final_out, sep='\t')
                 
@@ -0,0 +1,140 @@
+"""Helpers for reading and writing .gz files with parallel (bgzip/pigz) compression, and for
+placing derived files (indexes, caches) in a writable location
+"""
+import io
+import os
+import gzip
+import hashlib
+import shutil
+import signal
+import subprocess
+
+BUFFER_SIZE = 16 * 1024 * 1024
+CACHE_DIR = os.environ.get('GUTVIROME_CACHE',
+                           os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'gutvirome'))
+
+
+def is_gzipped(path:str):
+    '''True if file is gzip/bgzf compressed (by extension)'''
+    return path.endswith('.gz')
+
+
+def strip_ext(filename:str, ext:str):
+    '''Removes ext (and a trailing .gz) from filename, e.g. strip_ext("A_1.fastq.gz", ".fastq") -> "A_1"'''
+    if filename.endswith('.gz'):
+        filename = filename[:-3]
+    if filename.endswith(ext):
+        filename = filename[:-len(ext)]
+    return filename
+
+
+def compress_command(threads:int=1):
+    '''Shell command compressing stdin to stdout, bgzf blocks if bgzip is installed'''
+    if shutil.which('bgzip'):
+        return f'bgzip -@ {threads} -c'
+    if shutil.which('pigz'):
+        return f'pigz -p {threads} -c'
+    return 'gzip -c'
+
+
+def decompress_command(threads:int=1):
+    '''Shell command decompressing a file given as argument to stdout'''
+    if shutil.which('pigz'):
+        return f'pigz -p {threads} -dc'
+    if shutil.which('bgzip'):
+        return f'bgzip -@ {threads} -dc'
+    return 'gzip -dc'
+
+
+class ProcessFile:
+    '''File object over a (de)compression subprocess, close() raising if it failed (not for SIGPIPE after an early close)'''
+    def __init__(self, process, handle, text:bool, reading:bool=False):
+        self.process = process
+        self.reading = reading
+        self.raw = handle
+        self.handle = io.TextIOWrapper(handle) if text else handle
+
+    def __getattr__(self, attr):
+        return getattr(self.handle, attr)
+
+    def __iter__(self):
+        return iter(self.handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.handle.closed:
+            return
+        self.handle.close()
+        returncode = self.process.wait()
+        if returncode != 0 and not (self.reading and returncode == -signal.SIGPIPE):
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+
+
+def open_file(path:str, mode:str='r', threads:int=1):
+    """Opens plain or .gz files, .gz through bgzip/pigz when installed (written as seekable bgzf only with bgzip)
+
+    Args:
+        path (str): file location
+        mode (str, optional): 'r', 'w', 'rb' or 'wb'. Defaults to 'r'.
+        threads (int, optional): number of (de)compression threads. Defaults to 1.
+
+    Returns:
+        file object
+    """
+    if not is_gzipped(path):
+        return open(path, mode, buffering=BUFFER_SIZE)
+
+    text = 'b' not in mode
+    if mode.startswith('r'):
+        command = decompress_command(threads)
+        if command.startswith('gzip'):
+            return gzip.open(path, 'rt' if text else 'rb')
+        process = subprocess.Popen(command.split() + [path], stdout=subprocess.PIPE, bufsize=BUFFER_SIZE)
+        return ProcessFile(process, process.stdout, text, reading=True)
+
+    command = compress_command(threads)
+    if command.startswith('gzip'):
+        return gzip.open(path, 'wt' if text else 'wb')
+    with open(path, 'wb') as out:
+        process = subprocess.Popen(command.split(), stdin=subprocess.PIPE, stdout=out, bufsize=BUFFER_SIZE)
+    return ProcessFile(process, process.stdin, text)
+
+
+def output_name(path:str, compress:bool):
+    '''Adds or removes .gz on an output path'''
+    if compress and not is_gzipped(path):
+        return f'{path}.gz'
+    if not compress and is_gzipped(path):
+        return path[:-3]
+    return path
+
+
+def tmp_path(path:str):
+    '''Temporary name for an output written before being moved into place, keeping the .gz extension'''
+    if is_gzipped(path):
+        return f'{path[:-3]}.tmp.gz'
+    return f'{path}.tmp'
+
+
+def exists_any(path:str):
+    '''True if path exists either plain or .gz compressed'''
+    return os.path.exists(output_name(path, False)) or os.path.exists(output_name(path, True))
+
+
+def writable_dir(directory:str, fallback:str):
+    '''directory if files can be created in it, else fallback (created if needed)'''
+    if os.access(directory, os.W_OK | os.X_OK):
+        return directory
+    os.makedirs(fallback, exist_ok=True)
+    return fallback
+
+
+def cache_name(path:str):
+    '''File name of path made unique by a hash of its absolute location, for files kept in CACHE_DIR'''
+    digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    return f'{os.path.basename(path)}_{digest}'
@@ -0,0 +1,165 @@
+"""
+Collapses exact duplicate reads before seqscreen and re-expands seqscreen reports afterwards
+"""
+import argparse
+import os
+import glob
+import hashlib
+from compression import open_file, tmp_path, BUFFER_SIZE
+
+
+def read_fasta(handle):
+    '''Yields (header, sequence) for each record of a fasta file handle'''
+    header = None
+    seq = []
+    for line in handle:
+        if line.startswith('>'):
+            if header is not None:
+                yield header, ''.join(seq)
+            header = line[1:].rstrip('\n')
+            seq = []
+        else:
+            seq.append(line.strip())
+    if header is not None:
+        yield header, ''.join(seq)
+
+
+def collapse_fasta(fasta:str, out_fasta:str, multiplicity:str, threads:int=4):
+    """Collapses identical sequences into their first read, listing the reads of each in a multiplicity table
+
+    Args:
+        fasta (str): input fasta file
+        out_fasta (str): deduplicated fasta file
+        multiplicity (str): multiplicity table location
+        threads (int, optional): number of (de)compression threads for .gz files. Defaults to 4.
+
+    Returns:
+        (int, int): number of reads, number of unique sequences
+    """
+    seen = {}
+    members = []
+    reads = 0
+    with open_file(fasta, 'r', threads) as handle, \
+         open_file(tmp_path(out_fasta), 'w', threads) as out:
+        for header, seq in read_fasta(handle):
+            read_id = header.split()[0]
+            reads += 1
+            key = hashlib.blake2b(seq.encode(), digest_size=16).digest()
+            idx = seen.get(key)
+            if idx is None:
+                seen[key] = len(members)
+                members.append([read_id])
+                out.write(f'>{header}\n{seq}\n')
+            else:
+                members[idx].append(read_id)
+
+    with open(f'{multiplicity}.tmp', 'w', buffering=BUFFER_SIZE) as out:
+        out.write('representative\tcount\treads\n')
+        for read_ids in members:
+            out.write(f'{read_ids[0]}\t{len(read_ids)}\t{",".join(read_ids)}\n')
+
+    os.replace(tmp_path(out_fasta), out_fasta)
+    os.replace(f'{multiplicity}.tmp', multiplicity)
+    return reads, len(members)
+
+
+def read_multiplicity(multiplicity:str):
+    '''Reads multiplicity table into dict of representative -> list of read ids'''
+    members = {}
+    with open(multiplicity, 'r', buffering=BUFFER_SIZE) as handle:
+        next(handle)
+        for line in handle:
+            representative, _, read_ids = line.rstrip('\n').split('\t')
+            members[representative] = read_ids.split(',')
+    return members
+
+
+def expand_report(report:str, multiplicity:str, outname:str):
+    """Re-expands a seqscreen report of a deduplicated fasta to one (indexed) row per original read
+
+    Args:
+        report (str): seqscreen report of deduplicated fasta
+        multiplicity (str): multiplicity table written by collapse_fasta
+        outname (str): expanded report location
+
+    Returns:
+        int: number of rows written
+    """
+    members = read_multiplicity(multiplicity)
+    row = 0
+    with open(report, 'r', buffering=BUFFER_SIZE) as handle, \
+         open(f'{outname}.tmp', 'w', buffering=BUFFER_SIZE) as out:
+        header = handle.readline()
+        query_col = header.rstrip('\n').split('\t').index('query')
+        out.write(f'\t{header}')
+        for line in handle:
+            fields = line.rstrip('\n').split('\t')
+            for read_id in members.get(fields[query_col], [fields[query_col]]):
+                fields[query_col] = read_id
+                out.write(f'{row}\t' + '\t'.join(fields) + '\n')
+                row += 1
+    os.replace(f'{outname}.tmp', outname)
+    return row
+
+
+def dedup(pipeline:str):
+    """Collapses duplicate reads of every fasta file into fasta-dedup
+
+    Args:
+        pipeline (str): pipeline directory
+    """
+    fasta_dir = os.path.join(pipeline, 'fasta')
+    dedup_dir = os.path.join(pipeline, 'fasta-dedup')
+
+    input_files = sorted(glob.glob(f'{fasta_dir}/*.fasta') + glob.glob(f'{fasta_dir}/*.fasta.gz'))
+    for i, file in enumerate(input_files):
+        name = file.split('/')[-1]
+        out_loc = os.path.join(dedup_dir, name)
+        multiplicity = os.path.join(dedup_dir, f'{name.split(".fasta")[0]}.multiplicity.tsv')
+        if not os.path.exists(out_loc):
+            reads, unique = collapse_fasta(file, out_loc, multiplicity)
+            print(f'[{i+1}] {name}: {reads} reads -> {unique} unique ({round((1 - unique/reads) * 100, 2) if reads else 0}% duplicates)')
+
+
+def expand(pipeline:str):
+    """Re-expands seqscreen reports of deduplicated files into seqscreen/final
+
+    Args:
+        pipeline (str): pipeline directory
+    """
+    dedup_dir = os.path.join(pipeline, 'fasta-dedup')
+    seqscreen_dir = os.path.join(pipeline, 'seqscreen', 'fast')
+    output_dir = os.path.join(pipeline, 'seqscreen', 'final')
+
+    tables = sorted(glob.glob(f'{dedup_dir}/*.multiplicity.tsv'))
+    for i, multiplicity in enumerate(tables):
+        basename = multiplicity.split('/')[-1].split('.multiplicity.tsv')[0]
+        working = os.path.join(seqscreen_dir, f'{basename}.fasta')
+        if not os.path.exists(working):
+            working = f'{working}.gz'
+        report = os.path.join(working, 'report_generation', f'{basename}_seqscreen_report.tsv')
+        outname = os.path.join(output_dir, f'{basename}.tsv')
+        if os.path.exists(report) and not os.path.exists(outname):
+            rows = expand_report(report, multiplicity, outname)
+            print(f'[{i+1}] {basename}: {rows} reads')
+
+
+def parse_args():
+    """Parses arguments for deduplication
+    """
+    parser = argparse.ArgumentParser(
+        description='Collapses duplicate reads before seqscreen (or re-expands seqscreen reports with --expand)')
+    parser.add_argument('pipeline', type=str, help='pipeline directory')
+    parser.add_argument('--expand', action='store_true', default=False,
+                        help='Re-expand seqscreen reports of deduplicated files into seqscreen/final')
+
+    args = parser.parse_args()
+    pipeline = args.pipeline
+
+    if args.expand:
+        expand(pipeline)
+    else:
+        dedup(pipeline)
+
+if __name__=="__main__":
+    parse_args()
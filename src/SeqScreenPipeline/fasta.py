@@ -1,35 +1,122 @@
 """
-converts fastq files to fasta files with seqtk 
+converts fastq files to fasta files with seqtk (or in process with --local)
 """
 import argparse
 import os
 import glob
+from multiprocessing.pool import ThreadPool
 from slurm import slurm
+from compression import is_gzipped, strip_ext, compress_command, open_file, tmp_path, BUFFER_SIZE
 
 
-def fasta(pipeline:str):
+def fastq_to_fasta(src:str, fasta:str, checkpoint:str=None, strip_comments:bool=False, threads:int=2):
+    """Converts a fastq file (or stream) to fasta like seqtk seq -A, into tmp_path(fasta) for the caller to move
+
+    Args:
+        src (str): fastq file or fifo
+        fasta (str): fasta output, .gz for gzip (bgzf if bgzip is installed)
+        checkpoint (str, optional): also write the fastq to tmp_path(checkpoint)
+        strip_comments (bool, optional): only keep read id in headers (same as util/fix_fasta.py). Defaults to False.
+        threads (int, optional): number of (de)compression threads for .gz files. Defaults to 2.
+
+    Returns:
+        int: number of reads
+    """
+    count = 0
+    carry = []
+    ckpt = open_file(tmp_path(checkpoint), 'w', threads=threads) if checkpoint else None
+    with open_file(src, 'r', threads=threads) as handle, \
+         open_file(tmp_path(fasta), 'w', threads=threads) as out:
+        for lines in iter(lambda: handle.readlines(BUFFER_SIZE), []):
+            if ckpt:
+                ckpt.writelines(lines)
+            if not lines[-1].endswith('\n'):
+                lines[-1] += '\n'
+            lines = carry + lines
+            n = len(lines) - len(lines) % 4
+            carry = lines[n:]
+            if strip_comments:
+                ## a bare @ header has no read id and stays a bare >
+                out.write(''.join(f'>{"".join(header[1:].split(maxsplit=1)[:1])}\n{seq}' for header, seq in zip(lines[0:n:4], lines[1:n:4])))
+            else:
+                out.write(''.join(f'>{header[1:]}{seq}' for header, seq in zip(lines[0:n:4], lines[1:n:4])))
+            count += n // 4
+    if ckpt:
+        ckpt.close()
+    if carry:
+        raise ValueError(f'Truncated fastq record at end of {src}')
+    return count
+
+
+def convert_file(src:str, fasta:str, strip_comments:bool):
+    '''Converts one file and moves it into place once complete'''
+    try:
+        count = fastq_to_fasta(src, fasta, strip_comments=strip_comments)
+    except BaseException:
+        if os.path.exists(tmp_path(fasta)):
+            os.remove(tmp_path(fasta))
+        raise
+    os.replace(tmp_path(fasta), fasta)
+    print(f'{fasta}: {count} reads')
+    return count
+
+
+def fasta_local(pipeline:str, compress:bool=False, threads:int=4, strip_comments:bool=True):
+    """Converts all pending fastq files to fasta in this process with a thread pool
+
+    Args:
+        pipeline (str): pipeline directory
+        compress (bool): write .fasta.gz output (always done for .gz inputs)
+        threads (int): number of files converted at once
+        strip_comments (bool): only keep read id in headers
+    """
+    removed_human_dir = os.path.join(pipeline, 'removed-human')
+    fasta_dir = os.path.join(pipeline, 'fasta')
+
+    input_files = sorted(glob.glob(f'{removed_human_dir}/*.fastq') + glob.glob(f'{removed_human_dir}/*.fastq.gz'))
+
+    jobs = []
+    for file in input_files:
+        name = file.split('/')[-1]
+        gz_out = compress or is_gzipped(file)
+        fasta_name = strip_ext(name, '.fastq') + ('.fasta.gz' if gz_out else '.fasta')
+        out_loc = os.path.join(fasta_dir, fasta_name)
+        if not os.path.exists(out_loc):
+            jobs.append((file, out_loc, strip_comments))
+
+    print(f'Converting {len(jobs)} files with {threads} threads')
+    with ThreadPool(threads) as pool:
+        pool.starmap(convert_file, jobs)
+
+
+def fasta(pipeline:str, compress:bool=False):
     """Runs seqtk on the files to convert to fasta
 
     Args:
         pipeline (str): _description_
+        compress (bool): write .fasta.gz output (always done for .gz inputs)
     """
     removed_human_dir = os.path.join(pipeline, 'removed-human')
     fasta_dir = os.path.join(pipeline, 'fasta')
     
-    input_files = glob.glob(f'{removed_human_dir}/*.fastq')
+    input_files = glob.glob(f'{removed_human_dir}/*.fastq') + glob.glob(f'{removed_human_dir}/*.fastq.gz')
 
     ## process with seqtk
     i = 1
     for file in input_files:
         name = file.split('/')[-1]
-        fasta_name = name[:-1] + 'a'
+        gz_out = compress or is_gzipped(file)
+        fasta_name = strip_ext(name, '.fastq') + ('.fasta.gz' if gz_out else '.fasta')
         out_loc = os.path.join(fasta_dir, fasta_name)
         if not os.path.exists(out_loc):
-            command = f'seqtk seq -A {file} > {out_loc}'
+            if gz_out:
+                command = f'seqtk seq -A {file} | {compress_command(4)} > {out_loc}'
+            else:
+                command = f'seqtk seq -A {file} > {out_loc}'
             print(f'[{i}]{command}')
             i+=1
             name = out_loc.split('/')[-1]
-            slurm([command], f'{name}_fasta', hours=1, days=0, memory=16)
+            slurm([command], f'{name}_fasta', hours=1, days=0, memory=16, threads_per_task=4 if gz_out else 1)
 
 
 
@@ -39,11 +126,21 @@ def parse_args():
     parser = argparse.ArgumentParser(
         description='Bulk processes folder of fastq files into fasta')
     parser.add_argument('pipeline', type=str, help='pipeline directory containing fastq files')
+    parser.add_argument('--compress', action='store_true', default=False, help='Write .fasta.gz outputs (always done for .gz inputs)')
+    parser.add_argument('--local', action='store_true', default=False,
+                        help='Convert all files in this process instead of one slurm job per file')
+    parser.add_argument('-t', '--threads', type=int, default=4, help='Number of files converted at once with --local')
+    parser.add_argument('--keep-comments', action='store_true', default=False,
+                        help='Keep header comments with --local (stripped by default, as util/fix_fasta.py does)')
 
     args = parser.parse_args()
     pipeline = args.pipeline
+    compress = args.compress
 
-    fasta(pipeline)
+    if args.local:
+        fasta_local(pipeline, compress, args.threads, not args.keep_comments)
+    else:
+        fasta(pipeline, compress)
 
 if __name__=="__main__":
     parse_args()
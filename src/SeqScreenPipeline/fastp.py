@@ -3,29 +3,31 @@ import argparse
 import os
 import glob
 from slurm import slurm
+from compression import is_gzipped, strip_ext
 
 
-def fastp(pipeline:str, alt:str=None, alt_name:str=None, paired=True):
+def fastp(pipeline:str, alt:str=None, alt_name:str=None, paired=True, compress=False):
     """Runs seqtk on the files for length and quality filtering
 
     Args:
         pipeline (str): pipeline files
         alt (str): alternative input 
+        compress (bool): write .fastq.gz output even for uncompressed input
     """
     if alt is None and paired:
         fastq_dir = os.path.join(pipeline, 'fastq')
-        input_files = glob.glob(f'{fastq_dir}/*1.fastq')
+        input_files = glob.glob(f'{fastq_dir}/*1.fastq') + glob.glob(f'{fastq_dir}/*1.fastq.gz')
     elif paired:
         fastq_dir = alt
         if alt_name is None:
-            input_files = glob.glob(f'{fastq_dir}/*1.fastq')
+            input_files = glob.glob(f'{fastq_dir}/*1.fastq') + glob.glob(f'{fastq_dir}/*1.fastq.gz')
         else:
             all_files = glob.glob(f'{fastq_dir}/{alt_name}')
             input_files = [file for file in all_files if '1.fastq' in file]
     else:
         fastq_dir = alt
         if alt_name is None:
-            input_files = glob.glob(f'{fastq_dir}/*1.fastq')
+            input_files = glob.glob(f'{fastq_dir}/*1.fastq') + glob.glob(f'{fastq_dir}/*1.fastq.gz')
         else:
             all_files = glob.glob(f'{fastq_dir}/{alt_name}')
             input_files = [file for file in all_files if '.fastq' in file]
@@ -36,12 +38,12 @@ def fastp(pipeline:str, alt:str=None, alt_name:str=None, paired=True):
     if paired:
         for sample in input_files:
             filename = sample.split('/')[-1].split('1.fastq')[0]
-            r1 = f'{filename}1.fastq'
-            r2 = f'{filename}2.fastq'
-            file_loc_r1 = os.path.join(fastq_dir, r1)
-            file_loc_r2 = os.path.join(fastq_dir, r2)
-            out_loc_r1 = os.path.join(fastp_dir, r1)
-            out_loc_r2 = os.path.join(fastp_dir, r2)
+            ext = '.fastq.gz' if is_gzipped(sample) else '.fastq'
+            out_ext = '.fastq.gz' if (compress or is_gzipped(sample)) else '.fastq'
+            file_loc_r1 = os.path.join(fastq_dir, f'{filename}1{ext}')
+            file_loc_r2 = os.path.join(fastq_dir, f'{filename}2{ext}')
+            out_loc_r1 = os.path.join(fastp_dir, f'{filename}1{out_ext}')
+            out_loc_r2 = os.path.join(fastp_dir, f'{filename}2{out_ext}')
             threads = 5
             if not (os.path.exists(out_loc_r1) and os.path.exists(out_loc_r2)):
                 command = f'fastp -i {file_loc_r1} -I {file_loc_r2} -o {out_loc_r1} -O {out_loc_r2} -l 50 -y -3 -W 4 -M 20 -x --thread {threads}'
@@ -50,9 +52,10 @@ def fastp(pipeline:str, alt:str=None, alt_name:str=None, paired=True):
         for sample in input_files:
             filename = sample.split('/')[-1]
             file_loc_r1 = os.path.join(fastq_dir, filename)
-            out_loc_r1 = os.path.join(fastp_dir, filename)
+            out_ext = '.fastq.gz' if (compress or is_gzipped(sample)) else '.fastq'
+            out_loc_r1 = os.path.join(fastp_dir, strip_ext(filename, '.fastq') + out_ext)
             threads = 5
-            if not (os.path.exists(out_loc_r1) and os.path.exists(out_loc_r2)):
+            if not os.path.exists(out_loc_r1):
                 command = f'fastp -i {file_loc_r1} -o {out_loc_r1} -l 50 -y -3 -W 4 -M 20 -x --thread {threads}'
                 slurm([command], f'{filename}_fastp', hours=1, days=0, memory=4, tasks=1, threads_per_task=threads) 
 
@@ -71,14 +74,16 @@ def parse_args():
     parser.add_argument('--alt-input', type=str, default=None, help='location if fastq folders are in different location')
     parser.add_argument('--alt-name', type=str, default=None, help='general name format for alt input folder fastq files')
     parser.add_argument('--unpaired', action='store_false', help='If single end reads')
+    parser.add_argument('--compress', action='store_true', default=False, help='Write .fastq.gz outputs (always done for .gz inputs)')
 
     args = parser.parse_args()
     pipeline = args.pipeline
     alt = args.alt_input
     name = args.alt_name
     paired = args.unpaired
+    compress = args.compress
 
-    fastp(pipeline, alt, name, paired)
+    fastp(pipeline, alt, name, paired, compress)
 
 if __name__=="__main__":
     parse_args()
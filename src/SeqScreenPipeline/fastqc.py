@@ -4,7 +4,89 @@ Runs fastqc on bulk fastq files
 import argparse
 import os
 import glob
-from slurm import slurm
+import math
+import shutil
+import subprocess
+import tempfile
+import zlib
+import multiprocessing as mp
+import numpy as np
+from slurm import slurm, mkdir_p
+from compression import open_file, BUFFER_SIZE
+
+FASTQ_EXTENSIONS = ('.fastq', '.fq', '.fastq.gz', '.fq.gz')
+
+
+def fastqc_name(file:str):
+    '''Name of the zip FastQC writes for file, e.g. A_1.fastq.gz -> A_1_fastqc.zip'''
+    name = file.split('/')[-1]
+    for ext in ('.gz', '.bz2', '.fastq', '.fq'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+    return f'{name}_fastqc.zip'
+
+
+def stage_dirs(pipeline:str, alt:str=None):
+    """Input and fastqc output directories of the raw, fastp and removed-human stages
+
+    Args:
+        pipeline (str): pipeline directory
+        alt (str, optional): location of raw fastq files if not in pipeline. Defaults to None.
+
+    Returns:
+        list: (input directory, output directory) pairs
+    """
+    fastq_dir = os.path.join(pipeline, 'fastq') if alt is None else alt
+    return [(fastq_dir, os.path.join(pipeline, 'fastqc', 'raw')),
+            (os.path.join(pipeline, 'fastp'), os.path.join(pipeline, 'fastqc', 'fastp')),
+            (os.path.join(pipeline, 'removed-human'), os.path.join(pipeline, 'fastqc', 'removed-human'))]
+
+
+def pending_files(pipeline:str, alt:str=None):
+    """Gets fastq files that do not have a FastQC report yet
+
+    Args:
+        pipeline (str): pipeline directory
+        alt (str, optional): location of raw fastq files if not in pipeline. Defaults to None.
+
+    Returns:
+        list: (fastq file, output directory) pairs
+    """
+    pending = []
+    for input_dir, output_dir in stage_dirs(pipeline, alt):
+        if not os.path.exists(input_dir):
+            continue
+        mkdir_p(os.path.dirname(output_dir))
+        mkdir_p(output_dir)
+        for file in sorted(os.listdir(input_dir)):
+            if file.endswith(FASTQ_EXTENSIONS) and not os.path.exists(os.path.join(output_dir, fastqc_name(file))):
+                pending.append((os.path.join(input_dir, file), output_dir))
+    return pending
+
+
+def fastqc_incremental(pipeline:str, alt:str=None, threads:int=16):
+    """Runs fastqc only on files missing a report, packing them into jobs of [threads] files (one thread per file)
+
+    Args:
+        pipeline (str): pipeline directory
+        alt (str, optional): location of raw fastq files if not in pipeline. Defaults to None.
+        threads (int, optional): number of files (= threads) per job. Defaults to 16.
+    """
+    pending = pending_files(pipeline, alt)
+    print(f'{len(pending)} files missing FastQC reports')
+
+    name = pipeline.rstrip('/').split('/')[-1]
+    for i in range(0, len(pending), threads):
+        batch = pending[i:i + threads]
+        by_output = {}
+        for file, output_dir in batch:
+            by_output.setdefault(output_dir, []).append(file)
+        commands = [f'fastqc -f fastq -o {output_dir} -t {len(files)} {" ".join(files)} &'
+                    for output_dir, files in by_output.items()]
+        commands.append('wait')
+        ## fastqc allocates 250MB per thread
+        memory = max(4, math.ceil(0.5 * len(batch)))
+        slurm(commands, f'{name}_fastqc_{i // threads + 1}', hours=1, days=0, memory=memory, threads_per_task=len(batch))
 
 
 def fastqc(pipeline:str, alt:str=None):
@@ -45,18 +127,148 @@ def fastqc(pipeline:str, alt:str=None):
 
 
 
+def reservoir_sample(fastq:str, out:str, size:int, seed:int=0):
+    """Writes a uniform random sample of [size] reads of fastq to out in a single pass (reservoir sampling,
+    seeded from seed and the file name so a file always gives the same sample)
+
+    Args:
+        fastq (str): fastq file (.gz allowed)
+        out (str): sampled fastq output
+        size (int): number of reads to sample
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        int: total number of reads in fastq
+    """
+    rng = np.random.default_rng([seed, zlib.crc32(os.path.basename(fastq).encode())])
+    reservoir = []
+    seen = 0
+    carry = []
+    with open_file(fastq, 'rb', threads=2) as handle:
+        for lines in iter(lambda: handle.readlines(BUFFER_SIZE), []):
+            if not lines[-1].endswith(b'\n'):
+                lines[-1] += b'\n'
+            lines = carry + lines
+            n = len(lines) - len(lines) % 4
+            carry = lines[n:]
+            records = [b''.join(lines[k:k + 4]) for k in range(0, n, 4)]
+
+            fill = min(size - len(reservoir), len(records))
+            reservoir.extend(records[:fill])
+            seen += fill
+            records = records[fill:]
+            if records:
+                ## slot for record i is uniform in [0, i], kept if it falls inside the reservoir
+                slots = rng.integers(0, np.arange(seen, seen + len(records)) + 1)
+                for k in np.nonzero(slots < size)[0]:
+                    reservoir[slots[k]] = records[k]
+                seen += len(records)
+    if carry:
+        raise ValueError(f'Truncated fastq record at end of {fastq}')
+
+    with open(out, 'wb') as handle:
+        handle.writelines(reservoir)
+    return seen
+
+
+def fastqc_sample(fastq:str, output_dir:str, size:int, seed:int=0, tmp:str=None):
+    """Runs fastqc on a reservoir sample of a fastq file, writing the full read count to [name]_read_count.tsv
+
+    Args:
+        fastq (str): fastq file
+        output_dir (str): fastqc output directory
+        size (int): number of reads to sample
+        seed (int, optional): random seed. Defaults to 0.
+        tmp (str, optional): directory for the sampled fastq. Defaults to $TMPDIR.
+    """
+    name = fastqc_name(fastq)[:-len('_fastqc.zip')]
+    sample_dir = tempfile.mkdtemp(prefix=f'{name}_fastqc_', dir=tmp)
+    try:
+        sample = os.path.join(sample_dir, f'{name}.fastq')
+        reads = reservoir_sample(fastq, sample, size, seed)
+        subprocess.run(['fastqc', '-q', '-f', 'fastq', '-o', output_dir, '-t', '1', sample], check=True)
+    finally:
+        shutil.rmtree(sample_dir, ignore_errors=True)
+
+    with open(os.path.join(output_dir, f'{name}_read_count.tsv'), 'w') as handle:
+        handle.write('file\treads\tsampled\tseed\n')
+        handle.write(f'{fastq}\t{reads}\t{min(size, reads)}\t{seed}\n')
+    print(f'{fastq}: {reads} reads, fastqc on {min(size, reads)}')
+
+
+def fastqc_sample_files(pipeline:str, files:list, size:int, seed:int=0, alt:str=None, threads:int=1, tmp:str=None):
+    """Runs subsampled fastqc on a list of files in this process, one file per process
+
+    Args:
+        pipeline (str): pipeline directory
+        files (list): fastq files in the fastq, fastp or removed-human folders
+        size (int): number of reads to sample per file
+        seed (int, optional): random seed. Defaults to 0.
+        alt (str, optional): location of raw fastq files if not in pipeline. Defaults to None.
+        threads (int, optional): number of files processed at once. Defaults to 1.
+        tmp (str, optional): directory for the sampled fastq files. Defaults to $TMPDIR.
+    """
+    output_dirs = {os.path.abspath(input_dir): output_dir for input_dir, output_dir in stage_dirs(pipeline, alt)}
+    mkdir_p(os.path.join(pipeline, 'fastqc'))
+    for output_dir in output_dirs.values():
+        mkdir_p(output_dir)
+    data = [(file, output_dirs[os.path.abspath(os.path.dirname(file))], size, seed, tmp) for file in files]
+    with mp.Pool(threads) as pool:
+        pool.starmap(fastqc_sample, data)
+
+
+def fastqc_subsample(pipeline:str, size:int, seed:int=0, alt:str=None, threads:int=16):
+    """Submits subsampled fastqc jobs for files missing a report, [threads] files per job
+
+    Args:
+        pipeline (str): pipeline directory
+        size (int): number of reads to sample per file
+        seed (int, optional): random seed. Defaults to 0.
+        alt (str, optional): location of raw fastq files if not in pipeline. Defaults to None.
+        threads (int, optional): number of files (= threads) per job. Defaults to 16.
+    """
+    pending = pending_files(pipeline, alt)
+    print(f'{len(pending)} files missing FastQC reports')
+
+    name = pipeline.rstrip('/').split('/')[-1]
+    for i in range(0, len(pending), threads):
+        batch = [file for file, _ in pending[i:i + threads]]
+        command = f'python fastqc.py {pipeline} --subsample {size} --seed {seed} -t {len(batch)} --files {",".join(batch)}'
+        if alt is not None:
+            command += f' --alt-input {alt}'
+        ## reservoir plus fastqc (250MB) per file
+        memory = max(4, math.ceil(len(batch) * (0.5 + size / 1e6)))
+        slurm([command], f'{name}_fastqc_sample_{i // threads + 1}', hours=1, days=0, memory=memory, threads_per_task=len(batch))
+
+
 def parse_args():
     """Parses arguments for fastqc 
     """
     parser = argparse.ArgumentParser(description='Bulk processes folder of files with fastqc')
     parser.add_argument('pipeline', type=str, help='pipeline directory containing files')
     parser.add_argument('--alt-input', type=str, default=None, help='location if fastq folders are in different location')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Only run files without a _fastqc.zip report, packed into jobs of --threads files')
+    parser.add_argument('-t', '--threads', type=int, default=16, help='Files (one thread each) per job with --incremental or --subsample')
+    parser.add_argument('--subsample', type=int, default=None,
+                        help='Run fastqc on a random sample of this many reads per file (files missing a report only)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for --subsample')
+    parser.add_argument('--files', type=str, default=None,
+                        help='Comma separated files to run with --subsample in this process instead of submitting jobs')
+    parser.add_argument('--tmp', type=str, default=None, help='Directory for sampled fastq files (defaults to $TMPDIR)')
 
     args = parser.parse_args()
     pipeline = args.pipeline
     alt = args.alt_input
 
-    fastqc(pipeline, alt)
+    if args.subsample is not None and args.files is not None:
+        fastqc_sample_files(pipeline, args.files.split(','), args.subsample, args.seed, alt, args.threads, args.tmp)
+    elif args.subsample is not None:
+        fastqc_subsample(pipeline, args.subsample, args.seed, alt, args.threads)
+    elif args.incremental:
+        fastqc_incremental(pipeline, alt, args.threads)
+    else:
+        fastqc(pipeline, alt)
 
 if __name__=="__main__":
     parse_args()
@@ -2,36 +2,158 @@
 import argparse
 import os
 import glob
+import math
+import shutil
+import subprocess
+import tempfile
+from multiprocessing.pool import ThreadPool
 from slurm import slurm
+from compression import is_gzipped
+from kmer_prefilter import KmerFilter, split_candidates
 
 
-def remove_human(pipeline:str, genome:str, threads:int=1, paired=True):
-    
+def sample_paths(pipeline:str, name:str, compress:bool=False):
+    """Gets input and output locations for a paired sample
+
+    Args:
+        pipeline (str): pipeline directory
+        name (str): sample name (everything before 1.fastq)
+        compress (bool, optional): write .fastq.gz outputs. Defaults to False.
+
+    Returns:
+        (str, str, str, str): r1 input, r2 input, r1 output, r2 output
+    """
     fastp_dir = os.path.join(pipeline, 'fastp')
     removed_reads = os.path.join(pipeline, 'removed-human')
-    
-    
+
+    ext = '.fastq'
+    if not os.path.exists(os.path.join(fastp_dir, f'{name}1{ext}')):
+        ext = '.fastq.gz'
+    out_ext = '.fastq.gz' if (compress or is_gzipped(ext)) else '.fastq'
+
+    r1_loc = os.path.join(fastp_dir, f'{name}1{ext}')
+    r2_loc = os.path.join(fastp_dir, f'{name}2{ext}')
+    out1 = os.path.join(removed_reads, f'{name}1{out_ext}')
+    out2 = os.path.join(removed_reads, f'{name}2{out_ext}')
+    return r1_loc, r2_loc, out1, out2
+
+
+def concatenate(files:list, output:str):
+    '''Concatenates files byte for byte (gzip members can be concatenated as well)'''
+    with open(output, 'wb') as out:
+        for file in files:
+            with open(file, 'rb') as handle:
+                shutil.copyfileobj(handle, out, 16 * 1024 * 1024)
+
+
+def run_bowtie2(pipeline:str, name:str, genome:str, threads:int=1, compress:bool=False, prefilter:str=None, min_hits:int=1):
+    """Runs bowtie2 (memory mapped index) for one sample and moves the unaligned pairs to [name]1/2.fastq(.gz)
+
+    Args:
+        pipeline (str): pipeline directory
+        name (str): sample name (everything before 1.fastq)
+        genome (str): bowtie2 index
+        threads (int, optional): number of bowtie2 threads. Defaults to 1.
+        compress (bool, optional): write .fastq.gz outputs. Defaults to False.
+        prefilter (str, optional): prefix of kmer_prefilter.py filter. Defaults to None.
+        min_hits (int, optional): human k-mer hits for a pair to be aligned. Defaults to 1.
+    """
+    r1_loc, r2_loc, out1, out2 = sample_paths(pipeline, name, compress)
+    if os.path.exists(out1) and os.path.exists(out2):
+        return
+
+    gz_out = is_gzipped(out1)
+    tmp_out = os.path.join(os.path.dirname(out1), f'{name}.%.tmp')
+    work = tempfile.mkdtemp(prefix=f'{name}remove_human_')
+    try:
+        if prefilter is not None:
+            ext = '.fastq.gz' if gz_out else '.fastq'
+            candidates = (os.path.join(work, 'candidates1.fastq'), os.path.join(work, 'candidates2.fastq'))
+            keep = (os.path.join(work, f'keep1{ext}'), os.path.join(work, f'keep2{ext}'))
+            num_candidates, num_kept = split_candidates(r1_loc, r2_loc, KmerFilter(prefilter), candidates, keep, min_hits)
+            print(f'{name}: {num_kept} pairs without human k-mers skip bowtie2, {num_candidates} pairs aligned')
+            r1_loc, r2_loc = candidates
+
+        print(f'Removing human reads from {name}')
+        subprocess.run([
+            'bowtie2',
+            '--mm',
+            '-p', str(threads),
+            '-x', genome,
+            '-1', r1_loc,
+            '-2', r2_loc,
+            '--un-conc-gz' if gz_out else '--un-conc', tmp_out,
+            '-S', os.devnull
+        ], check=True)
+
+        if prefilter is not None:
+            for mate, out in ((1, out1), (2, out2)):
+                unaligned = tmp_out.replace('%', str(mate))
+                concatenate([keep[mate - 1], unaligned], f'{unaligned}.merged')
+                os.replace(f'{unaligned}.merged', out)
+                os.remove(unaligned)
+        else:
+            os.replace(tmp_out.replace('%', '1'), out1)
+            os.replace(tmp_out.replace('%', '2'), out2)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def remove_human_batch(pipeline:str, names:list, genome:str, threads:int=1, concurrent:int=1, compress:bool=False, prefilter:str=None, min_hits:int=1):
+    """Runs host removal for a list of samples within one allocation
+
+    Args:
+        pipeline (str): pipeline directory
+        names (list): sample names
+        genome (str): bowtie2 index
+        threads (int, optional): total number of threads. Defaults to 1.
+        concurrent (int, optional): number of samples aligned at once. Defaults to 1.
+        compress (bool, optional): write .fastq.gz outputs. Defaults to False.
+        prefilter (str, optional): prefix of kmer_prefilter.py filter. Defaults to None.
+        min_hits (int, optional): human k-mer hits for a pair to be aligned. Defaults to 1.
+    """
+    threads_per_sample = max(1, threads // concurrent)
+    data = [(pipeline, name, genome, threads_per_sample, compress, prefilter, min_hits) for name in names]
+    with ThreadPool(concurrent) as pool:
+        pool.starmap(run_bowtie2, data)
+
+
+def remove_human(pipeline:str, genome:str, threads:int=1, paired=True, compress=False, batch_size:int=1, concurrent:int=1, prefilter:str=None, min_hits:int=1):
+    """Submits host removal jobs for every sample that has not been processed
+
+    Args:
+        pipeline (str): pipeline directory
+        genome (str): bowtie2 index
+        threads (int, optional): number of threads per job. Defaults to 1.
+        compress (bool, optional): write .fastq.gz outputs. Defaults to False.
+        batch_size (int, optional): number of samples per slurm job. Defaults to 1.
+        concurrent (int, optional): number of samples aligned at once within a job. Defaults to 1.
+        prefilter (str, optional): prefix of kmer_prefilter.py filter. Defaults to None.
+        min_hits (int, optional): human k-mer hits for a pair to be aligned. Defaults to 1.
+    """
+    fastp_dir = os.path.join(pipeline, 'fastp')
+
     if paired:
-        input_files = glob.glob(f'{fastp_dir}/*1.fastq')
-        
+        input_files = sorted(glob.glob(f'{fastp_dir}/*1.fastq') + glob.glob(f'{fastp_dir}/*1.fastq.gz'))
+
+        pending = []
         for file in input_files:
-    
             ## if paired end reads not merged
             name = file.split('/')[-1].split('1.fastq')[0]
-            r1 = f'{name}1.fastq'
-            r2 = f'{name}2.fastq'
-            r1_loc = os.path.join(fastp_dir, r1)
-            r2_loc = os.path.join(fastp_dir, r2)
-            out = os.path.join(removed_reads, name)
-            command = f'bowtie2 -p {threads} -x {genome} -1 {r1_loc} -2 {r2_loc} --un-conc {out}'
-            out_parts = out.split('/')[-1]
-            out1 = os.path.join(removed_reads, f'{out_parts}.1')
-            out2 = os.path.join(removed_reads, f'{out_parts}.2')
-            mv_1 = f'mv {out1} {out}1.fastq'
-            mv_2 = f'mv {out2} {out}2.fastq'
-            
-            if not os.path.exists(f'{out}_R1.fastq'):
-                slurm([command, mv_1, mv_2], f'{name}_remove_human', hours=1, days=0, memory=10, threads_per_task=threads)
+            _, _, out1, out2 = sample_paths(pipeline, name, compress)
+            if not (os.path.exists(out1) and os.path.exists(out2)):
+                pending.append(name)
+
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            command = f'python human_read_removal.py {pipeline} {genome} -t {threads} --samples {",".join(batch)} --concurrent {concurrent}'
+            if compress:
+                command += ' --compress'
+            if prefilter is not None:
+                command += f' --prefilter {prefilter} --min-hits {min_hits}'
+            hours = math.ceil(len(batch) / concurrent)
+            job_name = f'{batch[0]}_remove_human' if len(batch) == 1 else f'{batch[0]}_remove_human_batch{len(batch)}'
+            slurm([command], job_name, hours=hours, days=0, memory=10 + 2 * concurrent, threads_per_task=threads)
 
 def parse_args():
     '''
@@ -40,14 +162,31 @@ def parse_args():
     parser = argparse.ArgumentParser(description='Removes human reads from filtered samples')
     parser.add_argument('pipeline', type=str, help="location of pipeline files")
     parser.add_argument('genome', type=str, help="Location of bowtie indexes (note: probably in form GRCh38_noalt_as/GRCh38_noalt_as)")
-    parser.add_argument('-t', '--threads', type=int, help="Number of threads")
-    
+    parser.add_argument('-t', '--threads', type=int, default=1, help="Number of threads")
+    parser.add_argument('--compress', action='store_true', default=False, help='Write .fastq.gz outputs (always done for .gz inputs)')
+    parser.add_argument('--batch-size', type=int, default=1, help='Number of samples processed per slurm job')
+    parser.add_argument('--concurrent', type=int, default=1, help='Number of samples aligned at once within a job (threads are split between them)')
+    parser.add_argument('--prefilter', type=str, default=None,
+                        help='Prefix of human k-mer filter (kmer_prefilter.py build); pairs without human k-mers skip bowtie2')
+    parser.add_argument('--min-hits', type=int, default=1, help='Human k-mer hits for a pair to be aligned with --prefilter')
+    parser.add_argument('--samples', type=str, default=None,
+                        help='Comma separated sample names to run in this process instead of submitting jobs')
+
     args = parser.parse_args()
     pipeline = args.pipeline
     genome = args.genome
     threads = args.threads
-    
-    remove_human(pipeline, genome, threads)
+    compress = args.compress
+    batch_size = args.batch_size
+    concurrent = args.concurrent
+    prefilter = args.prefilter
+    min_hits = args.min_hits
+
+    if args.samples is not None:
+        remove_human_batch(pipeline, args.samples.split(','), genome, threads, concurrent, compress, prefilter, min_hits)
+    else:
+        remove_human(pipeline, genome, threads, compress=compress, batch_size=batch_size, concurrent=concurrent,
+                     prefilter=prefilter, min_hits=min_hits)
 
 if __name__=='__main__':
-    parse_args()
\ No newline at end of file
+    parse_args()
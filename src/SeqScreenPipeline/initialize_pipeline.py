@@ -29,6 +29,7 @@ def initialize(output:str, name:str):
     removed_human_folder = os.path.join(output_folder, 'removed-human')
     fasta_folder = os.path.join(output_folder, 'fasta')
     fasta_split_folder = os.path.join(output_folder, 'fasta-split')
+    fasta_dedup_folder = os.path.join(output_folder, 'fasta-dedup')
     seqscreen_folder = os.path.join(output_folder, 'seqscreen')
     taxonkit_folder = os.path.join(output_folder, 'taxonkit')
     processing_folder = os.path.join(output_folder, 'output')
@@ -43,6 +44,7 @@ def initialize(output:str, name:str):
     mkdir_p(seqscreen_folder)
     mkdir_p(fasta_folder)
     mkdir_p(fasta_split_folder)
+    mkdir_p(fasta_dedup_folder)
     mkdir_p(taxonkit_folder)
     mkdir_p(processing_folder)
     mkdir_p(unmapped_folder)
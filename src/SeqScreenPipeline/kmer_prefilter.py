@@ -0,0 +1,303 @@
+"""
+Bloom filter of human genome k-mer minimizers used to skip bowtie2 for reads that
+are clearly not human (see human_read_removal.py --prefilter)
+"""
+import argparse
+import os
+import json
+import shutil
+import subprocess
+import tempfile
+from itertools import islice
+import numpy as np
+from compression import open_file, tmp_path
+
+CHUNK_SIZE = 50_000_000
+INVALID = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+## A/C/G/T -> 0-3, anything else -> 4
+ENCODING = np.full(256, 4, dtype=np.uint8)
+for base, code in zip(b'ACGT', range(4)):
+    ENCODING[base] = code
+    ENCODING[ord(chr(base).lower())] = code
+
+
+def mix64(values):
+    '''murmur3 finalizer, used to hash k-mers (uint64 arithmetic wraps around)'''
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ (values >> np.uint64(33))
+
+
+def encode(seq:bytes):
+    '''Encodes sequence bytes as 2-bit codes (4 for N/other)'''
+    return ENCODING[np.frombuffer(seq, dtype=np.uint8)]
+
+
+def kmer_hashes(codes, k:int):
+    """Hashes of the canonical k-mer starting at every position
+
+    Args:
+        codes (np.ndarray): encoded sequence
+        k (int): k-mer size (at most 31)
+
+    Returns:
+        np.ndarray: uint64 hash per k-mer start, INVALID where the k-mer contains an N
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    values = codes.astype(np.uint64)
+    forward = np.zeros(n, dtype=np.uint64)
+    reverse = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        window = values[j:j + n] & np.uint64(3)
+        forward |= window << np.uint64(2 * (k - 1 - j))
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * j)
+    hashes = mix64(np.minimum(forward, reverse))
+
+    ambiguous = np.concatenate(([0], np.cumsum(codes == 4)))
+    hashes[(ambiguous[k:] - ambiguous[:n]) > 0] = INVALID
+    return hashes
+
+
+def minimizers(hashes, w:int):
+    '''Unique window minima of k-mer hashes (window of w k-mers)'''
+    if len(hashes) < w:
+        ## a read shorter than one window has the minimum of all its k-mers (INVALID only if all are)
+        window_min = hashes.min(keepdims=True) if len(hashes) else hashes
+    else:
+        window_min = np.lib.stride_tricks.sliding_window_view(hashes, w).min(axis=1)
+    window_min = np.unique(window_min)
+    return window_min[window_min != INVALID]
+
+
+def bloom_indices(hashes, num_hashes:int, size:int):
+    '''Bit positions of hashes (double hashing), shape (num_hashes, len(hashes))'''
+    second = mix64(hashes ^ np.uint64(0x9e3779b97f4a7c15)) | np.uint64(1)
+    steps = np.arange(num_hashes, dtype=np.uint64)[:, None]
+    return (hashes[None, :] + steps * second[None, :]) % np.uint64(size)
+
+
+def read_fasta_sequences(fasta:str):
+    '''Yields (id, sequence bytes) for each record of a (possibly .gz) fasta'''
+    name = None
+    seq = bytearray()
+    with open_file(fasta, 'rb', threads=4) as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                if name is not None:
+                    yield name, bytes(seq)
+                name = line[1:].split()[0].decode()
+                seq = bytearray()
+            else:
+                seq += line.rstrip()
+    if name is not None:
+        yield name, bytes(seq)
+
+
+def genome_length(fasta:str):
+    '''Total sequence length of a (possibly .gz) fasta'''
+    length = 0
+    with open_file(fasta, 'rb', threads=4) as handle:
+        for line in handle:
+            if not line.startswith(b'>'):
+                length += len(line.rstrip())
+    return length
+
+
+def build_filter(reference:str, prefix:str, k:int=25, w:int=8, bits_per_kmer:int=16, num_hashes:int=7):
+    """Builds the human k-mer Bloom filter of reference minimizers into [prefix].bloom and [prefix].bloom.json
+
+    Args:
+        reference (str): human reference genome fasta (e.g. GRCh38_noalt_as.fna)
+        prefix (str): output prefix
+        k (int, optional): k-mer size (at most 31). Defaults to 25.
+        w (int, optional): minimizer window. Defaults to 8.
+        bits_per_kmer (int, optional): Bloom filter bits per expected minimizer. Defaults to 16.
+        num_hashes (int, optional): number of Bloom filter hash functions. Defaults to 7.
+    """
+    if k > 31:
+        raise ValueError('k must be at most 31')
+
+    expected = int(genome_length(reference) * 2 / (w + 1)) + 1
+    size = (expected * bits_per_kmer + 7) // 8 * 8
+    print(f'Building bloom filter with {size} bits for ~{expected} minimizers')
+
+    bits = np.memmap(tmp_path(f'{prefix}.bloom'), dtype=np.uint8, mode='w+', shape=(size // 8,))
+    inserted = 0
+    for name, seq in read_fasta_sequences(reference):
+        for start in range(0, len(seq), CHUNK_SIZE):
+            codes = encode(seq[start:start + CHUNK_SIZE + k - 1])
+            values = minimizers(kmer_hashes(codes, k), w)
+            indices = bloom_indices(values, num_hashes, size).ravel()
+            np.bitwise_or.at(bits, indices >> np.uint64(3), np.left_shift(1, indices & np.uint64(7)).astype(np.uint8))
+            inserted += len(values)
+        print(f'{name}: {inserted} minimizers inserted')
+
+    bits.flush()
+    del bits
+    os.replace(tmp_path(f'{prefix}.bloom'), f'{prefix}.bloom')
+
+    params = {'k': k, 'w': w, 'size': size, 'num_hashes': num_hashes, 'inserted': inserted}
+    with open(f'{prefix}.bloom.json', 'w') as handle:
+        json.dump(params, handle)
+
+
+class KmerFilter:
+    '''Read-only human k-mer Bloom filter, memory mapped so processes on a node share its pages'''
+    def __init__(self, prefix:str):
+        with open(f'{prefix}.bloom.json', 'r') as handle:
+            params = json.load(handle)
+        self.k = params['k']
+        self.size = params['size']
+        self.num_hashes = params['num_hashes']
+        self.bits = np.memmap(f'{prefix}.bloom', dtype=np.uint8, mode='r')
+
+    def contains(self, hashes):
+        '''Bloom filter membership for each hash'''
+        found = np.ones(len(hashes), dtype=bool)
+        for indices in bloom_indices(hashes, self.num_hashes, self.size):
+            found &= ((self.bits[indices >> np.uint64(3)] >> (indices & np.uint64(7)).astype(np.uint8)) & 1).astype(bool)
+        return found
+
+    def read_hits(self, seqs:list):
+        """Number of k-mers of each read found in the filter
+
+        Args:
+            seqs (list): read sequences (bytes or str, trailing newline allowed)
+
+        Returns:
+            np.ndarray: hits per read
+        """
+        seqs = [seq.rstrip() if isinstance(seq, bytes) else seq.rstrip().encode() for seq in seqs]
+        if not seqs:
+            return np.zeros(0, dtype=np.int64)
+        ## reads are joined by N so no k-mer spans two reads
+        codes = encode(b'N'.join(seqs))
+        hashes = kmer_hashes(codes, self.k)
+        valid = np.nonzero(hashes != INVALID)[0]
+        found = valid[self.contains(hashes[valid])]
+
+        lengths = np.array([len(seq) + 1 for seq in seqs])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        read_index = np.searchsorted(starts, found, side='right') - 1
+        return np.bincount(read_index, minlength=len(seqs))
+
+
+def split_candidates(r1:str, r2:str, kmer_filter:KmerFilter, candidates:tuple, keep:tuple, min_hits:int=1):
+    """Splits read pairs into human candidates (either mate has min_hits k-mer hits) and the rest
+
+    Args:
+        r1 (str): mate 1 fastq
+        r2 (str): mate 2 fastq
+        kmer_filter (KmerFilter): human k-mer filter
+        candidates (tuple): fastq outputs (mate 1, mate 2) for pairs that need alignment
+        keep (tuple): fastq outputs (mate 1, mate 2) for pairs that skip alignment
+        min_hits (int, optional): minimum human k-mer hits to be a candidate. Defaults to 1.
+
+    Returns:
+        (int, int): number of candidate pairs, number of skipped pairs
+    """
+    num_candidates = 0
+    num_kept = 0
+    with open_file(r1, 'r', threads=2) as handle1, open_file(r2, 'r', threads=2) as handle2, \
+         open_file(candidates[0], 'w', threads=2) as cand1, open_file(candidates[1], 'w', threads=2) as cand2, \
+         open_file(keep[0], 'w', threads=2) as keep1, open_file(keep[1], 'w', threads=2) as keep2:
+        for lines1 in iter(lambda: list(islice(handle1, 400000)), []):
+            lines2 = list(islice(handle2, len(lines1)))
+            hits = np.maximum(kmer_filter.read_hits(lines1[1::4]), kmer_filter.read_hits(lines2[1::4]))
+            human = hits >= min_hits
+            for i, is_candidate in enumerate(human):
+                record1 = ''.join(lines1[4 * i:4 * i + 4])
+                record2 = ''.join(lines2[4 * i:4 * i + 4])
+                if is_candidate:
+                    cand1.write(record1)
+                    cand2.write(record2)
+                else:
+                    keep1.write(record1)
+                    keep2.write(record2)
+            num_candidates += int(human.sum())
+            num_kept += int(len(human) - human.sum())
+    return num_candidates, num_kept
+
+
+def read_ids(fastq:str):
+    '''Set of read ids (without /1 /2 suffix) in a fastq'''
+    ids = set()
+    with open_file(fastq, 'r', threads=2) as handle:
+        for i, line in enumerate(handle):
+            if i % 4 == 0:
+                read_id = line[1:].split()[0]
+                ids.add(read_id[:-2] if read_id[-2:] in ('/1', '/2') else read_id)
+    return ids
+
+
+def evaluate(r1:str, r2:str, genome:str, prefix:str, min_hits:int=1, threads:int=1):
+    """Reports the fraction of pairs bowtie2 aligns concordantly that the prefilter sends to bowtie2
+
+    Args:
+        r1 (str): mate 1 fastq
+        r2 (str): mate 2 fastq
+        genome (str): bowtie2 index
+        prefix (str): k-mer filter prefix
+        min_hits (int, optional): minimum human k-mer hits to be a candidate. Defaults to 1.
+        threads (int, optional): bowtie2 threads. Defaults to 1.
+    """
+    work = tempfile.mkdtemp(prefix='kmer_prefilter_')
+    try:
+        subprocess.run(['bowtie2', '--mm', '-p', str(threads), '-x', genome, '-1', r1, '-2', r2,
+                        '--al-conc', os.path.join(work, 'al.%.fastq'), '-S', os.devnull],
+                       check=True, stderr=subprocess.DEVNULL)
+        human = read_ids(os.path.join(work, 'al.1.fastq'))
+
+        candidates = (os.path.join(work, 'cand1.fastq'), os.path.join(work, 'cand2.fastq'))
+        keep = (os.path.join(work, 'keep1.fastq'), os.path.join(work, 'keep2.fastq'))
+        num_candidates, num_kept = split_candidates(r1, r2, KmerFilter(prefix), candidates, keep, min_hits)
+        candidate_ids = read_ids(candidates[0])
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    total = num_candidates + num_kept
+    detected = len(human & candidate_ids)
+    sensitivity = detected / len(human) if human else 1.0
+    print(f'Pairs: {total}')
+    print(f'Human pairs (bowtie2): {len(human)}')
+    print(f'Prefilter candidates: {num_candidates} ({round(num_candidates / total * 100, 2) if total else 0}% of pairs aligned)')
+    print(f'Human pairs missed by prefilter: {len(human) - detected}')
+    print(f'Sensitivity: {round(sensitivity * 100, 4)}%')
+    return sensitivity
+
+
+def parse_args():
+    """Parses arguments for building / evaluating the filter
+    """
+    parser = argparse.ArgumentParser(description='Builds or evaluates the human k-mer prefilter for human read removal')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Build the filter from the human reference fasta')
+    build.add_argument('reference', type=str, help='Human reference genome fasta')
+    build.add_argument('prefix', type=str, help='Output prefix ([prefix].bloom, [prefix].bloom.json)')
+    build.add_argument('-k', type=int, default=25, help='k-mer size (max 31)')
+    build.add_argument('-w', type=int, default=8, help='Minimizer window')
+    build.add_argument('--bits-per-kmer', type=int, default=16, help='Bloom filter bits per minimizer')
+    build.add_argument('--num-hashes', type=int, default=7, help='Bloom filter hash functions')
+
+    test = subparsers.add_parser('evaluate', help='Report sensitivity against bowtie2 alone on a test sample')
+    test.add_argument('r1', type=str, help='Mate 1 fastq')
+    test.add_argument('r2', type=str, help='Mate 2 fastq')
+    test.add_argument('genome', type=str, help='Location of bowtie indexes')
+    test.add_argument('prefix', type=str, help='Filter prefix')
+    test.add_argument('--min-hits', type=int, default=1, help='Minimum human k-mer hits to align a pair')
+    test.add_argument('-t', '--threads', type=int, default=1, help='Number of bowtie2 threads')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_filter(args.reference, args.prefix, args.k, args.w, args.bits_per_kmer, args.num_hashes)
+    else:
+        evaluate(args.r1, args.r2, args.genome, args.prefix, args.min_hits, args.threads)
+
+if __name__=='__main__':
+    parse_args()
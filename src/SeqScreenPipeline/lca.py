@@ -3,8 +3,8 @@
 import argparse
 import os
 import pandas as pd
-import subprocess
 import glob
+from taxonomy_service import connect_taxonomy
 
 
 def get_taxa(taxid, centrifuge, centrifuge_lca, diamond, diamond_lca):
@@ -28,7 +28,7 @@ def run_lca(pipeline:str, database:str, sensitive:bool, split_files:bool=False):
 
     Args:
         pipeline (str): pipeline file locations
-        database (str): database for taxonkit
+        database (str): taxonkit data directory (compiled once with taxonomy.py)
         sensitive (bool): process sensitive output instead 
         split_files (bool): processes merged split files instead
     """
@@ -49,43 +49,16 @@ def run_lca(pipeline:str, database:str, sensitive:bool, split_files:bool=False):
     reports = [report for report in reports if '5015U-29-06-viromeT_S2_L001' not in report]
     reports = [report for report in reports if '4397U-29-06-viromeT_S4_L001' not in report]
     
+    taxonomy = connect_taxonomy(database)
     for i, report in enumerate(reports):
         print(f'[{i+1}] {report}')
         out_name = os.path.join(taxonkit_dir, report.split('/')[-1])
 
         if not os.path.exists(out_name):
-            out_name_centrifuge = report.split("/")[-1].split('.tsv')[0] + "_centrifuge.tsv"
-            out_name_diamond = report.split("/")[-1].split('.tsv')[0] + "_diamond.tsv"
-            
-            centrifuge_output = os.path.join(taxonkit_dir, out_name_centrifuge)
-            diamond_output = os.path.join(taxonkit_dir, out_name_diamond)
-            
-            if not os.path.exists(centrifuge_output):
-                subprocess.run([
-                    'taxonkit', 'lca',
-                    report,
-                    '-i', '4',
-                    '--data-dir', database,
-                    '-o', centrifuge_output,
-                    '-s', ','
-                ], check=True, stdout=subprocess.DEVNULL)
-                
-            if not os.path.exists(diamond_output):
-                subprocess.run([
-                    'taxonkit', 'lca',
-                    report,
-                    '-i', '5',
-                    '--data-dir', database,
-                    '-o', diamond_output,
-                    '-s', ','
-                ], check=True, stdout=subprocess.DEVNULL)
-                
-            initial_file = pd.read_csv(report, delimiter='\t')
-            centrifuge_out = pd.read_csv(centrifuge_output, delimiter='\t', header=None)
-            diamond_out = pd.read_csv(diamond_output, delimiter='\t', header=None)
-            
-            merged_df = initial_file.merge(centrifuge_out[[1,45]], left_on='query', right_on=1, how='left').merge(diamond_out[[1,45]], left_on='query', right_on=1, how='left')
-            merged_df['final_taxid'] = merged_df.apply(lambda x: get_taxa(x['taxid'], x['centrifuge_multi_tax'], x['45_x'], x['diamond_multi_tax'], x['45_y']), axis=1)
+            merged_df = pd.read_csv(report, delimiter='\t')
+            merged_df['centrifuge_lca'] = taxonomy.lca_strings(merged_df['centrifuge_multi_tax'])
+            merged_df['diamond_lca'] = taxonomy.lca_strings(merged_df['diamond_multi_tax'])
+            merged_df['final_taxid'] = merged_df.apply(lambda x: get_taxa(x['taxid'], x['centrifuge_multi_tax'], x['centrifuge_lca'], x['diamond_multi_tax'], x['diamond_lca']), axis=1)
 
             merged_df.to_csv(out_name, sep='\t')
 
@@ -1,47 +1,185 @@
 '''Merges split files into singular output files'''
 import argparse
 import os
-import pandas as pd
+import re
 import glob
+import multiprocessing as mp
+from compression import BUFFER_SIZE
 
-def merge_results(pipeline:str, splits:int):
-    '''Takes split output folders and number of splits'''
+## split_fasta.py writes chunks and manifests here (relative to the pipeline directory)
+SPLIT_DIR = os.path.join('fasta-split', 'fasta-split-slow')
+
+
+def read_manifest(manifest_loc:str):
+    '''Reads chunk filenames (in chunk order) from manifest written by split_fasta.py'''
+    chunks = []
+    with open(manifest_loc, 'r') as handle:
+        next(handle)
+        for line in handle:
+            chunk, filename, _ = line.rstrip('\n').split('\t')
+            chunks.append((int(chunk), filename))
+    chunks.sort()
+    if [chunk for chunk, _ in chunks] != list(range(1, len(chunks) + 1)):
+        raise ValueError(f'{manifest_loc} does not list chunks 1 to {len(chunks)}')
+    return [filename for _, filename in chunks]
+
+
+def find_chunks(basename:str, directories:list):
+    '''Chunk fasta names of a sample ([basename]_[i].fasta or .fasta.gz), in chunk order, from the first
+    directory that has any (the split chunks, or the seqscreen folders named after them)'''
+    pattern = re.compile(rf'{re.escape(basename)}_(\d+)\.fasta(\.gz)?')
+    for directory in directories:
+        if not os.path.isdir(directory):
+            continue
+        chunks = [(int(match.group(1)), name) for name in os.listdir(directory)
+                  for match in [pattern.fullmatch(name)] if match]
+        if chunks:
+            return [name for _, name in sorted(chunks)]
+    return []
+
+
+def chunk_reports(seqscreen_split_dir:str, chunk_files:list):
+    '''Gets the seqscreen report location for each chunk fasta (None if it has no report)'''
+    reports = []
+    for chunk_file in chunk_files:
+        found = glob.glob(os.path.join(glob.escape(os.path.join(seqscreen_split_dir, chunk_file)),
+                                       'report_generation', '*_seqscreen_report.tsv'))
+        if len(found) > 1:
+            raise ValueError(f'{chunk_file} has {len(found)} seqscreen reports')
+        reports.append(found[0] if found else None)
+    return reports
+
+
+def concat_reports(reports:list, outname:str):
+    """Streams chunk reports, in order and with a running row index, into one merged report
+
+    Args:
+        reports (list): seqscreen reports in chunk order
+        outname (str): merged report location
+
+    Returns:
+        int: number of rows written
+    """
+    tmp_out = f'{outname}.tmp'
+    header = None
+    row = 0
+    try:
+        with open(tmp_out, 'w', buffering=BUFFER_SIZE) as out:
+            for report in reports:
+                with open(report, 'r', buffering=BUFFER_SIZE) as handle:
+                    report_header = handle.readline()
+                    if header is None:
+                        header = report_header
+                        out.write(f'\t{header}')
+                    elif report_header != header:
+                        raise ValueError(f'Header of {report} does not match first chunk')
+
+                    for lines in iter(lambda: handle.readlines(BUFFER_SIZE), []):
+                        if not lines[-1].endswith('\n'):
+                            lines[-1] += '\n'
+                        out.write(''.join(f'{row + i}\t{line}' for i, line in enumerate(lines)))
+                        row += len(lines)
+    except BaseException:
+        os.remove(tmp_out)
+        raise
+    os.replace(tmp_out, outname)
+    return row
+
+
+def sample_reports(basename:str, splits:int, split_dir:str, seqscreen_split_dir:str):
+    """Chunk reports of a sample, checked against its manifest (or its chunk files if it has none)
+
+    Args:
+        basename (str): sample name
+        splits (int): expected number of chunks
+        split_dir (str): split_fasta.py output directory (chunks and manifests)
+        seqscreen_split_dir (str): seqscreen output directory of the chunks
+
+    Returns:
+        list: report of each chunk in chunk order, empty if the sample was not split
+    """
+    manifest_loc = os.path.join(split_dir, f'{basename}.manifest.tsv')
+    if os.path.exists(manifest_loc):
+        chunk_files = read_manifest(manifest_loc)
+    else:
+        chunk_files = find_chunks(basename, [split_dir, seqscreen_split_dir])
+        if not chunk_files:
+            return []
+
+    if len(chunk_files) != splits:
+        raise ValueError(f'{basename} has {len(chunk_files)} chunks, expected {splits}')
+    reports = chunk_reports(seqscreen_split_dir, chunk_files)
+    missing = [chunk_file for chunk_file, report in zip(chunk_files, reports) if report is None]
+    if missing:
+        raise ValueError(f'{basename} is missing seqscreen reports of {len(missing)}/{len(chunk_files)} chunks: {", ".join(missing)}')
+    return reports
+
+
+def merge_sample(outname:str, reports:list):
+    '''Merges the chunk reports of a single sample'''
+    rows = concat_reports(reports, outname)
+    print(f'Merged {len(reports)} chunks ({rows} reads) into {outname}')
+    return outname
+
+
+def merge_results(pipeline:str, splits:int, split_dir:str=None, processes:int=1):
+    """Takes split output folders and number of splits
+
+    Args:
+        pipeline (str): pipeline directory
+        splits (int): number of chunks of every split sample
+        split_dir (str, optional): split_fasta.py chunks and manifests. Defaults to [pipeline]/SPLIT_DIR.
+        processes (int, optional): number of samples merged in parallel. Defaults to 1.
+    """
     fasta_dir = os.path.join(pipeline, 'fasta')
     seqscreen_split_dir = os.path.join(pipeline, 'seqscreen', 'fast')
     output_dir = os.path.join(pipeline, 'seqscreen', 'final')
-    
-    count = 0
-    
-    for i, file in enumerate(os.listdir(fasta_dir)):
+    if split_dir is None:
+        split_dir = os.path.join(pipeline, SPLIT_DIR)
+
+    jobs = []
+    errors = []
+    for file in sorted(os.listdir(fasta_dir)):
         basename = file.split('.fasta')[0]
-        search = os.path.join(seqscreen_split_dir, basename)
-        output_files = glob.glob(f'{search}*/report_generation/*_seqscreen_report.tsv')
-        if len(output_files) == splits:
-            outname = os.path.join(output_dir, f'{basename}.tsv')
-            if not os.path.exists(outname):
-                output_df = pd.DataFrame()
-                count += 1
-                print(f'[{count}] {file}')
-                for report in output_files:
-                    df = pd.read_csv(report, delimiter='\t')
-                    output_df = pd.concat([output_df, df], ignore_index=True)
-                output_df.to_csv(outname, sep='\t')
-            
+        outname = os.path.join(output_dir, f'{basename}.tsv')
+        if os.path.exists(outname):
+            continue
+        try:
+            reports = sample_reports(basename, splits, split_dir, seqscreen_split_dir)
+        except ValueError as err:
+            errors.append(str(err))
+            continue
+        if reports:
+            jobs.append((outname, reports))
+
+    for i, (outname, _) in enumerate(jobs):
+        print(f'[{i+1}] {outname}')
+
+    with mp.Pool(processes) as pool:
+        pool.starmap(merge_sample, jobs)
+
+    ## complete samples are merged, but none of an incomplete sample is
+    if errors:
+        raise RuntimeError(f'{len(errors)} samples not merged:\n' + '\n'.join(errors))
 
 
 def parse_args():
     '''Parses arguments'''
     parser = argparse.ArgumentParser(
-        description='Bulk processes folder of fastq files into fasta')
+        description='Merges seqscreen reports of split fasta files into one report per sample')
     parser.add_argument('pipeline', type=str, help='pipeline directory containing fastq files')
-    parser.add_argument('splits', type=int, help='Number of splits if consistent')
+    parser.add_argument('splits', type=int, help='Number of chunks each sample was split into')
+    parser.add_argument('--split-dir', type=str, default=None,
+                        help=f'location of split_fasta chunks and manifests (defaults to [pipeline]/{SPLIT_DIR})')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='Number of samples merged in parallel')
 
     args = parser.parse_args()
     pipeline = args.pipeline
     splits = args.splits
+    split_dir = args.split_dir
+    processes = args.processes
 
-    merge_results(pipeline, splits)
+    merge_results(pipeline, splits, split_dir, processes)
 
 if __name__=="__main__":
     parse_args()
-    
\ No newline at end of file
@@ -1,44 +1,82 @@
 """
-Bulk-processes files with multiqc 
+Bulk-processes files with multiqc
 """
 import argparse
 import os
+import glob
+import hashlib
 from slurm import slurm
 
 
+def input_signature(files:list):
+    '''Hash of the names, sizes and modification times of the report inputs'''
+    digest = hashlib.sha256()
+    for file in sorted(files):
+        stat = os.stat(file)
+        digest.update(f'{os.path.basename(file)}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
 
-def multiqc(pipeline:str):
-    """Runs fastqc on the files
+
+def report_changed(multiqc_dir:str, report:str, signature:str):
+    '''True if the report does not exist or was made from different inputs'''
+    signature_loc = os.path.join(multiqc_dir, f'{report}.inputs')
+    if not os.path.exists(os.path.join(multiqc_dir, f'{report}.html')) or not os.path.exists(signature_loc):
+        return True
+    with open(signature_loc, 'r') as handle:
+        return handle.read().strip() != signature
+
+
+def multiqc(pipeline:str, force:bool=False):
+    """Runs multiqc on the fastqc reports of each stage whose inputs (recorded in [report].inputs) changed
 
     Args:
-        pipeline (str): _description_
+        pipeline (str): pipeline directory
+        force (bool, optional): regenerate all reports. Defaults to False.
     """
     fastqc_dir_raw = os.path.join(pipeline, 'fastqc', 'raw')
     fastqc_dir_fastp = os.path.join(pipeline, 'fastqc', 'fastp')
     fastqc_dir_no_human = os.path.join(pipeline, 'fastqc', 'removed-human')
     multiqc_dir = os.path.join(pipeline, 'multiqc')
 
+    reports = [(fastqc_dir_raw, 'raw_data'),
+               (fastqc_dir_fastp, 'fastp_data'),
+               (fastqc_dir_no_human, 'removed_human_data')]
 
     ## process with multiqc
-    command1 = f'multiqc {fastqc_dir_raw}/*fastqc.zip -o {multiqc_dir} -n raw_data'
-    command2 = f'multiqc {fastqc_dir_fastp}/*fastqc.zip -o {multiqc_dir} -n fastp_data'
-    command3 = f'multiqc {fastqc_dir_no_human}/*fastqc.zip -o {multiqc_dir} -n removed_human_data'
-    name = pipeline.split('/')[-1]
-    slurm([command1, command2, command3], f'{name}_multiqc', hours=1, days=0, memory=4)
+    commands = []
+    for fastqc_dir, report in reports:
+        inputs = glob.glob(f'{fastqc_dir}/*fastqc.zip')
+        if not inputs:
+            print(f'{report}: no fastqc reports in {fastqc_dir}')
+            continue
+        signature = input_signature(inputs)
+        if not force and not report_changed(multiqc_dir, report, signature):
+            print(f'{report}: inputs unchanged, skipping')
+            continue
+        signature_loc = os.path.join(multiqc_dir, f'{report}.inputs')
+        with open(f'{signature_loc}.tmp', 'w') as handle:
+            handle.write(f'{signature}\n')
+        commands.append(f'multiqc -f {fastqc_dir}/*fastqc.zip -o {multiqc_dir} -n {report} && mv {signature_loc}.tmp {signature_loc}')
+
+    if commands:
+        name = pipeline.split('/')[-1]
+        slurm(commands, f'{name}_multiqc', hours=1, days=0, memory=4)
 
 
 
 def parse_args():
-    """Parses arguments for fastqc 
+    """Parses arguments for fastqc
     """
     parser = argparse.ArgumentParser(
         description='Bulk processes folder of fastqc files with multiqc')
     parser.add_argument('pipeline', type=str, help='pipeline directory containing files')
+    parser.add_argument('--force', action='store_true', default=False,
+                        help='Regenerate reports even if their fastqc inputs did not change')
 
     args = parser.parse_args()
     pipeline = args.pipeline
 
-    multiqc(pipeline)
+    multiqc(pipeline, args.force)
 
 if __name__=="__main__":
     parse_args()
@@ -0,0 +1,270 @@
+"""
+Fused per-sample preprocessing: fastp -> bowtie2 human read removal -> fasta,
+streamed through named pipes so no intermediate fastq files are written
+"""
+import argparse
+import os
+import glob
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from slurm import slurm, mkdir_p
+from compression import open_file, tmp_path, is_gzipped, BUFFER_SIZE
+from fasta import fastq_to_fasta
+
+
+def release_fifo(fifo:str):
+    '''Opens and closes both ends of a fifo so a reader or writer blocked on open() gets EOF / a broken pipe'''
+    for flags in (os.O_WRONLY | os.O_NONBLOCK, os.O_RDONLY | os.O_NONBLOCK):
+        try:
+            fd = os.open(fifo, flags)
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def tee_fifo(src:str, dest:str, checkpoint:str):
+    '''Copies src fifo into dest fifo while writing a checkpoint copy'''
+    with open(src, 'rb', buffering=BUFFER_SIZE) as handle, \
+         open(dest, 'wb', buffering=BUFFER_SIZE) as out, \
+         open_file(tmp_path(checkpoint), 'wb', threads=2) as ckpt:
+        for block in iter(lambda: handle.read(BUFFER_SIZE), b''):
+            out.write(block)
+            ckpt.write(block)
+
+
+class Worker(threading.Thread):
+    '''Thread that stores the result or exception of its function'''
+    def __init__(self, function, arguments):
+        super().__init__(daemon=True)
+        self.function = function
+        self.arguments = arguments
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.function(*self.arguments)
+        except Exception as err:
+            self.error = err
+
+
+def wait_pipeline(processes:list, fifos:list, workers:list=()):
+    """Waits for all processes and worker threads of the pipeline, killing the rest if one fails
+
+    Args:
+        processes (list): (name, Popen) pairs
+        fifos (list): fifos to release so blocked readers/writers exit on failure
+        workers (list, optional): started Worker threads reading or writing the fifos. Defaults to ().
+    """
+    failed = None
+    error = None
+    while failed is None and error is None and any(process.poll() is None for _, process in processes):
+        ## a dead worker leaves the process on the other end of its fifo blocked forever
+        error = next((worker.error for worker in workers if worker.error is not None), None)
+        failed = next(((name, process) for name, process in processes if process.poll() not in (None, 0)), None)
+        if failed is None and error is None:
+            time.sleep(1)
+
+    if failed is None and error is None:
+        failed = next(((name, process) for name, process in processes if process.returncode != 0), None)
+
+    for _, process in processes:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+    ## a fifo that was never opened by its writer would leave the reader blocked, and a released
+    ## worker (tee_fifo) can go on to block opening its next fifo, so release until all have exited
+    for fifo in fifos:
+        release_fifo(fifo)
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.join(0.1)
+        for fifo in fifos:
+            release_fifo(fifo)
+
+    if error is None and failed is None:
+        error = next((worker.error for worker in workers if worker.error is not None), None)
+    if error is not None:
+        raise error
+    if failed is not None:
+        name, process = failed
+        raise subprocess.CalledProcessError(process.returncode, name)
+
+
+def parse_bowtie2_log(log:str):
+    '''Gets total and non-concordant pair counts from the bowtie2 alignment summary'''
+    pairs = None
+    unaligned = None
+    with open(log, 'r') as handle:
+        for line in handle:
+            line = line.strip()
+            if line.endswith('reads; of these:'):
+                pairs = int(line.split()[0])
+            elif line.endswith('aligned concordantly 0 times') and unaligned is None:
+                unaligned = int(line.split()[0])
+    return pairs, unaligned
+
+
+def preprocess_sample(pipeline:str, name:str, genome:str, threads:int=1, checkpoint:bool=False, tmp:str=None, compress:bool=False):
+    """Runs fastp, bowtie2 and fasta conversion for one paired sample, streamed through fifos,
+    writing the read counts of every step to output/preprocess/[name]read_counts.tsv
+
+    Args:
+        pipeline (str): pipeline directory
+        name (str): sample name (everything before 1.fastq)
+        genome (str): bowtie2 index of human genome
+        threads (int, optional): number of threads for bowtie2. Defaults to 1.
+        checkpoint (bool, optional): also write intermediate fastq files. Defaults to False.
+        tmp (str, optional): directory for the fifos. Defaults to $TMPDIR.
+        compress (bool, optional): write .gz outputs (always done for .gz inputs). Defaults to False.
+    """
+    fastq_dir = os.path.join(pipeline, 'fastq')
+    fastp_dir = os.path.join(pipeline, 'fastp')
+    removed_human_dir = os.path.join(pipeline, 'removed-human')
+    fasta_dir = os.path.join(pipeline, 'fasta')
+    qc_dir = os.path.join(pipeline, 'output', 'preprocess')
+    mkdir_p(qc_dir)
+
+    fastp_json = os.path.join(qc_dir, f'{name}fastp.json')
+    fastp_html = os.path.join(qc_dir, f'{name}fastp.html')
+    bowtie2_log = os.path.join(qc_dir, f'{name}bowtie2.log')
+    fastq_in = [os.path.join(fastq_dir, f'{name}{mate}.fastq') for mate in (1, 2)]
+    if not os.path.exists(fastq_in[0]):
+        fastq_in = [f'{fastq}.gz' for fastq in fastq_in]
+    gz = '.gz' if compress or is_gzipped(fastq_in[0]) else ''
+    fasta_out = [os.path.join(fasta_dir, f'{name}{mate}.fasta{gz}') for mate in (1, 2)]
+    fastp_ckpt = [os.path.join(fastp_dir, f'{name}{mate}.fastq{gz}') for mate in (1, 2)]
+    human_ckpt = [os.path.join(removed_human_dir, f'{name}{mate}.fastq{gz}') for mate in (1, 2)]
+
+    fifo_dir = tempfile.mkdtemp(prefix=f'{name}preprocess_', dir=tmp)
+    fastp_fifos = [os.path.join(fifo_dir, f'fastp_{mate}.fastq') for mate in (1, 2)]
+    bowtie2_fifos = [os.path.join(fifo_dir, f'bowtie2_in_{mate}.fastq') for mate in (1, 2)] if checkpoint else fastp_fifos
+    unconc_fifos = [os.path.join(fifo_dir, f'unconc_{mate}.fastq') for mate in (1, 2)]
+    fifos = sorted(set(fastp_fifos + bowtie2_fifos + unconc_fifos))
+    for fifo in fifos:
+        os.mkfifo(fifo)
+
+    outputs = fasta_out + (fastp_ckpt + human_ckpt if checkpoint else [])
+    try:
+        workers = []
+        for mate in range(2):
+            if checkpoint:
+                workers.append(Worker(tee_fifo, (fastp_fifos[mate], bowtie2_fifos[mate], fastp_ckpt[mate])))
+            workers.append(Worker(fastq_to_fasta, (unconc_fifos[mate], fasta_out[mate],
+                                                   human_ckpt[mate] if checkpoint else None)))
+        for worker in workers:
+            worker.start()
+
+        fastp_command = ['fastp',
+                         '-i', fastq_in[0],
+                         '-I', fastq_in[1],
+                         '-o', fastp_fifos[0],
+                         '-O', fastp_fifos[1],
+                         '-l', '50', '-y', '-3', '-W', '4', '-M', '20', '-x',
+                         '--thread', '5',
+                         '-j', fastp_json,
+                         '-h', fastp_html]
+        bowtie2_command = ['bowtie2',
+                           '-p', str(threads),
+                           '-x', genome,
+                           '-1', bowtie2_fifos[0],
+                           '-2', bowtie2_fifos[1],
+                           '--un-conc', os.path.join(fifo_dir, 'unconc_%.fastq'),
+                           '-S', os.devnull]
+
+        with open(os.path.join(fifo_dir, 'fastp.log'), 'w') as fastp_err, open(bowtie2_log, 'w') as bowtie2_err:
+            processes = [('fastp', subprocess.Popen(fastp_command, stdout=subprocess.DEVNULL, stderr=fastp_err)),
+                         ('bowtie2', subprocess.Popen(bowtie2_command, stdout=subprocess.DEVNULL, stderr=bowtie2_err))]
+            wait_pipeline(processes, fifos, workers)
+
+        ## pipeline succeeded, move outputs into place
+        for output in outputs:
+            os.replace(tmp_path(output), output)
+    except BaseException:
+        for output in outputs:
+            if os.path.exists(tmp_path(output)):
+                os.remove(tmp_path(output))
+        raise
+    finally:
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+
+    with open(fastp_json, 'r') as handle:
+        fastp_summary = json.load(handle)['summary']
+    pairs, unaligned = parse_bowtie2_log(bowtie2_log)
+    fasta_reads = [worker.result for worker in workers if worker.function is fastq_to_fasta]
+
+    counts = [('raw', fastp_summary['before_filtering']['total_reads']),
+              ('fastp', fastp_summary['after_filtering']['total_reads']),
+              ('bowtie2_input', pairs * 2 if pairs is not None else 'NA'),
+              ('removed_human', unaligned * 2 if unaligned is not None else 'NA'),
+              ('fasta_r1', fasta_reads[0]),
+              ('fasta_r2', fasta_reads[1])]
+    with open(os.path.join(qc_dir, f'{name}read_counts.tsv'), 'w') as handle:
+        handle.write('step\treads\n')
+        for step, reads in counts:
+            handle.write(f'{step}\t{reads}\n')
+    print(f'{name}: ' + ', '.join(f'{step}={reads}' for step, reads in counts))
+
+
+def preprocess(pipeline:str, genome:str, threads:int=1, checkpoint:bool=False, compress:bool=False):
+    """Submits one fused preprocessing job per paired sample in the fastq folder
+
+    Args:
+        pipeline (str): pipeline directory
+        genome (str): bowtie2 index of human genome
+        threads (int, optional): number of threads. Defaults to 1.
+        checkpoint (bool, optional): also write intermediate fastq files. Defaults to False.
+        compress (bool, optional): write .gz outputs (always done for .gz inputs). Defaults to False.
+    """
+    fastq_dir = os.path.join(pipeline, 'fastq')
+    fasta_dir = os.path.join(pipeline, 'fasta')
+
+    input_files = sorted(glob.glob(f'{fastq_dir}/*1.fastq') + glob.glob(f'{fastq_dir}/*1.fastq.gz'))
+    for i, file in enumerate(input_files):
+        name = file.split('/')[-1].split('1.fastq')[0]
+        gz = '.gz' if compress or is_gzipped(file) else ''
+        out_r1 = os.path.join(fasta_dir, f'{name}1.fasta{gz}')
+        out_r2 = os.path.join(fasta_dir, f'{name}2.fasta{gz}')
+        if not (os.path.exists(out_r1) and os.path.exists(out_r2)):
+            command = f'python preprocess.py {pipeline} {genome} --sample {name} -t {threads}'
+            if checkpoint:
+                command += ' --checkpoint'
+            if compress:
+                command += ' --compress'
+            print(f'[{i+1}] {command}')
+            slurm([command], f'{name}_preprocess', hours=2, days=0, memory=12, threads_per_task=threads + 5)
+
+
+def parse_args():
+    '''
+    Parses arguments for command line function
+    '''
+    parser = argparse.ArgumentParser(description='Runs fastp, human read removal and fasta conversion in one streamed job per sample')
+    parser.add_argument('pipeline', type=str, help="location of pipeline files")
+    parser.add_argument('genome', type=str, help="Location of bowtie indexes (note: probably in form GRCh38_noalt_as/GRCh38_noalt_as)")
+    parser.add_argument('-t', '--threads', type=int, default=1, help="Number of threads for bowtie2")
+    parser.add_argument('--checkpoint', action='store_true', default=False,
+                        help='Also write fastp and removed-human fastq files')
+    parser.add_argument('--sample', type=str, default=None,
+                        help='Run a single sample (name before 1.fastq) in this process instead of submitting jobs')
+    parser.add_argument('--tmp', type=str, default=None, help='Directory for named pipes (defaults to $TMPDIR)')
+    parser.add_argument('--compress', action='store_true', default=False, help='Write .gz outputs (always done for .gz inputs)')
+
+    args = parser.parse_args()
+    pipeline = args.pipeline
+    genome = args.genome
+    threads = args.threads
+    checkpoint = args.checkpoint
+    compress = args.compress
+
+    if args.sample is not None:
+        preprocess_sample(pipeline, args.sample, genome, threads, checkpoint, args.tmp, compress)
+    else:
+        preprocess(pipeline, genome, threads, checkpoint, compress)
+
+if __name__=='__main__':
+    parse_args()
@@ -4,7 +4,7 @@ import argparse
 
 from slurm import slurm
 
-def reference_inference(pipeline=str, database=str, threads=int):
+def reference_inference(pipeline=str, database=str, threads=int, reference_library=None, ncbi_cache=None, screen_fraction=None):
     full_fasta_files = os.path.join(pipeline, 'fastp')
     seqscreen_reports = os.path.join(pipeline, 'seqscreen', 'final')
     
@@ -19,6 +19,12 @@ def reference_inference(pipeline=str, database=str, threads=int):
         if not os.path.exists(working_dir):
             os.mkdir(working_dir)
         command = f'python seqscreen_reference_inference.py --fasta1 {fasta_path} -o {report_path} -w {working_dir} -d {database} --threads {threads} --online'
+        if reference_library is not None:
+            command += f' --reference-library {reference_library}'
+        if ncbi_cache is not None:
+            command += f' --ncbi-cache {ncbi_cache}'
+        if screen_fraction is not None:
+            command += f' --screen-fraction {screen_fraction}'
         #print(command)
         slurm([command], f'{sample_name}_ref_inf', hours=6, memory=100, days = 0, threads_per_task=threads)
 
@@ -28,13 +34,19 @@ def parse_args():
     parser.add_argument('pipeline', type=str, help="location of pipeline files")
     parser.add_argument('db', type=str, help="Seqscreen Database Location")
     parser.add_argument('-t', '--threads', type=int, help="Number of threads")
+    parser.add_argument('--reference-library', type=str, default=None,
+                        help="Shared directory of indexed reference genomes, built once and linked into every sample")
+    parser.add_argument('--ncbi-cache', type=str, default=None,
+                        help="Shared directory caching NCBI datasets summaries and genome downloads by taxid")
+    parser.add_argument('--screen-fraction', type=float, default=None,
+                        help="Screen candidates with this fraction of the reads before aligning all reads")
     
     args = parser.parse_args()
     pipeline = args.pipeline
     database = args.db
     threads = args.threads
     
-    reference_inference(pipeline, database, threads)
+    reference_inference(pipeline, database, threads, args.reference_library, args.ncbi_cache, args.screen_fraction)
     
     
     
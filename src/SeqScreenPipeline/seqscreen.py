@@ -26,7 +26,7 @@ def remove_tmp_directory(current_path:str, filename:str):
     os.chdir(current_path)
     shutil.rmtree(os.path.join(current_path, f'tmp-{filename}'))
 
-def run_seqscreen(pipeline:str, database:str, threads:int=1, sensitive:bool=True, local_launch:bool=False, one_job:bool=False, sep_directories:bool=False, split=False):
+def run_seqscreen(pipeline:str, database:str, threads:int=1, sensitive:bool=True, local_launch:bool=False, one_job:bool=False, sep_directories:bool=False, split=False, dedup=False):
     """Runs seqscreen on series of files
 
     Args:
@@ -34,9 +34,12 @@ def run_seqscreen(pipeline:str, database:str, threads:int=1, sensitive:bool=True
         database (str): database for seqscreen
         threads (int, optional): Number of threads. Defaults to 1.
         sensitive (bool, optional): Use seqscreen sensitive mode. Defaults to True.
+        dedup (bool, optional): Use deduplicated fasta files from dedup.py. Defaults to False.
     """
     if split:
         fasta_dir = os.path.join(pipeline, 'fasta-split') ##NOTE will need to be changed back after slow samples processed
+    elif dedup:
+        fasta_dir = os.path.join(pipeline, 'fasta-dedup')
     else:
         fasta_dir = os.path.join(pipeline, 'fasta')
         
@@ -46,7 +49,7 @@ def run_seqscreen(pipeline:str, database:str, threads:int=1, sensitive:bool=True
         seqscreen_dir = os.path.join(pipeline, 'seqscreen', 'fast') ##NOTE same as above
 
     fasta_files = os.listdir(fasta_dir)
-    fasta_files = sorted([file for file in fasta_files if 'Pntc' not in file]) ## filter any weird nextflow files that may pop up
+    fasta_files = sorted([file for file in fasta_files if 'Pntc' not in file and (file.endswith('.fasta') or file.endswith('.fasta.gz'))]) ## filter any weird nextflow files that may pop up
     
     #fasta_files = [file for file in fasta_files if file.split('2303_P')[-1].split('-')[0].isnumeric() and int(file.split('2303_P')[-1].split('-')[0]) >= 50] ## testing purposes../
     #fasta_files = [file for file in fasta_files if ('mock' in file and '_1' in file)]
@@ -180,9 +183,15 @@ def parse_args():
                         action='store_true',
                         default=False,
                         help='Run seqscreen on split fasta files rather than complete')
+    parser.add_argument('--dedup',
+                        action='store_true',
+                        default=False,
+                        help='Run seqscreen on deduplicated fasta files (fasta-dedup)')
     
 
     args = parser.parse_args()
+    if args.split_input and args.dedup:
+        parser.error('--split-input and --dedup cannot be combined (split_fasta.py splits fasta, not fasta-dedup)')
     pipeline = args.pipeline
     database = args.db
     threads = args.threads
@@ -191,8 +200,9 @@ def parse_args():
     one_job = args.one_job
     sep_dir = args.sep_dir
     split = args.split_input
+    dedup = args.dedup
 
-    run_seqscreen(pipeline, database, threads, sensitive, launch_mode, one_job, sep_dir, split)
+    run_seqscreen(pipeline, database, threads, sensitive, launch_mode, one_job, sep_dir, split, dedup)
 
 
 if __name__=="__main__":
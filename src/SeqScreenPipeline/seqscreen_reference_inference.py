@@ -3,16 +3,26 @@ import argparse
 import sys
 import subprocess
 import math
+import fcntl
+import hashlib
+import mmap
+import time
+import shutil
 import pickle
 import warnings
 from collections import defaultdict
 import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 import pandas as pd
-from ete3 import NCBITaxa
 from Bio import SeqIO
+from taxonomy import load_taxonomy
+from compression import CACHE_DIR, writable_dir, cache_name
+
+DATASETS = os.environ.get('DATASETS', 'datasets')
 
 def run_datasets_summary(taxid, flags, assembly_level='complete_genome'):
-    args = ['datasets', 'summary', 
+    args = [DATASETS, 'summary', 
             'genome',
             'taxon', str(taxid),
             '--assembly-level', assembly_level,
@@ -28,7 +38,7 @@ def run_datasets_summary(taxid, flags, assembly_level='complete_genome'):
     return json.loads(grepOut.stdout.strip())
 
 def run_datasets_download(taxid, assembly_accession, working_dir):
-    grepOut  = subprocess.run(['datasets', 'download', 
+    grepOut  = subprocess.run([DATASETS, 'download', 
                                'genome',
                                'accession', str(assembly_accession),
                                '--exclude-genomic-cds',
@@ -50,11 +60,10 @@ def cut_text(text, text_length):
     except TypeError:
         return "".ljust(text_length)
 
-def download_reference_genome(taxid, working_dir):
+def resolve_reference_genome(taxid):
+    '''runs the datasets summary cascade for a taxid, returns the summary and if it is a reference genome'''
     # check reference and representative genomes first
     #source = 'RefSeq'
-    assembly_accession = None
-    res =None
     representative = True # assembly_category
     assembly_level = 'complete'
     
@@ -84,7 +93,11 @@ def download_reference_genome(taxid, working_dir):
     if res['total_count'] == 0:
         assembly_level='scaffold'
         res = run_datasets_summary(taxid, [], assembly_level)
-        
+
+    return res, representative
+
+def summary_metadata(taxid, res, representative):
+    '''taxid, accession, source, representative, assembly level, organism and strain of a summary'''
     if res['total_count'] == 1:
         assembly_accession = res['assemblies'][0]['assembly']['assembly_accession']
         try:
@@ -99,24 +112,90 @@ def download_reference_genome(taxid, working_dir):
             strain = None
 
         #print(str(taxid).ljust(10), '\t', assembly_accession, '\t', cut_text(organism, 30), '\t', cut_text(strain, 10), '\t', assembly_level_ret)
-        
+        return taxid, assembly_accession, source, representative, assembly_level_ret, organism, strain
+
+    print(str(taxid).ljust(10), '\t', 'Genome Not Found.')
+    return taxid, None, None, None, None, None, None
+
+def download_reference_genome(taxid, working_dir):
+    res, representative = resolve_reference_genome(taxid)
+    metadata = summary_metadata(taxid, res, representative)
+    assembly_accession = metadata[1]
+
+    if assembly_accession is not None:
         return_code = run_datasets_download(taxid, assembly_accession, working_dir)
         if not return_code:
             download_completed = True
         else:
             download_completed = False
-            
     else:
-        print(str(taxid).ljust(10), '\t', 'Genome Not Found.')
-        assembly_accession = None
-        source = None
-        representative = None
-        assembly_level_ret = None
-        organism = None
-        strain = None
         download_completed = False
         
-    return taxid, assembly_accession, source, representative, assembly_level_ret, organism, strain, download_completed
+    return metadata + (download_completed,)
+
+def cached_metadata(metadata_file, negative_days=7):
+    '''cached result of a taxid, None if there is none or it is a negative result (no assembly found or the
+    download failed) older than negative_days, so assemblies published since are picked up'''
+    if not os.path.exists(metadata_file):
+        return None
+    with open(metadata_file, 'r') as handle:
+        result = tuple(json.load(handle))
+    if not result[-1] and time.time() - os.path.getmtime(metadata_file) > negative_days * 86400:
+        return None
+    return result
+
+def acquire_reference_genome(taxid, working_dir, cache_dir=None, retries=3, negative_days=7):
+    '''download_reference_genome with retries, keeping the summary and zip in cache_dir/[taxid]
+    so later samples (or a prepared local mirror of that layout) do not query NCBI again'''
+    if cache_dir is None:
+        for attempt in range(retries):
+            try:
+                return download_reference_genome(taxid, working_dir)
+            except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError) as error:
+                print(f"{taxid}: datasets failed ({error!r}), attempt {attempt + 1} of {retries}")
+                time.sleep(2 ** attempt)
+        return taxid, None, None, None, None, None, None, False
+
+    taxid_cache = os.path.join(cache_dir, str(taxid))
+    metadata_file = os.path.join(taxid_cache, 'metadata.json')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    with open(f"{taxid_cache}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        result = cached_metadata(metadata_file, negative_days)
+        if result is None:
+            tmp_cache = f"{taxid_cache}.tmp"
+            for attempt in range(retries):
+                shutil.rmtree(tmp_cache, ignore_errors=True)
+                os.makedirs(tmp_cache)
+                try:
+                    res, representative = resolve_reference_genome(taxid)
+                    metadata = summary_metadata(taxid, res, representative)
+                    download_completed = False
+                    if metadata[1] is not None:
+                        download_completed = not run_datasets_download(taxid, metadata[1], tmp_cache)
+                    break
+                except (subprocess.CalledProcessError, json.JSONDecodeError, KeyError) as error:
+                    print(f"{taxid}: datasets failed ({error!r}), attempt {attempt + 1} of {retries}")
+                    time.sleep(2 ** attempt)
+            else:
+                shutil.rmtree(tmp_cache, ignore_errors=True)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                return taxid, None, None, None, None, None, None, False
+
+            with open(os.path.join(tmp_cache, 'summary.json'), 'w') as handle:
+                json.dump(res, handle)
+            with open(os.path.join(tmp_cache, 'metadata.json'), 'w') as handle:
+                json.dump(list(metadata) + [download_completed], handle)
+            shutil.rmtree(taxid_cache, ignore_errors=True)
+            os.rename(tmp_cache, taxid_cache)
+            result = tuple(metadata) + (download_completed,)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+    if result[-1]:
+        link_file(os.path.join(taxid_cache, f"{taxid}.zip"), os.path.join(working_dir, f"{taxid}.zip"))
+    # taxids are ints in the rest of the pipeline
+    return (taxid,) + result[1:]
 
 def unpack(working_dir, output_dir):
     subprocess.run(['unzip', '-o', '-q', 
@@ -134,57 +213,97 @@ def cat_reference_genome(reference_metadata, output_dir, reference_genome_path='
         genome_path = os.path.join(output_dir, 'ncbi_dataset', 'data', assembly_id)
         output_fasta = os.path.join(reference_genome_path, f'{assembly_id}.fasta')
 
-        subprocess.Popen(f'cat {genome_path}/*.fna', shell=True, stdout=open(os.path.join(output_fasta), "w"))
-
-def get_species_taxid(taxid, ncbi_taxa_db, valid_kingdom):
-    lineage = ncbi_taxa_db.get_lineage(taxid)
-    if bool(set(lineage) & valid_kingdom):
-        taxid2rank_dict = ncbi_taxa_db.get_rank(lineage)
-        for lineage_taxid in taxid2rank_dict:
-            if taxid2rank_dict[lineage_taxid] == 'species':
-                return lineage_taxid
-    return None
-
-def filter_seqscreen_taxonomy(seqscreen_output, min_frac, ncbi_taxa_db, valid_kingdom):
+        with open(output_fasta, "w") as output_handle:
+            subprocess.run(f'cat {genome_path}/*.fna', shell=True, stdout=output_handle, check=True)
+
+# kingdoms recorded in the species table, bit i of the kingdom mask is KINGDOM_TAXIDS[i]
+# (bacteria, archaea, eukaryota, fungi, viruses, metazoa, viridiplantae)
+KINGDOM_TAXIDS = (2, 2157, 2759, 4751, 10239, 33208, 33090)
+
+def build_species_table(taxonomy, table_prefix):
+    '''compiles dense arrays indexed by taxid from the taxonomy store: the species taxid at or
+    above each taxid (0 if none) and a bitmask of the KINGDOM_TAXIDS in its lineage'''
+    taxids = np.arange(len(taxonomy))
+    species = taxonomy.ancestors_at_rank(taxids, 'species').astype(np.int32)
+
+    kingdom_bits = np.zeros(len(taxonomy), dtype=np.uint8)
+    for bit, kingdom in enumerate(KINGDOM_TAXIDS):
+        if kingdom < len(taxonomy):
+            kingdom_bits[kingdom] |= 1 << bit
+    # merged taxids resolve like the taxid they were merged into
+    current = taxonomy.resolve(taxids)
+    kingdoms = np.zeros(len(taxonomy), dtype=np.uint8)
+    for _ in range(int(taxonomy.depth.max(initial=0)) + 1):
+        kingdoms |= kingdom_bits[current]
+        current = taxonomy.parent[current]
+
+    np.save(f"{table_prefix}.species.tmp.npy", species)
+    np.save(f"{table_prefix}.kingdoms.tmp.npy", kingdoms)
+    for name in ('species', 'kingdoms'):
+        os.replace(f"{table_prefix}.{name}.tmp.npy", f"{table_prefix}.{name}.npy")
+
+def load_species_table(taxonomy, table_prefix=None):
+    '''memory maps the taxid -> species table, building it first (once, under a lock) if it is
+    missing or older than the taxonomy store'''
+    def stale(prefix):
+        return not all(os.path.exists(f"{prefix}.{name}.npy") and
+                       os.path.getmtime(f"{prefix}.{name}.npy") >= os.path.getmtime(taxonomy.store)
+                       for name in ('species', 'kingdoms'))
+    if table_prefix is None:
+        table_prefix = taxonomy.store
+        # a store compiled into a read-only database directory gets its table in the cache
+        table_dir = os.path.dirname(table_prefix)
+        if stale(table_prefix) and writable_dir(table_dir, os.path.join(CACHE_DIR, 'taxonomy')) != table_dir:
+            table_prefix = os.path.join(CACHE_DIR, 'taxonomy', cache_name(taxonomy.store))
+    table_files = [f"{table_prefix}.{name}.npy" for name in ('species', 'kingdoms')]
+    if stale(table_prefix):
+        with open(f"{table_prefix}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if stale(table_prefix):
+                print(f"Building species table {table_prefix}")
+                build_species_table(taxonomy, table_prefix)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    species, kingdoms = [np.load(table_file, mmap_mode='r') for table_file in table_files]
+    return {'species': species, 'kingdoms': kingdoms}
+
+def kingdom_mask(valid_kingdom):
+    mask = 0
+    for kingdom in valid_kingdom:
+        if kingdom not in KINGDOM_TAXIDS:
+            raise ValueError(f"kingdom {kingdom} is not in the species table (KINGDOM_TAXIDS)")
+        mask |= 1 << KINGDOM_TAXIDS.index(kingdom)
+    return mask
+
+def filter_seqscreen_taxonomy(seqscreen_output, min_frac, species_table, valid_kingdom):
     classification_result_df = pd.read_csv(seqscreen_output,
                                            sep='\t', usecols=[0,1,2])
-    
-    classification_result_df['taxid'] = classification_result_df['taxid'].astype(str)
     total_read_count, _ = classification_result_df.shape
     
-    taxid_count_dict = defaultdict(int)
-    taxid_species_lookup = dict()
-    error_count = 0
-    for taxid_list in classification_result_df['taxid'].values:
-        for taxid in taxid_list.split(','):
-            try:
-                taxid = int(taxid)
-                try:
-                    species_taxid = taxid_species_lookup[taxid]
-                except KeyError:
-                    species_taxid = get_species_taxid(taxid, ncbi_taxa_db, valid_kingdom)
-                    taxid_species_lookup[taxid] = species_taxid
-
-                if species_taxid is not None:
-                    taxid_count_dict[species_taxid] += 1
-            except ValueError:
-                error_count += 1
-
-    taxid_queries = []
-    for taxid in taxid_count_dict:
-        if taxid_count_dict[taxid] >= min_frac * total_read_count:
-            taxid_queries.append(taxid)
-            
-    return taxid_queries
+    # one row per (read, taxid), entries that are not taxids are skipped
+    taxids = classification_result_df['taxid'].astype(str).str.split(',').explode()
+    taxids = taxids[taxids.str.fullmatch(r'\s*\d+\s*').fillna(False).astype(bool)].astype(np.int64).to_numpy()
+    taxids = taxids[taxids < len(species_table['species'])]
+    
+    species = np.asarray(species_table['species'][taxids], dtype=np.int64)
+    in_kingdom = (species_table['kingdoms'][taxids] & kingdom_mask(valid_kingdom)) != 0
+    species = species[in_kingdom & (species != 0)]
+    
+    species_count = np.bincount(species)
+    # species in order of first appearance, as before
+    return [int(taxid) for taxid in pd.unique(species) 
+            if species_count[taxid] >= min_frac * total_read_count]
 
-def prepare_reference_genomes(taxid_queries, output_directory, ncbi_taxa_db):
+def prepare_reference_genomes(taxid_queries, output_directory, taxonomy, cache_dir=None, download_threads=4, retries=3,
+                              negative_days=7):
     working_dir = os.path.join(output_directory, 'ncbi_downloads')
     if not os.path.exists(working_dir):
         os.mkdir(working_dir)
         
-    download_result = []
-    for taxid in taxid_queries:
-        download_result.append(download_reference_genome(taxid, working_dir))
+    with ThreadPoolExecutor(max_workers=max(1, download_threads)) as executor:
+        download_result = list(executor.map(lambda taxid: acquire_reference_genome(taxid, working_dir, cache_dir, retries,
+                                                                             negative_days),
+                                            taxid_queries))
         
     unpack(working_dir, output_directory)
     reference_metadata = pd.DataFrame(download_result,
@@ -197,31 +316,28 @@ def prepare_reference_genomes(taxid_queries, output_directory, ncbi_taxa_db):
                                                'Strain',
                                                'Downloaded'])
     
-    taxonomy_name = []
-    for taxid in reference_metadata['Taxonomy ID']:
-        taxonomy_name.append(ncbi_taxa_db.get_taxid_translator([taxid])[taxid])
-    reference_metadata['Species'] = taxonomy_name
+    reference_metadata['Species'] = [taxonomy.name(taxid) for taxid in reference_metadata['Taxonomy ID']]
     
     reference_metadata.to_csv(os.path.join(output_directory, 'reference_metadata.csv'), index=False)
     cat_reference_genome(reference_metadata, output_directory, reference_genome_path=os.path.join(output_directory, 'reference_genomes'))
     
     return reference_metadata
 
-def sort_samfile(assembly_id, output_dir, min_mapq, num_cores):
+def sort_samfile(assembly_id, output_dir, min_mapq, num_cores, exclude_flags=None):
     '''converting and sorting alignment files'''
     bam_files = os.path.join(output_dir, "bam_files")
     sam_files = os.path.join(output_dir, "sam_files")
     
-    if not os.path.exists(bam_files):
-        os.mkdir(bam_files)
+    os.makedirs(bam_files, exist_ok=True)
 
     # covert sam file to binary bam file
     samtools_view_res = subprocess.Popen([
         "samtools",
         "view",
         "-@", str(num_cores),
-        "--min-MQ", str(min_mapq),
-        "-bS", os.path.join(sam_files, f"{assembly_id}.sam")],
+        "--min-MQ", str(min_mapq)] +
+        (["-F", exclude_flags] if exclude_flags is not None else []) +
+        ["-bS", os.path.join(sam_files, f"{assembly_id}.sam")],
         stdout=subprocess.PIPE)
 
     # sort the bam file 
@@ -245,8 +361,7 @@ def sort_samfile(assembly_id, output_dir, min_mapq, num_cores):
 def run_minimap2(input_fasta, reference_file, assembly_id, output_dir, threads=20):
     sam_files = os.path.join(output_dir, "sam_files")
 
-    if not os.path.exists(sam_files):
-        os.mkdir(sam_files)
+    os.makedirs(sam_files, exist_ok=True)
 
     subprocess.run(["minimap2", 
                     "-ax", "map-ont", 
@@ -257,56 +372,389 @@ def run_minimap2(input_fasta, reference_file, assembly_id, output_dir, threads=2
                     "-t", str(threads)],
                     check=True, stdout=open(os.path.join(output_dir, "minimap2.log"), "a"), stderr=open(os.path.join(output_dir, "minimap2.err"), "a"))
 
-def run_bwa(input_fastq_1, input_fastq_2, reference_file, assembly_id, output_dir, threads=20):
-    '''map the reads to the reference'''
+BWA_INDEX_EXTENSIONS = ['.amb', '.ann', '.bwt', '.pac', '.sa']
+
+def file_hash(path):
+    '''sha256 of a file's content (first 16 hex digits)'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(16 * 1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+def link_file(source, destination):
+    '''replaces destination with a hardlink to source (symlink if on another filesystem)'''
+    tmp_destination = f"{destination}.link.tmp"
+    if os.path.lexists(tmp_destination):
+        os.remove(tmp_destination)
+    try:
+        os.link(source, tmp_destination)
+    except OSError:
+        os.symlink(os.path.abspath(source), tmp_destination)
+    os.replace(tmp_destination, destination)
+
+def library_reference(reference_file, assembly_id, library_dir, log=None, err=None):
+    '''indexes the reference once in a shared library keyed by assembly id and sequence hash,
+    then links the fasta, .fai and bwa index files from the library next to reference_file'''
+    entry = os.path.join(library_dir, f"{assembly_id}_{file_hash(reference_file)}")
+    library_fasta = os.path.join(entry, "reference.fasta")
+    complete = os.path.join(entry, "complete")
+
+    if not os.path.exists(complete):
+        os.makedirs(library_dir, exist_ok=True)
+        with open(f"{entry}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another sample may have built it while waiting for the lock
+            if not os.path.exists(complete):
+                tmp_entry = f"{entry}.tmp"
+                shutil.rmtree(tmp_entry, ignore_errors=True)
+                os.makedirs(tmp_entry)
+                tmp_fasta = os.path.join(tmp_entry, "reference.fasta")
+                shutil.copyfile(reference_file, tmp_fasta)
+                subprocess.run(["samtools", "faidx", tmp_fasta], check=True)
+                subprocess.run(["bwa", "index", tmp_fasta], stdout=log, stderr=err, check=True)
+                open(os.path.join(tmp_entry, "complete"), "w").close()
+                shutil.rmtree(entry, ignore_errors=True)
+                os.rename(tmp_entry, entry)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    for ext in [''] + ['.fai'] + BWA_INDEX_EXTENSIONS:
+        link_file(library_fasta + ext, reference_file + ext)
+
+    return entry
+
+def run_bwa(input_fastq_1, input_fastq_2, reference_file, assembly_id, output_dir, threads=20, library=None, all_alignments=False):
+    '''map the reads to the reference (index from the shared library if given, bwa mem -a if all_alignments)'''
     sam_files = os.path.join(output_dir, "sam_files")
+    log_files = os.path.join(output_dir, "logs")
 
-    if not os.path.exists(sam_files):
-        os.mkdir(sam_files)
+    os.makedirs(sam_files, exist_ok=True)
+    os.makedirs(log_files, exist_ok=True)
 
-    subprocess.run(["bwa", "index", reference_file], 
-                    stdout=open(os.path.join(output_dir, "bwa_mem.log"), "a"),
-                    stderr=open(os.path.join(output_dir, "bwa_mem.err"), "a"),
-                    check=True)
+    with open(os.path.join(log_files, f"{assembly_id}.bwa_mem.log"), "a") as log, \
+         open(os.path.join(log_files, f"{assembly_id}.bwa_mem.err"), "a") as err:
+        if library is not None:
+            library_reference(reference_file, assembly_id, library, log, err)
+        else:
+            subprocess.run(["bwa", "index", reference_file], 
+                            stdout=log,
+                            stderr=err,
+                            check=True)
 
-    if input_fastq_2:
+        input_fastqs = [input_fastq_1, input_fastq_2] if input_fastq_2 else [input_fastq_1]
         try:
             subprocess.run([
                 "bwa",
                 "mem",
-                "-t", str(threads),
-                "-o", os.path.join(sam_files, f"{assembly_id}.sam"),
-                reference_file,
-                input_fastq_1,
-                input_fastq_2],
-                    stdout=open(os.path.join(output_dir, "bwa_mem.log"), "a"),
-                    stderr=open(os.path.join(output_dir, "bwa_mem.err"), "a"),
+                "-t", str(threads)] +
+                (["-a"] if all_alignments else []) +
+                ["-o", os.path.join(sam_files, f"{assembly_id}.sam"),
+                reference_file] + input_fastqs,
+                    stdout=log,
+                    stderr=err,
                     check=True)
         except subprocess.CalledProcessError:
             return 1
-    else:
+
+    return 0
+
+def wait_pipeline(processes):
+    '''waits for piped processes, raising for the first one that failed'''
+    return_codes = [process.wait() for process in processes]
+    failed = [process for process, return_code in zip(processes, return_codes) if return_code != 0]
+    # a process killed by SIGPIPE (-13, or 141 from a shell) only failed because a later one exited
+    failed.sort(key=lambda process: process.returncode in (-13, 141))
+    if failed:
+        raise subprocess.CalledProcessError(failed[0].returncode, failed[0].args)
+
+def run_bwa_sorted(input_fastq_1, input_fastq_2, reference_file, assembly_id, output_dir, min_mapq, threads=20,
+                   library=None, sort_memory='768M', sort_threads=None):
+    '''maps the reads and pipes them through the mapq filter into samtools sort, without a sam file'''
+    bam_files = os.path.join(output_dir, "bam_files")
+    log_files = os.path.join(output_dir, "logs")
+    sorted_bam = os.path.join(bam_files, f"{assembly_id}.sorted.bam")
+    if sort_threads is None:
+        sort_threads = threads
+
+    os.makedirs(bam_files, exist_ok=True)
+    os.makedirs(log_files, exist_ok=True)
+
+    with open(os.path.join(log_files, f"{assembly_id}.bwa_mem.log"), "a") as log, \
+         open(os.path.join(log_files, f"{assembly_id}.bwa_mem.err"), "a") as err:
+        if library is not None:
+            library_reference(reference_file, assembly_id, library, log, err)
+        else:
+            subprocess.run(["bwa", "index", reference_file],
+                            stdout=log,
+                            stderr=err,
+                            check=True)
+
+        input_fastqs = [input_fastq_1, input_fastq_2] if input_fastq_2 else [input_fastq_1]
+        bwa_res = subprocess.Popen([
+            "bwa",
+            "mem",
+            "-t", str(threads),
+            reference_file] + input_fastqs,
+            stdout=subprocess.PIPE,
+            stderr=err)
+
+        samtools_view_res = subprocess.Popen([
+            "samtools",
+            "view",
+            "-u",
+            "--min-MQ", str(min_mapq),
+            "-"],
+            stdin=bwa_res.stdout,
+            stdout=subprocess.PIPE,
+            stderr=err)
+        bwa_res.stdout.close()
+
+        samtools_sort_res = subprocess.Popen([
+            "samtools",
+            "sort",
+            "-@", str(sort_threads),
+            "-m", sort_memory,
+            "-T", os.path.join(bam_files, f"{assembly_id}.sort"),
+            "-o", sorted_bam,
+            "-O", "BAM"],
+            stdin=samtools_view_res.stdout,
+            stderr=err)
+        samtools_view_res.stdout.close()
+
         try:
-            subprocess.run([
-                "bwa",
-                "mem",
-                "-t", str(threads),
-                "-o", os.path.join(sam_files, f"{assembly_id}.sam"),
-                reference_file,
-                input_fastq_1],
-                    stdout=open(os.path.join(output_dir, "bwa_mem.log"), "a"),
-                    stderr=open(os.path.join(output_dir, "bwa_mem.err"), "a"),
-                    check=True)
+            wait_pipeline([bwa_res, samtools_view_res, samtools_sort_res])
         except subprocess.CalledProcessError:
-            return 1
+            if os.path.exists(sorted_bam):
+                os.remove(sorted_bam)
+            raise
 
-    return 0
+    subprocess.run([
+        "samtools",
+        "index",
+        sorted_bam],
+                    check=True)
+
+def align_reads(fasta1, fasta2, reference_fasta, assembly_id, working_directory, min_mapq, threads,
+                library=None, streaming=False, sort_memory='768M', sort_threads=None):
+    '''aligns the reads to one reference into bam_files/[assembly_id].sorted.bam'''
+    if streaming:
+        run_bwa_sorted(fasta1, fasta2, reference_fasta, assembly_id, working_directory, min_mapq, threads=threads,
+                       library=library, sort_memory=sort_memory, sort_threads=sort_threads)
+    else:
+        run_bwa(fasta1, fasta2, reference_fasta, assembly_id, working_directory, threads=threads, library=library)
+        sort_samfile(assembly_id, working_directory, min_mapq, threads)
+
+def align_assembly(fasta1, fasta2, assembly_id, working_directory, min_mapq, threads, keep_depth=False, library=None,
+                   streaming=False, sort_memory='768M', sort_threads=None):
+    '''stage 1 alignment of one assembly, returns its rle coverage'''
+    reference_fasta = os.path.join(working_directory, 'reference_genomes', f'{assembly_id}.fasta')
+    align_reads(fasta1, fasta2, reference_fasta, assembly_id, working_directory, min_mapq, threads,
+                library, streaming, sort_memory, sort_threads)
+    return samtools_calculate_coverage(assembly_id, working_directory, keep_depth)
+
+def assembly_threads(genome_lengths, threads, concurrent=4):
+    '''threads for each assembly in proportion to its genome length, capped so that up to concurrent
+    assemblies share the budget (the largest getting threads // min(assemblies, concurrent))'''
+    largest = max(genome_lengths.values())
+    cap = max(1, threads // min(len(genome_lengths), concurrent))
+    return {assembly_id: max(1, min(cap, math.ceil(cap * genome_length / largest)))
+            for assembly_id, genome_length in genome_lengths.items()}
+
+def align_assemblies(fasta1, fasta2, assembly_ids, working_directory, min_mapq, threads, keep_depth=False, library=None,
+                     streaming=False, sort_memory='768M', sort_threads=None, concurrent=4):
+    '''runs stage 1 alignments of up to concurrent assemblies (or more, smaller ones) at once within a budget
+    of threads, the largest genomes starting first'''
+    genome_lengths = {assembly_id: parse_reference_fasta(assembly_id, working_directory)[0] for assembly_id in assembly_ids}
+    if not genome_lengths:
+        return dict()
+    thread_dict = assembly_threads(genome_lengths, threads, concurrent)
+    pending = sorted(genome_lengths, key=genome_lengths.get, reverse=True)
+
+    coverage = dict()
+    running = dict()
+    free_threads = threads
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while pending or running:
+            for assembly_id in list(pending):
+                if thread_dict[assembly_id] <= free_threads:
+                    pending.remove(assembly_id)
+                    free_threads -= thread_dict[assembly_id]
+                    future = executor.submit(align_assembly, fasta1, fasta2, assembly_id, working_directory,
+                                             min_mapq, thread_dict[assembly_id], keep_depth, library,
+                                             streaming, sort_memory, sort_threads)
+                    running[future] = assembly_id
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                assembly_id = running.pop(future)
+                free_threads += thread_dict[assembly_id]
+                coverage[assembly_id] = future.result()
+                print(f"Stage 1 alignment finished: {assembly_id} ({thread_dict[assembly_id]} threads)")
+
+    return coverage
+
+def subsample_reads(fasta1, fasta2, fraction, output_dir, seed=11):
+    '''reproducible random subsample of the reads with seqtk, the same seed keeping the same pairs of both files'''
+    os.makedirs(output_dir, exist_ok=True)
+    subsampled = []
+    for i, fasta in enumerate([fasta1, fasta2]):
+        if not fasta:
+            subsampled.append(fasta)
+            continue
+        output = os.path.join(output_dir, f"subsample_{i+1}.fasta")
+        with open(f"{output}.tmp", "w") as handle:
+            subprocess.run(["seqtk", "sample", f"-s{seed}", fasta, str(fraction)], stdout=handle, check=True)
+        os.replace(f"{output}.tmp", output)
+        subsampled.append(output)
+    return subsampled
+
+def screening_score(assembly_id, output_directory, coverage, z=3):
+    '''reads mapped, provisional coverage score and its upper bound from the subsample alignment,
+    the bound adding z standard deviations of the breadth expected for randomly placed reads'''
+    genome_length, genome_ids = parse_reference_fasta(assembly_id, output_directory)
+    reads_mapped = get_mapping_stats(assembly_id, output_directory)['reads mapped']
+    pos_count, totol_count = coverage_counts(coverage, 1)
+    in_genome = pos_count.index.isin(set(genome_ids))
+    genome_pos_count = int(pos_count[in_genome].sum())
+    genome_totol_count = int(totol_count[in_genome].sum())
+    
+    if genome_totol_count == 0 or reads_mapped == 0:
+        return reads_mapped, 0, 0, 0, 0, math.inf
+    breadth_coverage = genome_pos_count/genome_length
+    depth_coverage = genome_totol_count/genome_pos_count
+    expected_breadth_coverage, std = get_expected_coverage(genome_length, reads_mapped, genome_totol_count)
+    # std is of the number of covered read-length slots, genome_length/mean mapping length of them
+    slots = genome_length/(genome_totol_count/reads_mapped)
+    coverage_score = breadth_coverage/expected_breadth_coverage
+    upper_bound = (breadth_coverage + z*std/slots)/expected_breadth_coverage
+    return reads_mapped, breadth_coverage, depth_coverage, expected_breadth_coverage, coverage_score, upper_bound
+
+def screen_assemblies(fasta1, fasta2, assembly_ids, working_directory, min_coverage_score, min_mapq, threads,
+                      fraction=0.1, min_reads=50, seed=11, library=None, streaming=False, sort_memory='768M', sort_threads=None):
+    '''aligns a subsample of the reads to every candidate and promotes to the full stage 1 alignment only
+    the assemblies whose coverage score could still reach min_coverage_score: those with fewer than
+    min_reads subsampled reads mapped (too few to judge) or an upper bound >= min_coverage_score.
+    More reads lower the coverage score of unevenly covered genomes, so the subsample score errs high.'''
+    screen_directory = os.path.join(working_directory, 'screening')
+    os.makedirs(screen_directory, exist_ok=True)
+    # the subsample is aligned to the same reference genomes (and their bwa index)
+    reference_genome_path = os.path.join(screen_directory, 'reference_genomes')
+    if not os.path.lexists(reference_genome_path):
+        os.symlink(os.path.abspath(os.path.join(working_directory, 'reference_genomes')), reference_genome_path)
+
+    sub1, sub2 = subsample_reads(fasta1, fasta2, fraction, screen_directory, seed)
+    coverage = align_assemblies(sub1, sub2, assembly_ids, screen_directory, min_mapq, threads, False, library,
+                                streaming, sort_memory, sort_threads)
+
+    screening = pd.DataFrame([(assembly_id,) + screening_score(assembly_id, screen_directory, coverage[assembly_id])
+                              for assembly_id in assembly_ids],
+                             columns=['Assembly Accession ID', 'Screening Reads Mapped', 'Screening Breadth Coverage',
+                                      'Screening Depth Coverage', 'Screening Expected Coverage', 'Screening Coverage Score',
+                                      'Screening Upper Bound'])
+    screening['Promoted'] = (screening['Screening Reads Mapped'] < min_reads) | (screening['Screening Upper Bound'] >= min_coverage_score)
+    screening.to_csv(os.path.join(working_directory, 'screening.csv'), index=False)
+
+    avoided = int((~screening['Promoted']).sum())
+    print(f"Screening ({fraction:g} of reads): {avoided} of {len(assembly_ids)} full stage 1 alignments avoided")
+    return screening
+
+def get_assembly_read_counts(assembly_id, output_directory, contig_assembly_dict, chunksize=5000000):
+    '''reads (each mate counted) with a primary or secondary alignment to each assembly, from the
+    unsorted sam file, where all alignments of a read are adjacent'''
+    sam_file = os.path.join(output_directory, 'sam_files', f"{assembly_id}.sam")
+    assemblies = sorted(set(contig_assembly_dict.values()))
+    assembly_code = {genome_id: assemblies.index(assembly) for genome_id, assembly in contig_assembly_dict.items()}
+    counts = np.zeros(len(assemblies), dtype=np.int64)
+
+    def add(alignments):
+        alignments = alignments.assign(assembly=alignments['genome_id'].map(assembly_code),
+                                       mate=alignments['flag'] & 0xC0)
+        alignments = alignments.dropna(subset=['assembly']).drop_duplicates(['read', 'mate', 'assembly'])
+        counts[:] += np.bincount(alignments['assembly'].astype(np.int64), minlength=len(assemblies))
+
+    view_res = subprocess.Popen(['samtools', 'view', '-F', '0x804', sam_file], stdout=subprocess.PIPE)
+    cut_res = subprocess.Popen(['cut', '-f', '1-3'], stdin=view_res.stdout, stdout=subprocess.PIPE)
+    view_res.stdout.close()
+    try:
+        reader = pd.read_csv(cut_res.stdout, sep='\t', header=None, names=['read', 'flag', 'genome_id'],
+                             dtype={'read': object, 'flag': np.int64, 'genome_id': object}, chunksize=chunksize)
+        carry = None
+        for chunk in reader:
+            if carry is not None:
+                chunk = pd.concat([carry, chunk])
+            if chunk.empty:
+                continue
+            # the last read may continue in the next chunk
+            last_read = chunk['read'].iat[-1]
+            carry = chunk[chunk['read'] == last_read]
+            add(chunk[chunk['read'] != last_read])
+        if carry is not None:
+            add(carry)
+    except pd.errors.EmptyDataError:
+        pass
+    finally:
+        cut_res.stdout.close()
+    wait_pipeline([view_res, cut_res])
+
+    return {assembly: int(count) for assembly, count in zip(assemblies, counts)}
+
+def competitive_alignment(fasta1, fasta2, assembly_ids, working_directory, threads, keep_depth=False):
+    '''stage 1 as a single alignment of the reads against all candidates at once (bwa mem -a, secondary
+    alignments kept), returning per assembly breadth, depth and expected coverage attributed from it.
+    Secondary alignments have mapq 0 against a combined reference, so no mapq filter is applied.'''
+    reference_fasta = merge_reference_fasta(assembly_ids, working_directory, 'combined')
+    contig_assembly_dict = load_contig_map('combined', working_directory)
+
+    # the combined reference is unique to the sample, so it is indexed in place rather than in the library
+    run_bwa(fasta1, fasta2, reference_fasta, 'combined', working_directory, threads=threads, all_alignments=True)
+    reads_mapped = get_assembly_read_counts('combined', working_directory, contig_assembly_dict)
+    sort_samfile('combined', working_directory, 0, threads, exclude_flags='0x4')
+    coverage = samtools_calculate_coverage('combined', working_directory, keep_depth)
+
+    breadth_coverage_dict, depth_coverage_dict, expected_breadth_coverage_dict = \
+    calculate_depth_merged(assembly_ids, working_directory, min_depth=1, coverage=coverage,
+                           merged_id='combined', reads_mapped=reads_mapped)
+    return {assembly_id: (breadth_coverage_dict[assembly_id], depth_coverage_dict[assembly_id],
+                          expected_breadth_coverage_dict[assembly_id])
+            for assembly_id in assembly_ids}
+
+def compare_stage_1(assembly_ids, working_directory, competitive, per_assembly_coverage, min_coverage_score):
+    '''writes stage_1_comparison.csv of the competitive and per-assembly stage 1 coverage of every
+    assembly, and prints how often they agree on passing min_coverage_score'''
+    rows = []
+    for assembly_id in assembly_ids:
+        per_assembly = calculate_depth(assembly_id, working_directory, min_depth=1, coverage=per_assembly_coverage.get(assembly_id))
+        row = [assembly_id]
+        for breadth_coverage, depth_coverage, expected_breadth_coverage in (per_assembly, competitive[assembly_id]):
+            coverage_score = breadth_coverage/expected_breadth_coverage if expected_breadth_coverage != 0 else 0
+            row += [breadth_coverage, expected_breadth_coverage, coverage_score, depth_coverage]
+        rows.append(row)
+
+    comparison = pd.DataFrame(rows, columns=['Assembly Accession ID',
+                                             'Breadth Coverage', 'Expected Coverage', 'Coverage Score', 'Depth Coverage',
+                                             'Competitive Breadth Coverage', 'Competitive Expected Coverage',
+                                             'Competitive Coverage Score', 'Competitive Depth Coverage'])
+    comparison['Coverage Score Difference'] = comparison['Competitive Coverage Score'] - comparison['Coverage Score']
+    comparison['Passed'] = comparison['Coverage Score'] >= min_coverage_score
+    comparison['Competitive Passed'] = comparison['Competitive Coverage Score'] >= min_coverage_score
+    comparison.to_csv(os.path.join(working_directory, 'stage_1_comparison.csv'), index=False)
+
+    agree = int((comparison['Passed'] == comparison['Competitive Passed']).sum())
+    max_difference = comparison['Coverage Score Difference'].abs().max() if len(comparison) else 0
+    print(f"Competitive stage 1 agrees with per-assembly alignment on {agree} of {len(comparison)} assemblies "
+          f"at coverage score {min_coverage_score} (largest coverage score difference {max_difference:.3f})")
+    return comparison
+
+# samtools depth (genome_id, 1-based pos, depth) -> runs (genome_id, 0-based start, end, depth)
+RUN_COLLAPSE = ('$1 != genome_id || $2 != end + 1 || $3 != depth { if (NR > 1) print genome_id, start, end, depth; '
+                'genome_id = $1; start = $2 - 1; depth = $3 } { end = $2 } '
+                'END { if (NR > 0) print genome_id, start, end, depth }')
 
 def samtools_calculate_depth(assembly_id, output_dir):
     depth_files = os.path.join(output_dir, "depth_files")
     bam_files = os.path.join(output_dir, "bam_files")
 
-    if not os.path.exists(depth_files):
-        os.mkdir(depth_files)
+    os.makedirs(depth_files, exist_ok=True)
 
     depth_file = os.path.join(depth_files, f"{assembly_id}.depth")
                 
@@ -318,6 +766,51 @@ def samtools_calculate_depth(assembly_id, output_dir):
                     check=True,
                     stdout=open(os.path.join(depth_file), "w"))
 
+def rle_coverage(depth_file=None, depth_stream=None):
+    '''bedGraph-like intervals (genome_id, start, end, depth) of samtools depth output, from a file or a pipe.
+    Runs of equal depth are collapsed by awk as the depth lines stream through, so only the runs are parsed'''
+    collapse_res = subprocess.Popen(['awk', '-F', '\t', '-v', 'OFS=\t', RUN_COLLAPSE] + ([depth_file] if depth_file else []),
+                                    stdin=depth_stream, stdout=subprocess.PIPE)
+    try:
+        coverage = pd.read_csv(collapse_res.stdout, sep='\t', header=None, names=['genome_id', 'start', 'end', 'depth'],
+                               dtype={'genome_id': object, 'start': np.int64, 'end': np.int64, 'depth': np.int64})
+    except pd.errors.EmptyDataError:
+        coverage = pd.DataFrame({'genome_id': pd.Series(dtype=object), 'start': pd.Series(dtype=np.int64),
+                                 'end': pd.Series(dtype=np.int64), 'depth': pd.Series(dtype=np.int64)})
+    finally:
+        collapse_res.stdout.close()
+    wait_pipeline([collapse_res])
+    return coverage
+
+def samtools_calculate_coverage(assembly_id, output_dir, keep_depth=False):
+    '''coverage of the sorted bam as run-length encoded intervals, without writing the depth file unless keep_depth'''
+    if keep_depth:
+        samtools_calculate_depth(assembly_id, output_dir)
+        return rle_coverage(os.path.join(output_dir, "depth_files", f"{assembly_id}.depth"))
+
+    bam_file = os.path.join(output_dir, "bam_files", f"{assembly_id}.sorted.bam")
+    depth_res = subprocess.Popen([
+        "samtools",
+        "depth",
+        bam_file,
+        "-G", "0x800"],
+                    stdout=subprocess.PIPE)
+    try:
+        coverage = rle_coverage(depth_stream=depth_res.stdout)
+    finally:
+        depth_res.stdout.close()
+    wait_pipeline([depth_res])
+
+    return coverage
+
+def coverage_counts(coverage, min_depth=1):
+    '''per genome id count of positions with depth >= min_depth and sum of their depth, from rle coverage'''
+    coverage = coverage[coverage['depth'] >= min_depth]
+    lengths = coverage['end'] - coverage['start']
+    pos_count = lengths.groupby(coverage['genome_id']).sum()
+    totol_count = (lengths * coverage['depth']).groupby(coverage['genome_id']).sum()
+    return pos_count.astype(np.int64), totol_count.astype(np.int64)
+
 def parse_reference_fasta(assembly_id, output_directory):
     reference_fasta = os.path.join(output_directory, 'reference_genomes', f'{assembly_id}.fasta')
     
@@ -358,6 +851,36 @@ def get_mapping_stats(assembly_id, output_directory, genome_id=None):
         
     return mapping_stats
 
+def get_contig_read_counts(assembly_id, output_directory, threads=1):
+    '''mapped read count of every contig in one pass over the sorted bam,
+    counting the same reads as "reads mapped" of samtools stats (primary, mapped)'''
+    bam_file = os.path.join(output_directory, 'bam_files', f"{assembly_id}.sorted.bam")
+
+    view_res = subprocess.Popen(['samtools', 'view', '-@', str(threads), '-F', '0x904', bam_file],
+                                stdout=subprocess.PIPE)
+    cut_res = subprocess.Popen(['cut', '-f', '3'],
+                               stdin=view_res.stdout,
+                               stdout=subprocess.PIPE)
+    view_res.stdout.close()
+    # the bam is sorted, so the reads of a contig are adjacent
+    uniq_res = subprocess.run(['uniq', '-c'],
+                              check=True,
+                              universal_newlines=True,
+                              stdin=cut_res.stdout,
+                              stdout=subprocess.PIPE)
+    cut_res.stdout.close()
+    for res in (view_res, cut_res):
+        if res.wait() != 0:
+            raise subprocess.CalledProcessError(res.returncode, res.args)
+
+    contig_read_counts = defaultdict(int)
+    for line in uniq_res.stdout.strip().split('\n'):
+        if line:
+            count, genome_id = line.split()
+            contig_read_counts[genome_id] += int(count)
+
+    return contig_read_counts
+
 def get_expected_coverage(genome_length, reads_mapped, genome_totol_count):
     mean_mapping_length = genome_totol_count/reads_mapped
     
@@ -374,25 +897,42 @@ def get_expected_coverage(genome_length, reads_mapped, genome_totol_count):
         std = 0
     return expected_coverage, std
 
-def calculate_depth(assembly_id, output_directory, min_depth=1):
+def read_depth(depth_file, min_depth=1, chunksize=5000000):
+    '''per genome id count of positions with depth >= min_depth and sum of their depth'''
+    pos_count = pd.Series(dtype='int64')
+    totol_count = pd.Series(dtype='int64')
+    if os.path.getsize(depth_file) == 0:
+        return pos_count, totol_count
+
+    reader = pd.read_csv(depth_file, sep='\t', header=None,
+                         names=['genome_id', 'pos', 'depth'], usecols=['genome_id', 'depth'],
+                         dtype={'genome_id': 'category', 'depth': np.int64}, chunksize=chunksize)
+    for chunk in reader:
+        chunk = chunk[chunk['depth'] >= min_depth]
+        grouped = chunk.groupby('genome_id', observed=True)['depth']
+        chunk_pos_count = grouped.size()
+        chunk_totol_count = grouped.sum()
+        chunk_pos_count.index = chunk_pos_count.index.astype(str)
+        chunk_totol_count.index = chunk_totol_count.index.astype(str)
+        pos_count = pos_count.add(chunk_pos_count, fill_value=0)
+        totol_count = totol_count.add(chunk_totol_count, fill_value=0)
+
+    return pos_count.astype(np.int64), totol_count.astype(np.int64)
+
+def calculate_depth(assembly_id, output_directory, min_depth=1, coverage=None):
     depth_file = os.path.join(output_directory, 'depth_files', f"{assembly_id}.depth")
     
     genome_length, genome_ids = parse_reference_fasta(assembly_id, output_directory)
     mapping_stats = get_mapping_stats(assembly_id, output_directory)
     reads_mapped = mapping_stats['reads mapped']
 
-    genome_pos_count = 0
-    genome_totol_count = 0
-    with open(depth_file, "r") as depth:
-        for line in depth.readlines():
-            
-            genome_id = line.split("\t")[0]
-            pos = int(line.split("\t")[1])
-            depth = int(line.strip().split("\t")[2])
-
-            if depth >= min_depth and genome_id in genome_ids:
-                genome_pos_count += 1
-                genome_totol_count += depth
+    if coverage is not None:
+        pos_count, totol_count = coverage_counts(coverage, min_depth)
+    else:
+        pos_count, totol_count = read_depth(depth_file, min_depth)
+    in_genome = pos_count.index.isin(set(genome_ids))
+    genome_pos_count = int(pos_count[in_genome].sum())
+    genome_totol_count = int(totol_count[in_genome].sum())
     
     if genome_totol_count == 0 or reads_mapped == 0:
         breadth_coverage = 0
@@ -405,38 +945,49 @@ def calculate_depth(assembly_id, output_directory, min_depth=1):
     
     return breadth_coverage, depth_coverage, expected_breadth_coverage
 
-def calculate_depth_merged(assembly_ids, output_directory, min_depth=1):
-    depth_file = os.path.join(output_directory, 'depth_files', f"merged.depth")
+def calculate_depth_merged(assembly_ids, output_directory, min_depth=1, coverage=None, merged_id='merged', reads_mapped=None):
+    '''per assembly breadth, depth and expected coverage from the alignment to the merged reference,
+    reads mapped per assembly coming from reads_mapped if given, else from the primary alignments'''
+    depth_file = os.path.join(output_directory, 'depth_files', f"{merged_id}.depth")
     
-    genome_id_pos_count = defaultdict(int)
-    genome_id_totol_count = defaultdict(int)
-    
-    with open(depth_file, "r") as depth:
-        for line in depth.readlines():            
-            genome_id = line.split("\t")[0]
-            pos = int(line.split("\t")[1])
-            depth = int(line.strip().split("\t")[2])
-
-            if depth >= min_depth:
-                genome_id_pos_count[genome_id] += 1
-                genome_id_totol_count[genome_id] += depth
+    if coverage is not None:
+        pos_count, totol_count = coverage_counts(coverage, min_depth)
+    else:
+        pos_count, totol_count = read_depth(depth_file, min_depth)
+    genome_id_pos_count = defaultdict(int, {genome_id: int(count) for genome_id, count in pos_count.items()})
+    genome_id_totol_count = defaultdict(int, {genome_id: int(count) for genome_id, count in totol_count.items()})
     
     breadth_coverage_dict = defaultdict(float)
     depth_coverage_dict = defaultdict(float)
     reads_mapped_dict = defaultdict(int)
     expected_breadth_coverage_dict = defaultdict(float)
     
+    # contigs and lengths come from the merge_reference_fasta contig map and the faidx index
+    contig_assembly_dict = load_contig_map(merged_id, output_directory)
+    contig_index = read_fasta_index(os.path.join(output_directory, 'reference_genomes', f'{merged_id}.fasta'))
+    reference_dict = {assembly_id: [0, []] for assembly_id in assembly_ids}
+    for genome_id, assembly_id in contig_assembly_dict.items():
+        if assembly_id in reference_dict:
+            reference_dict[assembly_id][0] += contig_index[genome_id][0]
+            reference_dict[assembly_id][1].append(genome_id)
+
+    if reads_mapped is None:
+        contig_read_counts = get_contig_read_counts(merged_id, output_directory)
+        for genome_id, count in contig_read_counts.items():
+            if genome_id in contig_assembly_dict and genome_id_pos_count[genome_id] > 0:
+                reads_mapped_dict[contig_assembly_dict[genome_id]] += float(count)
+    else:
+        contig_read_counts = defaultdict(int)
+        reads_mapped_dict.update({assembly_id: float(count) for assembly_id, count in reads_mapped.items()})
+
     for assembly_id in assembly_ids:
-        genome_length, genome_ids = parse_reference_fasta(assembly_id, output_directory)
+        genome_length, genome_ids = reference_dict[assembly_id]
         
         genome_pos_count = 0
         genome_totol_count = 0
         for genome_id in genome_ids:
             genome_pos_count += genome_id_pos_count[genome_id]
             genome_totol_count += genome_id_totol_count[genome_id]
-            if genome_id_pos_count[genome_id] > 0:
-                mapping_stats = get_mapping_stats('merged', output_directory, genome_id)
-                reads_mapped_dict[assembly_id] += mapping_stats['reads mapped']
             
         if genome_totol_count > 0 and reads_mapped_dict[assembly_id] > 0:
             breadth_coverage_dict[assembly_id] = genome_pos_count/genome_length
@@ -447,27 +998,96 @@ def calculate_depth_merged(assembly_ids, output_directory, min_depth=1):
             print("WARNING: Inconsistency between samtools depth and samtools stats for:", assembly_id)
             print("Genome ID", "\t", "Stats Mapped Read Count", "\t", "# of Covered Positions")
             for genome_id in genome_ids:
-                print(genome_id, "\t", get_mapping_stats('merged', output_directory, genome_id)['reads mapped'], "\t", genome_id_totol_count[genome_id])
+                print(genome_id, "\t", float(contig_read_counts[genome_id]), "\t", genome_id_totol_count[genome_id])
             
     return breadth_coverage_dict, depth_coverage_dict, expected_breadth_coverage_dict
 
-def merge_reference_fasta(assembly_ids, output_directory):
-    merged_fasta = os.path.join(output_directory, 'reference_genomes', f'merged.fasta')
-    
-    seq_records = []
-    for assembly_id in assembly_ids:
-        reference_fasta = os.path.join(output_directory, 'reference_genomes', f'{assembly_id}.fasta')
+def merge_reference_fasta(assembly_ids, output_directory, merged_id='merged'):
+    '''concatenates the assembly fastas byte for byte into [merged_id].fasta, writing the contig ->
+    assembly map of the merged reference to [merged_id].contigs.tsv as it goes'''
+    merged_fasta = os.path.join(output_directory, 'reference_genomes', f'{merged_id}.fasta')
+    contig_map = os.path.join(output_directory, 'reference_genomes', f'{merged_id}.contigs.tsv')
+
+    with open(f"{merged_fasta}.tmp", "wb") as output_handle, open(f"{contig_map}.tmp", "w") as map_handle:
+        for assembly_id in assembly_ids:
+            reference_fasta = os.path.join(output_directory, 'reference_genomes', f'{assembly_id}.fasta')
+            line = b'\n'
+            with open(reference_fasta, "rb") as handle:
+                for line in handle:
+                    if line.startswith(b'>'):
+                        map_handle.write(f"{line[1:].split(maxsplit=1)[0].decode()}\t{assembly_id}\n")
+                    output_handle.write(line)
+            # the next assembly has to start on a new line
+            if not line.endswith(b'\n'):
+                output_handle.write(b'\n')
+    os.replace(f"{contig_map}.tmp", contig_map)
+    os.replace(f"{merged_fasta}.tmp", merged_fasta)
 
-        with open(reference_fasta, "r") as handle:
-            for record in SeqIO.parse(handle, "fasta"):   
-                seq_records.append(record)
-                    
-    with open(merged_fasta, "w") as output_handle:
-        SeqIO.write(seq_records, output_handle, "fasta")
-        
     return merged_fasta
 
-def cal_ani(assembly_id, output_directory, consensus_record_dict, ignore_del=False, del_count_as_match=False):
+def load_contig_map(merged_id, output_directory):
+    '''contig -> assembly dict of a reference written by merge_reference_fasta'''
+    contig_map = os.path.join(output_directory, 'reference_genomes', f'{merged_id}.contigs.tsv')
+    with open(contig_map, "r") as handle:
+        return dict(line.rstrip('\n').split('\t') for line in handle)
+
+def read_fasta_index(fasta):
+    '''contig -> (length, offset, line bases, line width) from the .fai of a fasta, indexed with samtools faidx if needed'''
+    fai = f"{fasta}.fai"
+    if not os.path.exists(fai) or os.path.getmtime(fai) < os.path.getmtime(fasta):
+        subprocess.run(['samtools', 'faidx', fasta], check=True)
+
+    index = dict()
+    with open(fai, "r") as handle:
+        for line in handle:
+            name, length, offset, line_bases, line_width = line.split('\t')[:5]
+            index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+    return index
+
+def load_fasta_index(fasta):
+    '''faidx index of a fasta with the fasta memory mapped, so contigs can be fetched one at a time with fetch_contig'''
+    index = read_fasta_index(fasta)
+    with open(fasta, "rb") as handle:
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(fasta) else b''
+    return {'fasta': fasta, 'index': index, 'data': data}
+
+def fetch_contig(fasta_index, name):
+    '''sequence of one contig of a load_fasta_index fasta as a uint8 array, None if it is not in the fasta'''
+    if name not in fasta_index['index']:
+        return None
+    length, offset, line_bases, line_width = fasta_index['index'][name]
+    end = offset + (length // line_bases) * line_width + length % line_bases if line_bases else offset
+    sequence = np.frombuffer(fasta_index['data'][offset:end], dtype=np.uint8)
+    return sequence[(sequence != ord('\n')) & (sequence != ord('\r'))]
+
+def sequence_array(record):
+    '''sequence of a SeqRecord, Seq or str as a uint8 array of ascii codes'''
+    if isinstance(record, np.ndarray):
+        return record
+    seq = getattr(record, 'seq', record)
+    if isinstance(seq, str):
+        seq = seq.encode()
+    return np.frombuffer(bytes(seq), dtype=np.uint8)
+
+def count_ani(reference, consensus, ignore_del=False, del_count_as_match=False):
+    '''matched and total positions of one contig, reference and consensus as uint8 arrays'''
+    if len(consensus) < len(reference):
+        raise IndexError("consensus sequence is shorter than the reference")
+    consensus = consensus[:len(reference)]
+
+    called = consensus != ord('N')
+    deletion = consensus == ord('*')
+    base = called & ~deletion
+    del_count = 0 if ignore_del else int(np.count_nonzero(deletion))
+
+    total_count = int(np.count_nonzero(base)) + del_count
+    matched_count = int(np.count_nonzero(base & (consensus == reference)))
+    if del_count_as_match:
+        matched_count += del_count
+    return matched_count, total_count
+
+def cal_ani(assembly_id, output_directory, consensus_index, ignore_del=False, del_count_as_match=False):
+    '''consensus ani of one assembly, fetching the consensus of its contigs one at a time'''
     reference_fasta = os.path.join(output_directory, 'reference_genomes', f'{assembly_id}.fasta')
 
     with open(reference_fasta, "r") as handle:
@@ -475,19 +1095,11 @@ def cal_ani(assembly_id, output_directory, consensus_record_dict, ignore_del=Fal
         matched_count = 0
 
         for record in SeqIO.parse(handle, "fasta"):
-            if record.id in consensus_record_dict:
-                for idx, base in enumerate(record.seq):
-                    if consensus_record_dict[record.id][idx] != 'N':
-                        if consensus_record_dict[record.id][idx] == '*' and ignore_del:
-                            continue
-                        elif consensus_record_dict[record.id][idx] == '*':
-                            total_count += 1
-                            if del_count_as_match:
-                                matched_count += 1
-                        else:
-                            total_count += 1
-                            if consensus_record_dict[record.id][idx] == base:
-                                matched_count += 1
+            consensus = fetch_contig(consensus_index, record.id)
+            if consensus is not None:
+                matched, total = count_ani(sequence_array(record), consensus, ignore_del, del_count_as_match)
+                matched_count += matched
+                total_count += total
             else:
                 continue
                 #print("No alignment found:", record.id, record.description)
@@ -497,16 +1109,35 @@ def cal_ani(assembly_id, output_directory, consensus_record_dict, ignore_del=Fal
     else:
         return 0
 
+def cal_ani_all(assembly_ids, output_directory, consensus_index, ignore_del=False, del_count_as_match=False):
+    '''consensus ani of every assembly'''
+    return {assembly_id: cal_ani(assembly_id, output_directory, consensus_index, ignore_del, del_count_as_match)
+            for assembly_id in assembly_ids}
+
 def cal_combined_cs2_ani(cs2, ani):
     return round(math.sqrt(ani)*cs2*100,2)
 
-def alignment_1_summary(downloaded_assemblies, output_directory):
+def alignment_1_summary(downloaded_assemblies, output_directory, coverage=None, screening=None, competitive=None):
+    if coverage is None:
+        coverage = dict()
+    screened_out = pd.DataFrame()
+    if screening is not None:
+        screened_out = screening[~screening['Promoted']].set_index('Assembly Accession ID')
     breadth_coverage_list = []
     depth_coverage_list = []
     expected_breadth_coverage_list = []
     coverage_score = []
     for assembly_id in downloaded_assemblies['Assembly Accession ID']:
-        breadth_coverage, depth_coverage, expected_breadth_coverage = calculate_depth(assembly_id, output_directory, min_depth=1)
+        if assembly_id in screened_out.index:
+            # not aligned with all reads, the subsample values are kept
+            breadth_coverage, depth_coverage, expected_breadth_coverage = screened_out.loc[assembly_id, ['Screening Breadth Coverage',
+                                                                                                         'Screening Depth Coverage',
+                                                                                                         'Screening Expected Coverage']]
+        elif competitive is not None:
+            breadth_coverage, depth_coverage, expected_breadth_coverage = competitive[assembly_id]
+        else:
+            breadth_coverage, depth_coverage, expected_breadth_coverage = calculate_depth(assembly_id, output_directory, min_depth=1,
+                                                                                          coverage=coverage.get(assembly_id))
         breadth_coverage_list.append(breadth_coverage)
         depth_coverage_list.append(depth_coverage)
         expected_breadth_coverage_list.append(expected_breadth_coverage)
@@ -519,14 +1150,16 @@ def alignment_1_summary(downloaded_assemblies, output_directory):
     downloaded_assemblies['Expected Coverage'] = expected_breadth_coverage_list
     downloaded_assemblies['Coverage Score'] = coverage_score
     downloaded_assemblies['Depth Coverage'] = depth_coverage_list
+    if screening is not None:
+        downloaded_assemblies = downloaded_assemblies.merge(screening, on='Assembly Accession ID', how='left')
     
     downloaded_assemblies.to_csv(os.path.join(output_directory, 'alignment.csv'), index=False)
     
     return downloaded_assemblies
 
-def alignment_2_summary(downloaded_assemblies, output_directory):
+def alignment_2_summary(downloaded_assemblies, output_directory, coverage=None):
     breadth_coverage_dict, depth_coverage_dict, expected_breadth_coverage_dict = \
-    calculate_depth_merged(list(downloaded_assemblies['Assembly Accession ID']), output_directory, min_depth=1)
+    calculate_depth_merged(list(downloaded_assemblies['Assembly Accession ID']), output_directory, min_depth=1, coverage=coverage)
     
     breadth_coverage_list = []
     depth_coverage_list = []
@@ -564,16 +1197,17 @@ def samtools_merged_consensus(output_directory, threads):
                     '-o', os.path.join(output_directory, 'merged_consensus.fasta')],
                   check=True)
     
-    consensus_record_dict = SeqIO.to_dict(SeqIO.parse(os.path.join(output_directory, 'merged_consensus.fasta'), "fasta"))
-    return consensus_record_dict
+    return load_fasta_index(os.path.join(output_directory, 'merged_consensus.fasta'))
 
-def ani_summary(downloaded_assemblies, consensus_record_dict, output_directory):
+def ani_summary(downloaded_assemblies, consensus_index, output_directory):
+    ani_dict = cal_ani_all(downloaded_assemblies[downloaded_assemblies['CS2'] != 0]['Assembly Accession ID'],
+                           output_directory, consensus_index)
     ani_list = []
     combined_cs2_ani_list = []
     for idx, row in downloaded_assemblies.iterrows():
         if row['CS2'] != 0:
             assembly_id = row['Assembly Accession ID']
-            ani = cal_ani(assembly_id, output_directory, consensus_record_dict)
+            ani = ani_dict[assembly_id]
             combined_cs2_ani = cal_combined_cs2_ani(row["CS2"], ani)
             ani_list.append(ani)
             combined_cs2_ani_list.append(combined_cs2_ani)
@@ -608,44 +1242,132 @@ def call_present_absent(downloaded_assemblies):
     downloaded_assemblies["Presence/Absence"] = status
     return downloaded_assemblies
 
-def build_record_dict(sequences_db_f):
-    sequence_ids = set()
-    record_dict = dict()
-    count = 0
-    for record in SeqIO.parse(sequences_db_f, "fasta"):
-        count += 1
-        if record.id not in sequence_ids:
-            sequence_ids.add(record.id)
-            record_dict[record.id] = record
-    print(f"WARNING: {count-len(record_dict)} duplicated record found among {count} sequences.")
-    
-    return record_dict
+SEQUENCE_INDEX_FILES = ('offsets', 'taxids', 'rows')
+
+def build_sequence_index(sequences_db_f, mapping_f, index_prefix):
+    '''builds a byte offset index of the records of the sequence database named in the taxid2seqid pickle
+    and a taxid -> record index, as numpy arrays that are memory mapped when fetching'''
+    taxid2seqid_dict = dict()
+    if os.path.getsize(mapping_f):
+        with open(mapping_f, 'rb') as handle:
+            taxid2seqid_dict = pickle.load(handle)
+    # only records of a mapped sequence id are indexed
+    wanted = {sequence_id for sequence_ids in taxid2seqid_dict.values() for sequence_id in sequence_ids}
 
-def local_taxid_fetch(taxid, output_directory, taxid2seqid_dict, record_dict):
+    offsets = []
+    row_dict = dict()
+    count = 0
+    duplicated = 0
+    if os.path.getsize(sequences_db_f):
+        with open(sequences_db_f, 'rb') as handle:
+            with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as db:
+                start = 0 if db[:1] == b'>' else db.find(b'\n>') + 1
+                while start > 0 or db[:1] == b'>':
+                    # a record runs until the next line starting with >
+                    next_start = db.find(b'\n>', start) + 1
+                    end = next_start if next_start else len(db)
+                    header_end = db.find(b'\n', start, end)
+                    header = db[start + 1:header_end if header_end != -1 else end].split()
+                    sequence_id = header[0].decode() if header else ''
+                    count += 1
+                    # the first record of a duplicated id is kept, as in build_record_dict before
+                    if sequence_id in row_dict:
+                        duplicated += 1
+                    elif sequence_id in wanted:
+                        row_dict[sequence_id] = len(offsets)
+                        offsets.append((start, end - start))
+                    if not next_start:
+                        break
+                    start = next_start
+    print(f"WARNING: {duplicated} duplicated record found among {count} sequences.")
+
+    taxids = []
+    rows = []
+    missing = 0
+    for taxid, sequence_ids in taxid2seqid_dict.items():
+        for sequence_id in sequence_ids:
+            if sequence_id in row_dict:
+                taxids.append(int(taxid))
+                rows.append(row_dict[sequence_id])
+            else:
+                missing += 1
+    if missing:
+        print(f"WARNING: {missing} sequence ids of {os.path.basename(mapping_f)} not found in {os.path.basename(sequences_db_f)}.")
+
+    taxids = np.array(taxids, dtype=np.int64)
+    order = np.argsort(taxids, kind='stable')
+    np.save(f"{index_prefix}.offsets.tmp.npy", np.array(offsets, dtype=np.int64).reshape(-1, 2))
+    np.save(f"{index_prefix}.taxids.tmp.npy", taxids[order])
+    np.save(f"{index_prefix}.rows.tmp.npy", np.array(rows, dtype=np.int64).reshape(-1)[order])
+    for name in SEQUENCE_INDEX_FILES:
+        os.replace(f"{index_prefix}.{name}.tmp.npy", f"{index_prefix}.{name}.npy")
+
+def sequence_index_stale(sequences_db_f, mapping_f, index_prefix):
+    '''True if an index file is missing or older than the sequence database or the mapping'''
+    newest = max(os.path.getmtime(sequences_db_f), os.path.getmtime(mapping_f))
+    return not all(os.path.exists(f"{index_prefix}.{name}.npy") and
+                   os.path.getmtime(f"{index_prefix}.{name}.npy") >= newest
+                   for name in SEQUENCE_INDEX_FILES)
+
+def load_sequence_index(sequences_db_f, mapping_f, index_prefix):
+    '''memory maps the sequence database index, building it first (once, under a lock) if it is
+    missing or older than the sequence database or the mapping'''
+    if sequence_index_stale(sequences_db_f, mapping_f, index_prefix):
+        with open(f"{index_prefix}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if sequence_index_stale(sequences_db_f, mapping_f, index_prefix):
+                print(f"Building sequence index {index_prefix}")
+                build_sequence_index(sequences_db_f, mapping_f, index_prefix)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    offsets, taxids, rows = [np.load(f"{index_prefix}.{name}.npy", mmap_mode='r') for name in SEQUENCE_INDEX_FILES]
+    return {'db': sequences_db_f, 'offsets': offsets, 'taxids': taxids, 'rows': rows}
+
+def local_taxid_fetch(taxid, output_directory, sequence_index):
     reference_genome_path=os.path.join(output_directory, 'reference_genomes')
     if not os.path.exists(reference_genome_path):
         os.mkdir(reference_genome_path)
     
-    records = []
-    for sequence_id in taxid2seqid_dict[str(taxid)]:
-        records.append(record_dict[sequence_id])
+    taxids = sequence_index['taxids']
+    first, last = np.searchsorted(taxids, int(taxid), side='left'), np.searchsorted(taxids, int(taxid), side='right')
+    rows = sequence_index['rows'][first:last]
         
-    if len(records) > 0:
-        with open(os.path.join(reference_genome_path, f"taxid_{taxid}.fasta"), "w") as output_handle:
-            SeqIO.write(records, output_handle, "fasta")
+    if len(rows) > 0:
+        with open(sequence_index['db'], 'rb') as db, \
+             open(os.path.join(reference_genome_path, f"taxid_{taxid}.fasta"), "wb") as output_handle:
+            for offset, length in sequence_index['offsets'][rows]:
+                db.seek(offset)
+                record = db.read(length)
+                output_handle.write(record if record.endswith(b'\n') else record + b'\n')
         return taxid, f"taxid_{taxid}", "Local Database", "N/A", "N/A", "N/A", "N/A", True
     else:
         return taxid, "N/A", "N/A", "N/A", "N/A", "N/A", "N/A", False
 
-def prepare_reference_genomes_offline(taxid_queries, output_directory, sequences_db_f, mapping_f, ncbi_taxa_db):
-    with open(mapping_f, 'rb') as handle:
-        taxid2seqid_dict = pickle.load(handle)
-        
-    record_dict = build_record_dict(sequences_db_f)
+def sequence_index_prefix(sequences_db_f, mapping_f, index_dir=None):
+    '''prefix of the sequence index files: in index_dir if given, else next to taxid2seqid.pickle if an up to date
+    index is there or the directory is writable, else in $GUTVIROME_CACHE/sequence_index (shared installs are read-only)'''
+    if index_dir is not None:
+        os.makedirs(index_dir, exist_ok=True)
+        return os.path.join(index_dir, os.path.basename(sequences_db_f))
+
+    database_dir = os.path.dirname(mapping_f)
+    prefix = os.path.join(database_dir, os.path.basename(sequences_db_f))
+    if not sequence_index_stale(sequences_db_f, mapping_f, prefix):
+        return prefix
+    index_dir = writable_dir(database_dir, os.path.join(CACHE_DIR, 'sequence_index'))
+    if index_dir == database_dir:
+        return prefix
+    return os.path.join(index_dir, cache_name(sequences_db_f))
+
+def prepare_reference_genomes_offline(taxid_queries, output_directory, sequences_db_f, mapping_f, taxonomy, index_prefix=None,
+                                      index_dir=None):
+    if index_prefix is None:
+        index_prefix = sequence_index_prefix(sequences_db_f, mapping_f, index_dir)
+    sequence_index = load_sequence_index(sequences_db_f, mapping_f, index_prefix)
     
     download_result = []
     for taxid in taxid_queries:
-        download_result.append(local_taxid_fetch(taxid, output_directory, taxid2seqid_dict, record_dict))
+        download_result.append(local_taxid_fetch(taxid, output_directory, sequence_index))
         
     reference_metadata = pd.DataFrame(download_result,
                                       columns=['Taxonomy ID', 
@@ -657,48 +1379,67 @@ def prepare_reference_genomes_offline(taxid_queries, output_directory, sequences
                                                'Strain',
                                                'Downloaded'])
     
-    taxonomy_name = []
-    for taxid in reference_metadata['Taxonomy ID']:
-        taxonomy_name.append(ncbi_taxa_db.get_taxid_translator([taxid])[taxid])
-    reference_metadata['Species'] = taxonomy_name
+    reference_metadata['Species'] = [taxonomy.name(taxid) for taxid in reference_metadata['Taxonomy ID']]
     reference_metadata.to_csv(os.path.join(output_directory, 'reference_metadata.csv'), index=False)
     
     return reference_metadata
 
-def reference_inference(fasta1, fasta2, seqscreen_output, working_directory, databases, min_frac=0.002, min_coverage_score=0.7, min_mapq=20, online=True, threads=1):
+def reference_inference(fasta1, fasta2, seqscreen_output, working_directory, databases, min_frac=0.002, min_coverage_score=0.7, min_mapq=20, online=True, threads=1,
+                        keep_depth=False, reference_library=None, streaming=False, sort_memory='768M', sort_threads=None,
+                        ncbi_cache=None, download_threads=4, screen_fraction=None, screen_min_reads=50, screen_seed=11,
+                        competitive=False, compare_stage_1_alignment=False, index_dir=None, ncbi_negative_days=7):
      # TODO, point this path to DB file
     ete3db = os.path.join(databases, "reference_inference", "taxa.sqlite")
     sequences_db_f = os.path.join(databases, "bowtie2", "blacklist.seqs.nt.fna")
     mapping_f = os.path.join(databases, "reference_inference", "taxid2seqid.pickle")
 
-    ncbi_taxa_db = NCBITaxa(dbfile=ete3db)
+    taxonomy = load_taxonomy(ete3db)
+    species_table = load_species_table(taxonomy)
     
     # valid_kingdom = set(bacteria, archaea, viruses, fungi)
     taxid_queries = filter_seqscreen_taxonomy(seqscreen_output, 
                                               min_frac=min_frac, 
-                                              ncbi_taxa_db=ncbi_taxa_db, 
+                                              species_table=species_table, 
                                               valid_kingdom={2, 4751, 2157, 10239})
     
     if not taxid_queries:
         sys.exit(0)
     
     if online:
-        reference_metadata = prepare_reference_genomes(taxid_queries, working_directory, ncbi_taxa_db)
+        reference_metadata = prepare_reference_genomes(taxid_queries, working_directory, taxonomy, ncbi_cache, download_threads,
+                                                       negative_days=ncbi_negative_days)
     else:
-        reference_metadata = prepare_reference_genomes_offline(taxid_queries, working_directory, sequences_db_f, mapping_f, ncbi_taxa_db)
+        reference_metadata = prepare_reference_genomes_offline(taxid_queries, working_directory, sequences_db_f, mapping_f, taxonomy,
+                                                               index_dir=index_dir)
 
     downloaded_assemblies = reference_metadata[reference_metadata['Downloaded']]
     if downloaded_assemblies.empty:
         print("Failed to download any of the assemblies.")
         sys.exit(0)
 
-    for assembly_id in downloaded_assemblies['Assembly Accession ID']:
-        reference_fasta = os.path.join(working_directory, 'reference_genomes', f'{assembly_id}.fasta')
-        run_bwa(fasta1, fasta2, reference_fasta, assembly_id, working_directory, threads=threads)
-        sort_samfile(assembly_id, working_directory, min_mapq, threads)
-        samtools_calculate_depth(assembly_id, working_directory)
+    stage_1_assemblies = list(downloaded_assemblies['Assembly Accession ID'])
+    screening = None
+    if screen_fraction is not None:
+        screening = screen_assemblies(fasta1, fasta2, stage_1_assemblies, working_directory, min_coverage_score, min_mapq, threads,
+                                      screen_fraction, screen_min_reads, screen_seed, reference_library,
+                                      streaming, sort_memory, sort_threads)
+        stage_1_assemblies = list(screening[screening['Promoted']]['Assembly Accession ID'])
+
+    competitive_coverage = None
+    if competitive:
+        competitive_coverage = competitive_alignment(fasta1, fasta2, stage_1_assemblies, working_directory, threads,
+                                                     keep_depth)
+    if not competitive or compare_stage_1_alignment:
+        coverage = align_assemblies(fasta1, fasta2, stage_1_assemblies,
+                                    working_directory, min_mapq, threads, keep_depth, reference_library,
+                                    streaming, sort_memory, sort_threads)
+    else:
+        coverage = dict()
+    if competitive and compare_stage_1_alignment:
+        compare_stage_1(stage_1_assemblies, working_directory, competitive_coverage, coverage, min_coverage_score)
         
-    downloaded_assemblies = alignment_1_summary(downloaded_assemblies, working_directory)
+    downloaded_assemblies = alignment_1_summary(downloaded_assemblies, working_directory, coverage, screening,
+                                                competitive_coverage)
     
     # Filtered the assemblies by coverage score
     filtered_assemblies = list(downloaded_assemblies[downloaded_assemblies['Coverage Score'] >= min_coverage_score]['Assembly Accession ID'])
@@ -707,13 +1448,14 @@ def reference_inference(fasta1, fasta2, seqscreen_output, working_directory, dat
         sys.exit(0)
 
     reference_fasta = merge_reference_fasta(filtered_assemblies, working_directory)
-    run_bwa(fasta1, fasta2, reference_fasta, 'merged', working_directory, threads=threads)
-    sort_samfile('merged', working_directory, min_mapq, threads)
-    samtools_calculate_depth('merged', working_directory)
-
-    downloaded_assemblies = alignment_2_summary(downloaded_assemblies, working_directory)
-    consensus_record_dict = samtools_merged_consensus(working_directory, threads)
-    downloaded_assemblies = ani_summary(downloaded_assemblies, consensus_record_dict, working_directory)
+    # as the combined reference, the merged one is indexed in the working directory
+    align_reads(fasta1, fasta2, reference_fasta, 'merged', working_directory, min_mapq, threads,
+                None, streaming, sort_memory, sort_threads)
+    coverage['merged'] = samtools_calculate_coverage('merged', working_directory, keep_depth)
+
+    downloaded_assemblies = alignment_2_summary(downloaded_assemblies, working_directory, coverage['merged'])
+    consensus_index = samtools_merged_consensus(working_directory, threads)
+    downloaded_assemblies = ani_summary(downloaded_assemblies, consensus_index, working_directory)
     
     downloaded_assemblies = call_present_absent(downloaded_assemblies)
     
@@ -743,6 +1485,36 @@ def main(argv):
     parser.add_argument("--online", action='store_true', help="Use online mode for searching reference genome. Requires internet access.")
     parser.add_argument("-t", "--threads", type=int, default=1,
                         help="Number of threads. [1]")
+    parser.add_argument("--keep-depth", action='store_true',
+                        help="Also write per-position samtools depth files to depth_files (coverage is otherwise kept in memory).")
+    parser.add_argument("--reference-library", type=str, default=None,
+                        help="Shared directory of indexed single-assembly reference genomes, reused across samples.")
+    parser.add_argument("--streaming", action='store_true',
+                        help="Pipe bwa mem through the mapq filter into samtools sort without writing sam files.")
+    parser.add_argument("--sort-memory", type=str, default='768M',
+                        help="Memory per thread for samtools sort with --streaming. [768M]")
+    parser.add_argument("--sort-threads", type=int, default=None,
+                        help="Threads for samtools sort with --streaming. [same as the alignment]")
+    parser.add_argument("--ncbi-cache", type=str, default=None,
+                        help="Directory caching datasets summaries and genome downloads by taxid (online mode), shared across samples.")
+    parser.add_argument("--ncbi-negative-days", type=float, default=7,
+                        help="Days a cached 'genome not found' or failed download is kept before the taxid is queried again. [7]")
+    parser.add_argument("--download-threads", type=int, default=4,
+                        help="Number of taxids resolved and downloaded at once in online mode. [4]")
+    parser.add_argument("--screen-fraction", type=float, default=None,
+                        help="Align this fraction of the reads to every candidate first, and align all reads only to assemblies \
+                        whose coverage score could reach --min-coverage-score.")
+    parser.add_argument("--screen-min-reads", type=int, default=50,
+                        help="Assemblies with fewer subsampled reads mapped are always aligned with all reads. [50]")
+    parser.add_argument("--screen-seed", type=int, default=11,
+                        help="Seed of the read subsample for --screen-fraction. [11]")
+    parser.add_argument("--competitive", action='store_true',
+                        help="Run stage 1 as one alignment against all candidate assemblies (secondary alignments kept) \
+                        instead of one alignment per assembly.")
+    parser.add_argument("--compare-stage-1", action='store_true',
+                        help="With --competitive, also run the per-assembly stage 1 and write stage_1_comparison.csv.")
+    parser.add_argument("--index-dir", type=str, default=None,
+                        help="Directory of the offline sequence index. [next to the database if writable, else $GUTVIROME_CACHE]")
     parser.set_defaults(online=False)
     
     args = parser.parse_args()
@@ -763,7 +1535,11 @@ def main(argv):
         
     online = args.online
     
-    reference_inference(input_fasta_1, input_fasta_2, seqscreen_output, working_directory, database, min_frac, min_cov, min_mapq, online, threads)
+    reference_inference(input_fasta_1, input_fasta_2, seqscreen_output, working_directory, database, min_frac, min_cov, min_mapq, online, threads,
+                        args.keep_depth, args.reference_library, args.streaming, args.sort_memory,
+                        args.sort_threads, args.ncbi_cache, args.download_threads, args.screen_fraction,
+                        args.screen_min_reads, args.screen_seed, args.competitive, args.compare_stage_1, args.index_dir,
+                        args.ncbi_negative_days)
     
 
 if __name__ == "__main__":
@@ -6,6 +6,8 @@ from Bio import SeqIO
 import os
 import glob
 import subprocess
+from compression import open_file, is_gzipped, strip_ext
+from merge_results import SPLIT_DIR
 
 
 
@@ -30,28 +32,54 @@ def batch_iterator(iterator, batch_size):
         if batch:
             yield batch
 
-def split_files(ffile: str, chunks:int, out_dir:str):
+def split_files(ffile: str, chunks:int, out_dir:str, compress:bool=None, threads:int=4):
     """Splits files into n chunks
 
     Args:
-        ffile (str): fasta file to split
+        ffile (str): fasta file to split (.fasta or .fasta.gz)
         chunks (int): number of chunks to split file into
+        compress (bool, optional): write .gz chunks (bgzf if bgzip is installed). Defaults to compressing if ffile is.
+        threads (int, optional): number of (de)compression threads. Defaults to 4.
     """
-    nseq = len([1 for line in open(ffile) if line.startswith(">")])
+    if compress is None:
+        compress = is_gzipped(ffile)
+
+    with open_file(ffile, threads=threads) as handle:
+        nseq = sum(1 for line in handle if line.startswith(">"))
     chunksize=math.ceil(nseq/int(chunks))
     print("Splitting fasta file of", nseq, "sequences into chunks of size", chunksize)
 
-    records = SeqIO.parse(open(ffile), "fasta")
+    in_handle = open_file(ffile, threads=threads)
+    records = SeqIO.parse(in_handle, "fasta")
+    output_name = ffile.split('/')[-1].split(".fasta")[0]
+    ext = ".fasta.gz" if compress else ".fasta"
+    manifest = []
     for i, batch in enumerate(batch_iterator(records, chunksize)):
-        output_name = ffile.split('/')[-1].split(".fasta")[0]
-        filename = f"{output_name}_{i+1}.fasta"
+        filename = f"{output_name}_{i+1}{ext}"
         out_loc = os.path.join(out_dir, filename)
+        manifest.append((i+1, filename, len(batch)))
         if not os.path.exists(out_loc):
-            with open(filename, "w") as handle:
+            with open_file(filename, "w", threads=threads) as handle:
                 count = SeqIO.write(batch, handle, "fasta")
             print(f"Wrote {count} sequences to {filename}")
             
             subprocess.run(['mv', filename, out_loc], check=True)
+    in_handle.close()
+
+    write_manifest(manifest, os.path.join(out_dir, f"{output_name}.manifest.tsv"))
+
+
+def write_manifest(manifest:list, manifest_loc:str):
+    """Writes the chunk manifest used by merge_results.py to validate split outputs
+
+    Args:
+        manifest (list): (chunk index, chunk filename, number of sequences) for each chunk
+        manifest_loc (str): location of manifest file
+    """
+    with open(manifest_loc, "w") as handle:
+        handle.write("chunk\tfile\tsequences\n")
+        for chunk, filename, count in manifest:
+            handle.write(f"{chunk}\t{filename}\t{count}\n")
         
 
 
@@ -61,35 +89,39 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Splits fasta file into n equivalent chunks")
     parser.add_argument('pipeline', type=str, help="Pipeline location")
     parser.add_argument('n', type=int, help="Number of chunks to split each fasta file into")
+    parser.add_argument('--compress', action='store_true', default=None, help="Write .gz chunks, bgzf if bgzip is installed (always done for .gz inputs)")
 
     args = parser.parse_args()
     pipeline = args.pipeline
     n = args.n
+    compress = args.compress
 
     fasta_dir = os.path.join(pipeline, 'fasta-split')
-    outdir = os.path.join(pipeline, 'fasta-split/fasta-split-slow')
+    outdir = os.path.join(pipeline, SPLIT_DIR)
 
     # files_r1 = glob.glob(f'{fasta_dir}/*1.fasta')
     # files_r2 = glob.glob(f'{fasta_dir}/*2.fasta')
     # files = set(files_r1 + files_r2)
     
-    files = glob.glob(f'{fasta_dir}/*.fasta')
+    files = glob.glob(f'{fasta_dir}/*.fasta') + glob.glob(f'{fasta_dir}/*.fasta.gz')
     
     to_split = ['2305_P71-69764_stool_virome_CACTI_Microbiome12_R2_8.fasta',
                 '2306_Pntc-00003_stool_virome_CACTI_Microbiome15_R1_1.fasta',
                 '2306_Pntc-00003_stool_virome_CACTI_Microbiome15_R1_5.fasta',
                 '2309_P153-01219_stool_virome_CACTI_Microbiome26_R2_4.fasta',
                 '2309_P164-01251_stool_virome_CACTI_Microbiome28_R2_2.fasta']
-    files = [file for file in files if file.split('/')[-1] in to_split]
+    ## names are matched without .gz so compressed inputs are split as well
+    to_split = [strip_ext(name, '.fasta') for name in to_split]
+    files = [file for file in files if strip_ext(file.split('/')[-1], '.fasta') in to_split]
     print(files)
     
     for file in files:
         output_name = file.split("/")[-1].split('.fasta')[0]
         filename = f"{output_name}_1.fasta"
         out_loc = os.path.join(outdir, filename)
-        if not os.path.exists(out_loc):
+        if not (os.path.exists(out_loc) or os.path.exists(f'{out_loc}.gz')):
             print(out_loc)
-            split_files(file, n, outdir)
+            split_files(file, n, outdir, compress)
             
     # single_end_files = set(glob.glob(f'{fasta_dir}/*.fasta')) - files    
     # for file in single_end_files:
@@ -3,14 +3,33 @@
 import argparse
 import os
 import glob
-import subprocess
+import numpy as np
+import pandas as pd
+from taxonomy_service import connect_taxonomy
+
+
+def add_lineage(report:str, output:str, taxonomy):
+    """Appends the lineage and lineage ranks of the taxid column (3rd) of a report, as taxonkit lineage -R
+
+    Args:
+        report (str): seqscreen report (tsv)
+        output (str): output tsv
+        taxonomy (Taxonomy): compiled taxonomy
+    """
+    data = pd.read_csv(report, sep='\t', dtype=str, keep_default_na=False)
+    taxids = pd.to_numeric(data.iloc[:, 2], errors='coerce').fillna(0).astype(np.int64)
+    lineage, ranks = taxonomy.lineage_strings(taxids)
+    data['lineage'] = lineage.values
+    data['lineage_ranks'] = ranks.values
+    data.to_csv(f'{output}.tmp', sep='\t', index=False)
+    os.replace(f'{output}.tmp', output)
 
 def run_taxonkit(pipeline:str, database:str, sensitive:bool, split_files:bool=False):
     """Runs taxonkit on all pipeline files
 
     Args:
         pipeline (str): pipeline file locations
-        database (str): database for taxonkit
+        database (str): taxonkit data directory (compiled once with taxonomy.py)
         sensitive (bool): process sensitive output instead 
         split_files (bool): processes merged split files instead
     """
@@ -28,20 +47,14 @@ def run_taxonkit(pipeline:str, database:str, sensitive:bool, split_files:bool=Fa
         taxonkit_dir = os.path.join(pipeline, 'taxonkit', 'fast', 'final')
     
     print(reports)
+    taxonomy = connect_taxonomy(database)
     for i, report in enumerate(reports):
         out_name = report.split("/")[-1]
         output = os.path.join(taxonkit_dir, out_name)
         
         if not os.path.exists(output):
             print(f'[{i+1}] {report}')
-            subprocess.run([
-                'taxonkit', 'lineage',
-                report,
-                '-i', '3',
-                '--data-dir', database,
-                '-o', output,
-                '-R'
-            ], check=True)
+            add_lineage(report, output, taxonomy)
 
 
 
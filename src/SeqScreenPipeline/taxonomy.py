@@ -0,0 +1,339 @@
+"""
+Compact taxonomy store: the NCBI taxonomy (taxonkit nodes.dmp/names.dmp or an ete3 taxa.sqlite)
+compiled once into flat arrays in a single memory mapped file, with lineage, rank, LCA and
+name lookups shared by every stage
+"""
+import argparse
+import os
+import json
+import fcntl
+import mmap
+import sqlite3
+import struct
+import numpy as np
+import pandas as pd
+from compression import CACHE_DIR, writable_dir, cache_name
+
+MAGIC = b'GVTAX001'
+ALIGNMENT = 64
+
+
+def read_dmp(path:str):
+    '''Yields the fields of each line of a taxdump .dmp file'''
+    with open(path, 'r') as handle:
+        for line in handle:
+            yield line.rstrip('\n').rstrip('\t|').split('\t|\t')
+
+
+def read_taxdump(data_dir:str):
+    """Reads nodes, scientific names and merged taxids of a taxdump directory
+
+    Returns:
+        (list, dict, list): (taxid, parent, rank) nodes, taxid -> name, (old, new) merged taxids
+    """
+    nodes = [(int(fields[0]), int(fields[1]), fields[2]) for fields in read_dmp(os.path.join(data_dir, 'nodes.dmp'))]
+    names = {int(fields[0]): fields[1] for fields in read_dmp(os.path.join(data_dir, 'names.dmp'))
+             if fields[3] == 'scientific name'}
+    merged = []
+    if os.path.exists(os.path.join(data_dir, 'merged.dmp')):
+        merged = [(int(fields[0]), int(fields[1])) for fields in read_dmp(os.path.join(data_dir, 'merged.dmp'))]
+    return nodes, names, merged
+
+
+def read_ete3(ete3db:str):
+    '''Reads nodes, names and merged taxids of an ete3 taxa.sqlite (see read_taxdump)'''
+    with sqlite3.connect(ete3db) as db:
+        rows = db.execute('SELECT taxid, parent, rank, spname FROM species').fetchall()
+        merged = db.execute('SELECT taxid_old, taxid_new FROM merged').fetchall()
+    ## the root has no parent in ete3
+    nodes = [(taxid, parent if parent != '' else taxid, rank) for taxid, parent, rank, _ in rows]
+    names = {taxid: name for taxid, _, _, name in rows}
+    return nodes, names, merged
+
+
+def source_files(source:str):
+    '''Files the store of a taxdump directory or ete3 database is compiled from'''
+    if os.path.isdir(source):
+        return [os.path.join(source, name) for name in ('nodes.dmp', 'names.dmp', 'merged.dmp')
+                if os.path.exists(os.path.join(source, name))]
+    return [source]
+
+
+def store_outdated(source:str, store:str):
+    '''True if the store does not exist or is older than the files it is compiled from'''
+    return not os.path.exists(store) or any(os.path.getmtime(file) > os.path.getmtime(store)
+                                            for file in source_files(source))
+
+
+def default_store(source:str):
+    '''[data dir]/taxonomy.bin or [taxa.sqlite].taxonomy.bin, or a file in $TAXONOMY_STORE_DIR if set
+    (or in $GUTVIROME_CACHE/taxonomy if the data directory is read-only)'''
+    store_dir = os.environ.get('TAXONOMY_STORE_DIR')
+    if store_dir is None:
+        store = os.path.join(source, 'taxonomy.bin') if os.path.isdir(source) else f'{source}.taxonomy.bin'
+        if not store_outdated(source, store):
+            return store
+        store_dir = writable_dir(os.path.dirname(store), os.path.join(CACHE_DIR, 'taxonomy'))
+        if store_dir == os.path.dirname(store):
+            return store
+    os.makedirs(store_dir, exist_ok=True)
+    return os.path.join(store_dir, f'{cache_name(os.path.normpath(source))}.taxonomy.bin')
+
+
+def build_taxonomy(source:str, store:str=None):
+    """Compiles the taxonomy into one file of flat arrays indexed by taxid (a json header, then the
+    parent, rank, depth, merged alias and scientific name arrays)
+
+    Args:
+        source (str): taxonkit data directory (nodes.dmp, names.dmp, merged.dmp) or ete3 taxa.sqlite
+        store (str, optional): output file. Defaults to default_store(source).
+    """
+    if store is None:
+        store = default_store(source)
+    nodes, names, merged = read_taxdump(source) if os.path.isdir(source) else read_ete3(source)
+
+    taxids = np.array([node[0] for node in nodes], dtype=np.int64)
+    size = int(max(taxids.max(initial=0), max((old for old, _ in merged), default=0))) + 1
+
+    up = np.arange(size, dtype=np.int64)
+    up[taxids] = [node[1] for node in nodes]
+    parent = np.zeros(size, dtype=np.int32)
+    parent[taxids] = up[taxids]
+
+    rank_names = sorted({node[2] for node in nodes})
+    rank_codes = {rank: code for code, rank in enumerate(rank_names)}
+    rank = np.zeros(size, dtype=np.uint8)
+    rank[taxids] = [rank_codes[node[2]] for node in nodes]
+
+    ## pointer jumping: distance to the root, which is its own parent
+    depth = (up != np.arange(size)).astype(np.int64)
+    while True:
+        depth = depth + depth[up]
+        next_up = up[up]
+        if np.array_equal(next_up, up):
+            break
+        up = next_up
+
+    alias = np.zeros(size, dtype=np.int32)
+    alias[taxids] = taxids
+    for old, new in merged:
+        if new < size and alias[new] == new:
+            alias[old] = new
+
+    encoded = [b''] * size
+    for taxid, name in names.items():
+        encoded[taxid] = name.encode()
+    name_offsets = np.zeros(size + 1, dtype=np.int64)
+    name_offsets[1:] = np.cumsum([len(name) for name in encoded])
+    name_blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    arrays = {'parent': parent, 'rank': rank, 'depth': depth.astype(np.uint16), 'alias': alias,
+              'name_offsets': name_offsets, 'names': name_blob}
+    layout = {}
+    offset = 0
+    for key, array in arrays.items():
+        layout[key] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({'ranks': rank_names, 'arrays': layout}).encode()
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(f'{store}.tmp', 'wb') as handle:
+        handle.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for key, array in arrays.items():
+            handle.seek(data_start + layout[key]['offset'])
+            handle.write(array.tobytes())
+        handle.truncate(data_start + offset)
+    os.replace(f'{store}.tmp', store)
+    print(f'Compiled {len(nodes)} taxa ({len(merged)} merged) into {store}')
+
+
+class Taxonomy:
+    '''Read-only view of a compiled taxonomy store; the arrays are backed by a shared memory map'''
+    def __init__(self, store:str):
+        with open(store, 'rb') as handle:
+            self.buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{store} is not a compiled taxonomy')
+        header_size, = struct.unpack('<Q', self.buffer[len(MAGIC):len(MAGIC) + 8])
+        header = json.loads(self.buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_size])
+        data_start = -(-(len(MAGIC) + 8 + header_size) // ALIGNMENT) * ALIGNMENT
+
+        arrays = {}
+        for key, layout in header['arrays'].items():
+            dtype = np.dtype(layout['dtype'])
+            count = int(np.prod(layout['shape']))
+            arrays[key] = np.frombuffer(self.buffer, dtype=dtype, count=count,
+                                        offset=data_start + layout['offset']).reshape(layout['shape'])
+        self.store = store
+        self.rank_names = header['ranks']
+        self.parent = arrays['parent']
+        self.rank_code = arrays['rank']
+        self.depth = arrays['depth']
+        self.alias = arrays['alias']
+        self.name_offsets = arrays['name_offsets']
+        self.names_blob = arrays['names']
+
+    def __reduce__(self):
+        ## worker processes reopen the store, sharing its pages instead of copying the arrays
+        return (Taxonomy, (self.store,))
+
+    def __len__(self):
+        return len(self.parent)
+
+    def resolve(self, taxids):
+        '''Current taxids (merged taxids translated, 0 for unknown or invalid taxids)'''
+        taxids = np.asarray(taxids, dtype=np.int64)
+        known = (taxids > 0) & (taxids < len(self.alias))
+        return np.where(known, self.alias[np.where(known, taxids, 0)], 0).astype(np.int64)
+
+    def rank(self, taxid:int):
+        '''Rank name of a taxid, None if unknown'''
+        taxid = int(self.resolve(taxid))
+        return self.rank_names[self.rank_code[taxid]] if taxid else None
+
+    def name(self, taxid:int):
+        '''Scientific name of a taxid, None if unknown'''
+        taxid = int(self.resolve(taxid))
+        if not taxid:
+            return None
+        return bytes(self.names_blob[self.name_offsets[taxid]:self.name_offsets[taxid + 1]]).decode()
+
+    def lineage(self, taxid:int):
+        '''Taxids from the root down to the taxid (as ete3 get_lineage), empty if unknown'''
+        taxid = int(self.resolve(taxid))
+        if not taxid:
+            return []
+        lineage = [taxid]
+        while self.parent[taxid] != taxid:
+            taxid = int(self.parent[taxid])
+            lineage.append(taxid)
+        return lineage[::-1]
+
+    def lca_pairs(self, first, second):
+        '''Lowest common ancestors of two taxid arrays, element wise (unknown taxids are ignored, 0 if both are)'''
+        first = self.resolve(first)
+        second = self.resolve(second)
+        first, second = np.where(first == 0, second, first), np.where(second == 0, first, second)
+        ## lift the deeper taxid to the same depth, then both until they meet
+        while True:
+            first_depth, second_depth = self.depth[first], self.depth[second]
+            if not np.any(first_depth != second_depth):
+                break
+            first = np.where(first_depth > second_depth, self.parent[first], first)
+            second = np.where(second_depth > first_depth, self.parent[second], second)
+        while np.any(first != second):
+            differ = first != second
+            first = np.where(differ, self.parent[first], first)
+            second = np.where(differ, self.parent[second], second)
+        return first
+
+    def lca(self, taxids):
+        '''Lowest common ancestor of a list of taxids (unknown taxids are ignored, 0 if none known)'''
+        result = np.zeros(1, dtype=np.int64)
+        for taxid in taxids:
+            result = self.lca_pairs(result, [taxid])
+        return int(result[0])
+
+    def lca_strings(self, values, sep:str=','):
+        """Lowest common ancestor of each separated list of taxids (as taxonkit lca, non-taxid entries ignored)
+
+        Args:
+            values (pd.Series): separated taxid lists
+            sep (str, optional): separator. Defaults to ','.
+
+        Returns:
+            pd.Series: lca taxid of each list (same index), NaN where no taxid was known
+        """
+        taxids = values.reset_index(drop=True).astype(str).str.split(sep).explode()
+        valid = taxids.str.fullmatch(r'\s*\d+(\.0*)?\s*').fillna(False).astype(bool)
+        rows = taxids.index.to_numpy(dtype=np.int64)
+        taxids = self.resolve(pd.to_numeric(taxids.where(valid), errors='coerce').fillna(0).to_numpy(dtype=np.int64))
+
+        ## fold the k-th taxid of every list into its running lca
+        positions = pd.Series(rows).groupby(rows).cumcount().to_numpy()
+        result = np.zeros(len(values), dtype=np.int64)
+        for k in range(int(positions.max(initial=-1)) + 1):
+            at = positions == k
+            result[rows[at]] = self.lca_pairs(result[rows[at]], taxids[at])
+        return pd.Series(np.where(result > 0, result, np.nan), index=values.index)
+
+    def ancestors_at_rank(self, taxids, rank:str):
+        '''Ancestor-or-self of each taxid at a rank (0 if unknown or there is none)'''
+        current = self.resolve(taxids)
+        if rank not in self.rank_names:
+            return np.zeros_like(current)
+        code = self.rank_names.index(rank)
+        found = np.zeros_like(current)
+        for _ in range(int(self.depth.max(initial=0)) + 1):
+            hit = (found == 0) & (current != 0) & (self.rank_code[current] == code)
+            found[hit] = current[hit]
+            current = self.parent[current].astype(np.int64)
+        return found
+
+    def lineage_strings(self, taxids):
+        """taxonkit lineage style names and ranks of each taxid (root excluded, ';' separated)
+
+        Returns:
+            (pd.Series, pd.Series): lineage names and lineage ranks, NaN for unknown taxids
+        """
+        taxids = pd.Series(self.resolve(taxids))
+        cache = {0: (np.nan, np.nan)}
+        for taxid in taxids.unique():
+            if taxid not in cache:
+                ## the root itself is named, as in taxonkit
+                lineage = self.lineage(taxid)[1:] or self.lineage(taxid)
+                cache[taxid] = (';'.join(self.name(node) for node in lineage),
+                                ';'.join(self.rank(node) for node in lineage))
+        return taxids.map(lambda taxid: cache[taxid][0]), taxids.map(lambda taxid: cache[taxid][1])
+
+
+def load_taxonomy(source:str, store:str=None):
+    """Opens the compiled taxonomy of a source, compiling it first (once, under a lock) if it is
+    missing or older than the source files
+
+    Args:
+        source (str): taxonkit data directory or ete3 taxa.sqlite
+        store (str, optional): compiled file. Defaults to default_store(source).
+
+    Returns:
+        Taxonomy: memory mapped taxonomy
+    """
+    if store is None:
+        store = default_store(source)
+    if store_outdated(source, store):
+        with open(f'{store}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if store_outdated(source, store):
+                build_taxonomy(source, store)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return Taxonomy(store)
+
+
+def parse_args():
+    """Parses arguments for compiling / querying the taxonomy
+    """
+    parser = argparse.ArgumentParser(description='Compiles the taxonomy into a memory mapped store and queries it')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help='Compile a taxonkit data directory or ete3 taxa.sqlite')
+    build.add_argument('source', type=str, help='Taxonkit data directory (nodes.dmp, names.dmp) or ete3 taxa.sqlite')
+    build.add_argument('-o', '--output', type=str, default=None,
+                       help='Compiled file (defaults to [data dir]/taxonomy.bin or [taxa.sqlite].taxonomy.bin, '
+                            'in $TAXONOMY_STORE_DIR or the cache directory if set or read-only)')
+
+    query = subparsers.add_parser('query', help='Print lineage, rank and name of taxids and their lca')
+    query.add_argument('source', type=str, help='Taxonkit data directory or ete3 taxa.sqlite')
+    query.add_argument('--store', type=str, default=None, help='Compiled file [see build -o]')
+    query.add_argument('taxids', type=int, nargs='+', help='Taxids')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        build_taxonomy(args.source, args.output)
+    else:
+        taxonomy = load_taxonomy(args.source, args.store)
+        for taxid in args.taxids:
+            print(f'{taxid}\t{taxonomy.name(taxid)}\t{taxonomy.rank(taxid)}\t{";".join(map(str, taxonomy.lineage(taxid)))}')
+        print(f'lca\t{taxonomy.lca(args.taxids)}')
+
+if __name__=='__main__':
+    parse_args()
@@ -0,0 +1,267 @@
+"""
+Optional node-local taxonomy daemon: holds the compiled taxonomy (taxonomy.py) in one process
+and answers batched lineage/LCA/name queries over a Unix domain socket, so concurrent stage
+workers on a node do not each open the taxonomy
+"""
+import argparse
+import os
+import json
+import socket
+import socketserver
+import struct
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from taxonomy import Taxonomy, load_taxonomy, default_store
+
+SOCKET_PATH = os.environ.get('TAXONOMY_SOCKET', os.path.join(tempfile.gettempdir(), f'taxonomy-{os.getuid()}.sock'))
+
+
+def recv_exact(sock, size:int):
+    '''Reads exactly size bytes from a socket'''
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('taxonomy socket closed')
+        data += chunk
+    return bytes(data)
+
+
+def send_message(sock, header:dict, arrays:list=()):
+    '''Sends the header length, a json header (with the array lengths in 'sizes') and the raw int64 arrays'''
+    arrays = [np.ascontiguousarray(array, dtype=np.int64) for array in arrays]
+    header = dict(header, sizes=[len(array) for array in arrays])
+    encoded = json.dumps(header).encode()
+    sock.sendall(b''.join([struct.pack('<Q', len(encoded)), encoded] + [array.tobytes() for array in arrays]))
+
+
+def recv_message(sock):
+    '''Receives a message sent with send_message, returns (header, arrays)'''
+    size, = struct.unpack('<Q', recv_exact(sock, 8))
+    header = json.loads(recv_exact(sock, size))
+    arrays = [np.frombuffer(recv_exact(sock, 8 * length), dtype=np.int64) for length in header['sizes']]
+    return header, arrays
+
+
+def nan_to_none(values):
+    '''NaN -> None so lists can be sent as json'''
+    return [None if isinstance(value, float) else value for value in values]
+
+
+def answer(taxonomy:Taxonomy, header:dict, arrays:list):
+    '''Runs one batched query against the taxonomy, returns the (header, arrays) of the reply'''
+    op = header['op']
+    if op == 'info':
+        return {'store': os.path.realpath(taxonomy.store)}, []
+    if op == 'resolve':
+        return {}, [taxonomy.resolve(arrays[0])]
+    if op == 'lca_pairs':
+        return {}, [taxonomy.lca_pairs(arrays[0], arrays[1])]
+    if op == 'ancestors_at_rank':
+        return {}, [taxonomy.ancestors_at_rank(arrays[0], header['rank'])]
+    if op == 'lineages':
+        return {'values': [taxonomy.lineage(taxid) for taxid in arrays[0]]}, []
+    if op == 'names':
+        return {'values': [taxonomy.name(taxid) for taxid in arrays[0]]}, []
+    if op == 'ranks':
+        return {'values': [taxonomy.rank(taxid) for taxid in arrays[0]]}, []
+    if op == 'lineage_strings':
+        lineage, ranks = taxonomy.lineage_strings(arrays[0])
+        return {'values': [nan_to_none(lineage.tolist()), nan_to_none(ranks.tolist())]}, []
+    raise ValueError(f'unknown taxonomy query {op}')
+
+
+class TaxonomyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Unix socket server answering taxonomy queries, one thread per connected client'''
+    daemon_threads = True
+
+    def __init__(self, socket_path:str, taxonomy:Taxonomy):
+        self.taxonomy = taxonomy
+        super().__init__(socket_path, TaxonomyHandler)
+
+
+class TaxonomyHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, arrays = recv_message(self.request)
+            except ConnectionError:
+                return
+            try:
+                reply, reply_arrays = answer(self.server.taxonomy, header, arrays)
+            except Exception as err:
+                reply, reply_arrays = {'error': str(err)}, []
+            send_message(self.request, reply, reply_arrays)
+
+
+def serve(source:str, socket_path:str=SOCKET_PATH, store:str=None):
+    """Runs the taxonomy daemon until interrupted
+
+    Args:
+        source (str): taxonkit data directory or ete3 taxa.sqlite
+        socket_path (str, optional): Unix socket. Defaults to $TAXONOMY_SOCKET or $TMPDIR/taxonomy-[uid].sock.
+        store (str, optional): compiled taxonomy. Defaults to default_store(source).
+    """
+    taxonomy = load_taxonomy(source, store)
+    ## a socket left by a daemon that died is removed, a live one is not replaced
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+            raise RuntimeError(f'A taxonomy daemon is already listening on {socket_path}')
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(socket_path)
+
+    with TaxonomyServer(socket_path, taxonomy) as server:
+        os.chmod(socket_path, 0o600)
+        print(f'Serving {taxonomy.store} on {socket_path}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+
+class RemoteTaxonomy:
+    '''Client of the taxonomy daemon with the query methods of Taxonomy'''
+    def __init__(self, socket_path:str=SOCKET_PATH):
+        self.socket_path = socket_path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.store = self.query('info')[0]['store']
+
+    def __reduce__(self):
+        ## worker processes open their own connection
+        return (RemoteTaxonomy, (self.socket_path,))
+
+    def close(self):
+        self.sock.close()
+
+    def query(self, op:str, arrays:list=(), **params):
+        send_message(self.sock, dict(params, op=op), arrays)
+        header, arrays = recv_message(self.sock)
+        if 'error' in header:
+            raise ValueError(header['error'])
+        return header, arrays
+
+    def resolve(self, taxids):
+        return self.query('resolve', [np.atleast_1d(taxids)])[1][0].reshape(np.shape(taxids))
+
+    def lca_pairs(self, first, second):
+        first, second = np.broadcast_arrays(np.asarray(first, dtype=np.int64), np.asarray(second, dtype=np.int64))
+        return self.query('lca_pairs', [first.ravel(), second.ravel()])[1][0].reshape(first.shape)
+
+    def ancestors_at_rank(self, taxids, rank:str):
+        return self.query('ancestors_at_rank', [np.atleast_1d(taxids)], rank=rank)[1][0].reshape(np.shape(taxids))
+
+    def lineage(self, taxid:int):
+        return self.query('lineages', [[taxid]])[0]['values'][0]
+
+    def name(self, taxid:int):
+        return self.query('names', [[taxid]])[0]['values'][0]
+
+    def rank(self, taxid:int):
+        return self.query('ranks', [[taxid]])[0]['values'][0]
+
+    def names(self, taxids):
+        return self.query('names', [np.atleast_1d(taxids)])[0]['values']
+
+    def lineage_strings(self, taxids):
+        lineage, ranks = self.query('lineage_strings', [np.atleast_1d(taxids)])[0]['values']
+        return pd.Series(lineage).fillna(np.nan), pd.Series(ranks).fillna(np.nan)
+
+    ## built from resolve/lca_pairs, one round trip per taxid position
+    lca = Taxonomy.lca
+    lca_strings = Taxonomy.lca_strings
+
+
+def connect_taxonomy(source:str, socket_path:str=SOCKET_PATH, store:str=None):
+    """Taxonomy of a source from the node's daemon if one serves it, else opened in-process
+
+    Args:
+        source (str): taxonkit data directory or ete3 taxa.sqlite
+        socket_path (str, optional): daemon socket. Defaults to $TAXONOMY_SOCKET or $TMPDIR/taxonomy-[uid].sock.
+        store (str, optional): compiled taxonomy. Defaults to default_store(source).
+
+    Returns:
+        RemoteTaxonomy or Taxonomy: object with the Taxonomy query methods
+    """
+    if os.path.exists(socket_path):
+        try:
+            remote = RemoteTaxonomy(socket_path)
+            if remote.store == os.path.realpath(store or default_store(source)):
+                return remote
+            remote.close()
+        except (OSError, ValueError):
+            pass
+    return load_taxonomy(source, store)
+
+
+def benchmark(source:str, batch_sizes:list, queries:int=200000, socket_path:str=SOCKET_PATH, seed:int=0):
+    """Prints query throughput of lca and lineage lookups per batch size, in-process and through the daemon
+
+    Args:
+        source (str): taxonkit data directory or ete3 taxa.sqlite
+        batch_sizes (list): taxids per request
+        queries (int, optional): taxids queried per batch size. Defaults to 200000.
+        socket_path (str, optional): daemon socket. Defaults to $TAXONOMY_SOCKET or $TMPDIR/taxonomy-[uid].sock.
+        seed (int, optional): seed of the random taxids. Defaults to 0.
+    """
+    start = time.perf_counter()
+    local = load_taxonomy(source)
+    print(f'in-process open: {1000 * (time.perf_counter() - start):.2f} ms')
+    backends = [('in-process', local)]
+    try:
+        start = time.perf_counter()
+        backends.append(('daemon', RemoteTaxonomy(socket_path)))
+        print(f'daemon connect: {1000 * (time.perf_counter() - start):.2f} ms')
+    except OSError:
+        print(f'No taxonomy daemon on {socket_path}, benchmarking in-process lookups only')
+
+    rng = np.random.default_rng(seed)
+    known = np.flatnonzero(np.asarray(local.alias))
+    first, second = rng.choice(known, queries), rng.choice(known, queries)
+
+    print('backend\tquery\tbatch_size\tqueries_per_second')
+    for name, taxonomy in backends:
+        for batch_size in batch_sizes:
+            ## lineage strings are slower, so fewer of them are queried
+            for query, count in (('lca_pairs', queries), ('lineage_strings', max(batch_size, queries // 20))):
+                start = time.perf_counter()
+                for i in range(0, count, batch_size):
+                    if query == 'lca_pairs':
+                        taxonomy.lca_pairs(first[i:i + batch_size], second[i:i + batch_size])
+                    else:
+                        taxonomy.lineage_strings(first[i:i + batch_size])
+                print(f'{name}\t{query}\t{batch_size}\t{count / (time.perf_counter() - start):.0f}')
+
+
+def parse_args():
+    """Parses arguments for running / benchmarking the taxonomy daemon
+    """
+    parser = argparse.ArgumentParser(description='Node-local taxonomy daemon answering lineage/LCA/name queries over a Unix socket')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the daemon (until interrupted)')
+    serve_parser.add_argument('source', type=str, help='Taxonkit data directory or ete3 taxa.sqlite')
+    serve_parser.add_argument('--socket', type=str, default=SOCKET_PATH, help=f'Unix socket [{SOCKET_PATH}]')
+    serve_parser.add_argument('--store', type=str, default=None, help='Compiled taxonomy [see taxonomy.py build -o]')
+
+    bench = subparsers.add_parser('benchmark', help='Throughput of batched queries, in-process and through the daemon')
+    bench.add_argument('source', type=str, help='Taxonkit data directory or ete3 taxa.sqlite')
+    bench.add_argument('--socket', type=str, default=SOCKET_PATH, help=f'Unix socket [{SOCKET_PATH}]')
+    bench.add_argument('--batch-sizes', type=str, default='1,10,100,1000,10000,100000',
+                       help='Comma separated taxids per request')
+    bench.add_argument('--queries', type=int, default=200000, help='Taxids queried per batch size')
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.source, args.socket, args.store)
+    else:
+        benchmark(args.source, [int(size) for size in args.batch_sizes.split(',')], args.queries, args.socket)
+
+if __name__=='__main__':
+    parse_args()
@@ -1,35 +1,117 @@
 """
 Generates csv file of overview stats for a fastq file or directory of fastq files
+(run from src as python -m util.fastq_stats)
 """
 import argparse
 import os
-import gzip
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
-from Bio import SeqIO
+from SeqScreenPipeline.compression import open_file, BUFFER_SIZE
 
+PHRED_OFFSET = 33
+OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'output')
 
 
-def get_info(fastq:os.path, zipped:bool):
-    """Gets basic information about fastq file and prints report
+def add_histogram(total:np.ndarray, counts:np.ndarray):
+    '''Adds two bincount histograms of possibly different lengths'''
+    if len(counts) > len(total):
+        total, counts = counts, total
+    total[:len(counts)] += counts
+    return total
+
+
+def get_info(fastq:os.path):
+    """Gets basic information about fastq file (counted with numpy in ~16MB batches) and prints report
 
     Args:
-        fastq (os.path): path to fastq file
-        zipped (bool): .gz file or directory
+        fastq (os.path): path to fastq file (.fastq or .fastq.gz)
+
+    Returns:
+        (dict, np.ndarray): summary statistics, read length histogram
     """
-    if zipped:
-        with gzip.open(fastq, "rt") as file:
-            records = list(SeqIO.parse(file, "fastq"))
-            num_reads = len(records)
-    else:
-        records = list(SeqIO.parse(fastq, "fastq"))
-        num_reads = len(records)
+    num_reads = 0
+    lengths = np.zeros(1, dtype=np.int64)
+    bases = np.zeros(256, dtype=np.int64)
+    qualities = np.zeros(256, dtype=np.int64)
+    carry = []
+
+    ## closing the handle raises if the decompressor failed (truncated or corrupt .gz)
+    with open_file(fastq, 'rb', threads=4) as handle:
+        for lines in iter(lambda: handle.readlines(BUFFER_SIZE), []):
+            if not lines[-1].endswith(b'\n'):
+                lines[-1] += b'\n'
+            lines = carry + lines
+            n = len(lines) - len(lines) % 4
+            carry = lines[n:]
+            seqs = lines[1:n:4]
+
+            ## every sequence line ends with a newline, so its length is one less
+            read_lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)) - 1
+            lengths = add_histogram(lengths, np.bincount(read_lengths))
+            bases += np.bincount(np.frombuffer(b''.join(seqs), dtype=np.uint8), minlength=256)
+            qualities += np.bincount(np.frombuffer(b''.join(lines[3:n:4]), dtype=np.uint8), minlength=256)
+            num_reads += len(seqs)
+    if carry:
+        raise ValueError(f'Truncated fastq record at end of {fastq}')
+
+    total_bases = int(np.dot(np.arange(len(lengths)), lengths))
+    gc = sum(int(bases[ord(base)]) for base in 'GCgc')
+    quality = qualities[PHRED_OFFSET:]
+    num_quality = int(quality.sum())
+    present = np.nonzero(lengths)[0]
+
     name = fastq.split('/')[-1]
+    stats = {'Sample': name,
+             'NumberReads': num_reads,
+             'TotalBases': total_bases,
+             'MeanLength': total_bases / num_reads if num_reads else np.nan,
+             'MinLength': int(present[0]) if num_reads else np.nan,
+             'MaxLength': int(present[-1]) if num_reads else np.nan,
+             'GC': gc / total_bases if total_bases else np.nan,
+             'MeanQuality': np.dot(np.arange(len(quality)), quality) / num_quality if num_quality else np.nan,
+             'Q30': quality[30:].sum() / num_quality if num_quality else np.nan}
+
     print(f'\nBASIC STATISTICS FOR {name}:')
     print(f'Number of Reads: {num_reads}')
+    print(f'Total Bases: {total_bases}')
+    print(f'GC: {stats["GC"]:.4f}, Mean Quality: {stats["MeanQuality"]:.2f}')
+
+    return stats, lengths
+
+
+def fastq_overview(files:list, output_dir:str=OUTPUT_DIR, output:str='fastq_overview', processes:int=1):
+    """Gets the statistics of fastq files in parallel and writes [output].csv and [output]_lengths.csv
+
+    Args:
+        files (list): fastq files
+        output_dir (str, optional): output directory. Defaults to data/output of the repository.
+        output (str, optional): name of output files. Defaults to 'fastq_overview'.
+        processes (int, optional): number of files processed at once. Defaults to 1.
+
+    Returns:
+        pd.DataFrame: statistics of each file
+    """
+    with mp.Pool(processes) as pool:
+        results = pool.map(get_info, files)
+
+    data = pd.DataFrame([stats for stats, _ in results])
+    reads = data['NumberReads']
+    print(f'Mean reads: {np.mean(reads)}')
+    print(f'Max reads: {np.max(reads)}')
+    print(f'Min reads: {np.min(reads)}')
+    print(f'Stdev reads: {np.std(reads)}')
 
+    histograms = []
+    for stats, lengths in results:
+        present = np.nonzero(lengths)[0]
+        histograms.append(pd.DataFrame({'Sample': stats['Sample'], 'Length': present, 'Count': lengths[present]}))
+
+    os.makedirs(output_dir, exist_ok=True)
+    data.to_csv(os.path.join(output_dir, f'{output}.csv'))
+    pd.concat(histograms).to_csv(os.path.join(output_dir, f'{output}_lengths.csv'), index=False)
+    return data
 
-    return num_reads
 
 def parse_args():
     """parses fastq format
@@ -42,45 +124,32 @@ def parse_args():
                         default=False,
                         help='Use a directory of fastq files (any .fastq file in the directory will be processed)')
     parser.add_argument('-o', '--output', type=str, default=None, help='Name of output file')
+    parser.add_argument('--output-dir', type=str, default=OUTPUT_DIR, help='Directory of output files (defaults to data/output)')
     parser.add_argument('--gz', action='store_true', help='Files are zipped (directory or file of fastq.gz filetype)')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='Number of files processed at once')
 
     args = parser.parse_args()
     fastq = args.fastq
-    fastq = '/mnt/lustre/hsm/nlsas/notape/home/uvi/be/posadalab/loretta/fastq/virome_fastq/'
     use_directory = args.directory
     output = args.output
     if output is None:
         output = 'fastq_overview'
     zipped = args.gz
+    processes = args.processes
 
-
-    reads = []
-    names = []
-
+    files = []
     if use_directory and os.path.exists(fastq):
-        for fastq_path in os.listdir(fastq):
-            search = '.fastq.gz' if zipped else '.fastq'
+        search = '.fastq.gz' if zipped else '.fastq'
+        for fastq_path in sorted(os.listdir(fastq)):
             if fastq_path.split(fastq_path.split('.')[0])[-1] == search:
-                new_path = os.path.join(fastq, fastq_path)
-                num_reads = get_info(new_path, zipped)
-                reads.append(num_reads)
-                names.append(fastq_path)
+                files.append(os.path.join(fastq, fastq_path))
     elif not use_directory and os.path.exists(fastq):
-        num_reads = get_info(fastq, zipped)
-        reads.append(num_reads)
-        names.append(fastq_path)
+        files.append(fastq)
     else:
         print('Path does not exist, please enter a valid path')
+        return
 
-
-    data_dict = {"Sample": names, 'NumberReads': reads}
-    data = pd.DataFrame(data_dict)
-    print(f'Mean reads: {np.mean(reads)}')
-    print(f'Max reads: {np.max(reads)}')
-    print(f'Min reads: {np.min(reads)}')
-    print(f'Stdev reads: {np.std(reads)}')
-
-    data.to_csv(f'../../data/output/{output}.csv')
+    fastq_overview(files, args.output_dir, output, processes)
 
 if __name__=="__main__":
     parse_args()
@@ -0,0 +1,48 @@
+import os
+import sys
+import pytest
+
+## pipeline scripts import their siblings by module name, util scripts are run from src as a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'SeqScreenPipeline'))
+
+
+## root 1 -> Bacteria 2 -> genus 10 -> species 11, 12; Viruses 3 -> species 30; 99 was merged into 12
+NODES = [(1, 1, 'no rank'), (2, 1, 'superkingdom'), (10, 2, 'genus'), (11, 10, 'species'),
+         (12, 10, 'species'), (3, 1, 'superkingdom'), (30, 3, 'species')]
+NAMES = {1: 'root', 2: 'Bacteria', 10: 'Bacillus', 11: 'Bacillus alpha', 12: 'Bacillus beta',
+         3: 'Viruses', 30: 'Virus gamma'}
+
+
+@pytest.fixture
+def taxdump(tmp_path):
+    data_dir = tmp_path / 'taxdump'
+    data_dir.mkdir()
+    (data_dir / 'nodes.dmp').write_text(''.join(f'{taxid}\t|\t{parent}\t|\t{rank}\t|\t\t|\n'
+                                                for taxid, parent, rank in NODES))
+    (data_dir / 'names.dmp').write_text(''.join(f'{taxid}\t|\t{name}\t|\t\t|\tscientific name\t|\n'
+                                                f'{taxid}\t|\tsyn {name}\t|\t\t|\tsynonym\t|\n'
+                                                for taxid, name in NAMES.items()))
+    (data_dir / 'merged.dmp').write_text('99\t|\t12\t|\n')
+    return str(data_dir)
+
+
+@pytest.fixture
+def taxonomy(taxdump, tmp_path):
+    from taxonomy import load_taxonomy
+    return load_taxonomy(taxdump, str(tmp_path / 'taxonomy.bin'))
+
+
+@pytest.fixture
+def stub_bin(tmp_path, monkeypatch):
+    '''Writes executable python stand-ins for external tools into a directory put first on PATH'''
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+
+    def write(name, source):
+        path = bin_dir / name
+        path.write_text(f'#!{sys.executable}\n{source}')
+        path.chmod(0o755)
+        return str(path)
+    return write
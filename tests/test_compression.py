@@ -0,0 +1,66 @@
+import gzip
+import os
+import subprocess
+import pytest
+import compression
+from compression import open_file, strip_ext, output_name, tmp_path, writable_dir
+
+
+@pytest.fixture
+def pigz(tmp_path, monkeypatch):
+    '''pigz on PATH, standing in with gzip (pigz -p N -dc FILE)'''
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    script = bin_dir / 'pigz'
+    script.write_text('#!/bin/sh\nshift 2\nexec gzip "$@"\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+
+
+def test_names():
+    assert strip_ext('A_1.fastq.gz', '.fastq') == 'A_1'
+    assert strip_ext('A_1.fastq', '.fastq') == 'A_1'
+    assert output_name('a.fasta', True) == 'a.fasta.gz'
+    assert output_name('a.fasta.gz', False) == 'a.fasta'
+    assert tmp_path('a.fasta.gz') == 'a.fasta.tmp.gz'
+    assert tmp_path('a.fasta') == 'a.fasta.tmp'
+
+
+@pytest.mark.parametrize('name', ['reads.fasta', 'reads.fasta.gz'])
+def test_open_file_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    with open_file(path, 'w') as handle:
+        handle.write('>r1\nACGT\n')
+    with open_file(path) as handle:
+        assert handle.read() == '>r1\nACGT\n'
+    if name.endswith('.gz'):
+        with gzip.open(path, 'rt') as handle:
+            assert handle.read() == '>r1\nACGT\n'
+
+
+def test_process_file_early_close_is_not_an_error(tmp_path, pigz):
+    path = tmp_path / 'big.txt.gz'
+    with gzip.open(path, 'wb', compresslevel=1) as handle:
+        handle.write(os.urandom(8 * 1024 * 1024).hex().encode())
+
+    handle = open_file(str(path), 'rb')
+    assert isinstance(handle, compression.ProcessFile)
+    handle.read(10)
+    handle.close()
+
+
+def test_process_file_raises_for_truncated_gzip(tmp_path, pigz):
+    data = gzip.compress(b'@r\nACGT\n+\nIIII\n' * 100000)
+    path = tmp_path / 'truncated.fastq.gz'
+    path.write_bytes(data[:len(data) // 2])
+
+    with pytest.raises(subprocess.CalledProcessError):
+        with open_file(str(path), 'rb') as handle:
+            handle.read()
+
+
+def test_writable_dir(tmp_path, monkeypatch):
+    assert writable_dir(str(tmp_path), str(tmp_path / 'cache')) == str(tmp_path)
+    monkeypatch.setattr(os, 'access', lambda path, mode: False)
+    assert writable_dir(str(tmp_path), str(tmp_path / 'cache')) == str(tmp_path / 'cache')
+    assert os.path.isdir(tmp_path / 'cache')
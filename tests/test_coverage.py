@@ -0,0 +1,41 @@
+from seqscreen_reference_inference import coverage_counts, rle_coverage
+
+
+def test_rle_coverage_collapses_runs(tmp_path):
+    depth_file = tmp_path / 'A.depth'
+    depth_file.write_text('g1\t1\t2\ng1\t2\t2\ng1\t3\t5\ng1\t6\t5\ng1\t7\t5\ng2\t1\t5\ng2\t2\t5\n')
+
+    coverage = rle_coverage(str(depth_file))
+
+    assert coverage.values.tolist() == [['g1', 0, 2, 2], ['g1', 2, 3, 5], ['g1', 5, 7, 5], ['g2', 0, 2, 5]]
+
+
+def test_rle_coverage_from_stream(tmp_path):
+    depth_file = tmp_path / 'A.depth'
+    depth_file.write_text('1\t1\t0\n1\t2\t0\n')
+
+    with open(depth_file) as handle:
+        coverage = rle_coverage(depth_stream=handle)
+
+    ## numeric genome ids stay strings
+    assert coverage.values.tolist() == [['1', 0, 2, 0]]
+
+
+def test_rle_coverage_empty(tmp_path):
+    depth_file = tmp_path / 'A.depth'
+    depth_file.write_text('')
+
+    coverage = rle_coverage(str(depth_file))
+
+    assert coverage.empty
+    assert list(coverage.columns) == ['genome_id', 'start', 'end', 'depth']
+
+
+def test_coverage_counts(tmp_path):
+    depth_file = tmp_path / 'A.depth'
+    depth_file.write_text('g1\t1\t0\ng1\t2\t3\ng1\t3\t3\ng1\t4\t1\ng2\t1\t2\n')
+
+    pos_count, total_count = coverage_counts(rle_coverage(str(depth_file)), min_depth=2)
+
+    assert pos_count.to_dict() == {'g1': 2, 'g2': 1}
+    assert total_count.to_dict() == {'g1': 6, 'g2': 2}
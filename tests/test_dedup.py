@@ -0,0 +1,39 @@
+import gzip
+from dedup import collapse_fasta, read_multiplicity, expand_report
+
+
+def write_fasta(path, records):
+    with open(path, 'w') as handle:
+        for read_id, seq in records:
+            handle.write(f'>{read_id} description\n{seq[:4]}\n{seq[4:]}\n')
+
+
+def test_collapse_fasta_keeps_first_read_per_sequence(tmp_path):
+    fasta = tmp_path / 'reads.fasta'
+    write_fasta(fasta, [('r1', 'ACGTACGT'), ('r2', 'TTTTGGGG'), ('r3', 'ACGTACGT'), ('r4', 'ACGTACGT')])
+
+    reads, unique = collapse_fasta(str(fasta), str(tmp_path / 'dedup.fasta'), str(tmp_path / 'mult.tsv'))
+
+    assert (reads, unique) == (4, 2)
+    assert (tmp_path / 'dedup.fasta').read_text() == '>r1 description\nACGTACGT\n>r2 description\nTTTTGGGG\n'
+    assert read_multiplicity(str(tmp_path / 'mult.tsv')) == {'r1': ['r1', 'r3', 'r4'], 'r2': ['r2']}
+
+
+def test_collapse_fasta_gzip(tmp_path):
+    fasta = tmp_path / 'reads.fasta.gz'
+    with gzip.open(fasta, 'wt') as handle:
+        handle.write('>a\nAAAA\n>b\nAAAA\n')
+
+    assert collapse_fasta(str(fasta), str(tmp_path / 'dedup.fasta.gz'), str(tmp_path / 'mult.tsv')) == (2, 1)
+    with gzip.open(tmp_path / 'dedup.fasta.gz', 'rt') as handle:
+        assert handle.read() == '>a\nAAAA\n'
+
+
+def test_expand_report_repeats_representative_rows(tmp_path):
+    (tmp_path / 'mult.tsv').write_text('representative\tcount\treads\nr1\t2\tr1,r3\nr2\t1\tr2\n')
+    (tmp_path / 'report.tsv').write_text('query\ttaxid\nr1\t10\nr2\t20\nunknown\t30\n')
+
+    rows = expand_report(str(tmp_path / 'report.tsv'), str(tmp_path / 'mult.tsv'), str(tmp_path / 'out.tsv'))
+
+    assert rows == 4
+    assert (tmp_path / 'out.tsv').read_text() == '\tquery\ttaxid\n0\tr1\t10\n1\tr3\t10\n2\tr2\t20\n3\tunknown\t30\n'
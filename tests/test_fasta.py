@@ -0,0 +1,55 @@
+import gzip
+import os
+import pytest
+from compression import tmp_path as partial_path
+from fasta import convert_file, fasta_local, fastq_to_fasta
+
+FASTQ = '@r1 comment one\nACGT\n+\nIIII\n@\nGG\n+\nII\n@r3\tcomment\nTTT\n+r3\nIII\n'
+
+
+def test_fastq_to_fasta(tmp_path):
+    (tmp_path / 'A.fastq').write_text(FASTQ)
+
+    assert fastq_to_fasta(str(tmp_path / 'A.fastq'), str(tmp_path / 'A.fasta')) == 3
+    assert open(partial_path(str(tmp_path / 'A.fasta'))).read() == '>r1 comment one\nACGT\n>\nGG\n>r3\tcomment\nTTT\n'
+
+    assert fastq_to_fasta(str(tmp_path / 'A.fastq'), str(tmp_path / 'B.fasta'), strip_comments=True) == 3
+    assert open(partial_path(str(tmp_path / 'B.fasta'))).read() == '>r1\nACGT\n>\nGG\n>r3\nTTT\n'
+
+
+def test_fastq_to_fasta_gzip_and_checkpoint(tmp_path):
+    with gzip.open(tmp_path / 'A.fastq.gz', 'wt') as handle:
+        handle.write(FASTQ.rstrip('\n'))
+
+    count = fastq_to_fasta(str(tmp_path / 'A.fastq.gz'), str(tmp_path / 'A.fasta.gz'),
+                           checkpoint=str(tmp_path / 'ckpt.fastq'), strip_comments=True)
+
+    assert count == 3
+    with gzip.open(partial_path(str(tmp_path / 'A.fasta.gz')), 'rt') as handle:
+        assert handle.read() == '>r1\nACGT\n>\nGG\n>r3\nTTT\n'
+    assert open(partial_path(str(tmp_path / 'ckpt.fastq'))).read() == FASTQ.rstrip('\n')
+
+
+def test_convert_file_removes_partial_output(tmp_path):
+    (tmp_path / 'A.fastq').write_text(FASTQ + '@r4\nACGT\n')
+
+    with pytest.raises(ValueError):
+        convert_file(str(tmp_path / 'A.fastq'), str(tmp_path / 'A.fasta'), True)
+    assert sorted(os.listdir(tmp_path)) == ['A.fastq']
+
+
+@pytest.mark.parametrize('strip_comments', [True, False])
+def test_fasta_local(tmp_path, strip_comments):
+    os.makedirs(tmp_path / 'removed-human')
+    os.makedirs(tmp_path / 'fasta')
+    (tmp_path / 'removed-human' / 'A_1.fastq').write_text(FASTQ)
+    with gzip.open(tmp_path / 'removed-human' / 'A_2.fastq.gz', 'wt') as handle:
+        handle.write(FASTQ)
+
+    fasta_local(str(tmp_path), threads=2, strip_comments=strip_comments)
+
+    expected = '>r1\nACGT\n>\nGG\n>r3\nTTT\n' if strip_comments else '>r1 comment one\nACGT\n>\nGG\n>r3\tcomment\nTTT\n'
+    assert sorted(os.listdir(tmp_path / 'fasta')) == ['A_1.fasta', 'A_2.fasta.gz']
+    assert (tmp_path / 'fasta' / 'A_1.fasta').read_text() == expected
+    with gzip.open(tmp_path / 'fasta' / 'A_2.fasta.gz', 'rt') as handle:
+        assert handle.read() == expected
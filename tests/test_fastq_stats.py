@@ -0,0 +1,45 @@
+import gzip
+import pandas as pd
+import pytest
+from util import fastq_stats
+from util.fastq_stats import fastq_overview, get_info
+
+## qualities: I = 40, + = 10, 5 = 20, ? = 30
+FASTQ = '@r1\nACGT\n+\nIIII\n@r2 comment\nGGCCA\n+\n+++++\n@r3\nAC\n+\n5?'
+
+
+@pytest.fixture(params=[3, 7, 1 << 20])
+def batch_size(request, monkeypatch):
+    ## small batches split records between batches
+    monkeypatch.setattr(fastq_stats, 'BUFFER_SIZE', request.param)
+
+
+def test_get_info(tmp_path, batch_size):
+    (tmp_path / 'A.fastq').write_text(FASTQ)
+
+    stats, lengths = get_info(str(tmp_path / 'A.fastq'))
+
+    assert stats == pytest.approx({'Sample': 'A.fastq', 'NumberReads': 3, 'TotalBases': 11, 'MeanLength': 11 / 3,
+                                   'MinLength': 2, 'MaxLength': 5, 'GC': 7 / 11, 'MeanQuality': 260 / 11, 'Q30': 5 / 11})
+    assert lengths.tolist() == [0, 0, 1, 0, 1, 1]
+
+
+def test_get_info_rejects_truncated_fastq(tmp_path, batch_size):
+    (tmp_path / 'A.fastq').write_text(FASTQ.rsplit('\n', 1)[0])
+    with pytest.raises(ValueError):
+        get_info(str(tmp_path / 'A.fastq'))
+
+
+def test_fastq_overview(tmp_path, batch_size):
+    (tmp_path / 'A.fastq').write_text(FASTQ)
+    with gzip.open(tmp_path / 'B.fastq.gz', 'wt') as handle:
+        handle.write('@r1\nNNNN\n+\n####\n')
+
+    fastq_overview([str(tmp_path / 'A.fastq'), str(tmp_path / 'B.fastq.gz')], str(tmp_path / 'out'), 'overview', 2)
+
+    data = pd.read_csv(tmp_path / 'out' / 'overview.csv', index_col=0)
+    assert data['Sample'].tolist() == ['A.fastq', 'B.fastq.gz']
+    assert data['NumberReads'].tolist() == [3, 1]
+    assert data['GC'].tolist() == pytest.approx([7 / 11, 0])
+    lengths = pd.read_csv(tmp_path / 'out' / 'overview_lengths.csv')
+    assert lengths.values.tolist() == [['A.fastq', 2, 1], ['A.fastq', 4, 1], ['A.fastq', 5, 1], ['B.fastq.gz', 4, 1]]
@@ -0,0 +1,57 @@
+import gzip
+import pytest
+from fastqc import fastqc_name, reservoir_sample
+
+
+def write_fastq(path, reads, opener=open):
+    with opener(path, 'wt') as handle:
+        for i in range(reads):
+            handle.write(f'@read{i}\nACGT\n+\nIIII\n')
+
+
+def read_ids(path):
+    with open(path) as handle:
+        return [line.strip() for i, line in enumerate(handle) if i % 4 == 0]
+
+
+def test_fastqc_name():
+    assert fastqc_name('/data/A_1.fastq.gz') == 'A_1_fastqc.zip'
+    assert fastqc_name('B.fq') == 'B_fastqc.zip'
+
+
+def test_reservoir_sample_is_reproducible_subset(tmp_path):
+    write_fastq(tmp_path / 'A_1.fastq', 1000)
+
+    total = reservoir_sample(str(tmp_path / 'A_1.fastq'), str(tmp_path / 'first.fastq'), 100, seed=1)
+    reservoir_sample(str(tmp_path / 'A_1.fastq'), str(tmp_path / 'second.fastq'), 100, seed=1)
+    reservoir_sample(str(tmp_path / 'A_1.fastq'), str(tmp_path / 'other.fastq'), 100, seed=2)
+
+    sample = read_ids(tmp_path / 'first.fastq')
+    assert total == 1000
+    assert len(sample) == len(set(sample)) == 100
+    assert set(sample) <= {f'@read{i}' for i in range(1000)}
+    assert sample == read_ids(tmp_path / 'second.fastq')
+    assert sample != read_ids(tmp_path / 'other.fastq')
+
+
+def test_reservoir_sample_keeps_all_reads_of_small_file(tmp_path):
+    write_fastq(tmp_path / 'small.fastq.gz', 10, gzip.open)
+    assert reservoir_sample(str(tmp_path / 'small.fastq.gz'), str(tmp_path / 'out.fastq'), 100) == 10
+    assert read_ids(tmp_path / 'out.fastq') == [f'@read{i}' for i in range(10)]
+
+
+def test_reservoir_sample_is_uniform(tmp_path):
+    write_fastq(tmp_path / 'A.fastq', 200)
+    counts = dict.fromkeys(range(200), 0)
+    for seed in range(200):
+        reservoir_sample(str(tmp_path / 'A.fastq'), str(tmp_path / 'out.fastq'), 50, seed=seed)
+        for read_id in read_ids(tmp_path / 'out.fastq'):
+            counts[int(read_id[5:])] += 1
+    ## every read is expected in a quarter of the samples
+    assert min(counts.values()) > 25 and max(counts.values()) < 80
+
+
+def test_reservoir_sample_rejects_truncated_fastq(tmp_path):
+    (tmp_path / 'bad.fastq').write_text('@r1\nACGT\n+\nIIII\n@r2\nACGT\n')
+    with pytest.raises(ValueError):
+        reservoir_sample(str(tmp_path / 'bad.fastq'), str(tmp_path / 'out.fastq'), 10)
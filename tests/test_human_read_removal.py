@@ -0,0 +1,114 @@
+import gzip
+import json
+import os
+import pytest
+import human_read_removal
+from human_read_removal import remove_human, remove_human_batch, run_bowtie2
+
+## bowtie2 stand-in: waits (up to 5 s) until $BOWTIE2_CONCURRENT runs have started, logs its arguments
+## with the number of runs started by then, then writes every pair as unaligned
+BOWTIE2 = '''import json, os, shutil, sys, time
+args = sys.argv[1:]
+log = os.environ['BOWTIE2_LOG']
+open(os.path.join(log, 'started', str(os.getpid())), 'w').close()
+deadline = time.time() + 5
+while len(os.listdir(os.path.join(log, 'started'))) < int(os.environ.get('BOWTIE2_CONCURRENT', 1)) and time.time() < deadline:
+    time.sleep(0.01)
+with open(os.path.join(log, f'{os.getpid()}.json'), 'w') as handle:
+    json.dump({'args': args, 'started': len(os.listdir(os.path.join(log, 'started')))}, handle)
+flag = '--un-conc-gz' if '--un-conc-gz' in args else '--un-conc'
+unaligned = args[args.index(flag) + 1]
+for mate in ('1', '2'):
+    shutil.copyfile(args[args.index(f'-{mate}') + 1], unaligned.replace('%', mate))
+'''
+
+
+@pytest.fixture
+def bowtie2(tmp_path, stub_bin, monkeypatch):
+    log = tmp_path / 'bowtie2_log'
+    (log / 'started').mkdir(parents=True)
+    monkeypatch.setenv('BOWTIE2_LOG', str(log))
+    stub_bin('bowtie2', BOWTIE2)
+
+    def calls():
+        runs = []
+        for name in os.listdir(log):
+            if name.endswith('.json'):
+                with open(log / name) as handle:
+                    runs.append(json.load(handle))
+        return sorted(runs, key=lambda run: run['args'][run['args'].index('-1') + 1])
+    return calls
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    os.makedirs(tmp_path / 'fastp')
+    os.makedirs(tmp_path / 'removed-human')
+    for name in ('A_', 'B_', 'C_'):
+        for mate in (1, 2):
+            (tmp_path / 'fastp' / f'{name}{mate}.fastq').write_text(f'@{name}r/{mate}\nACGT\n+\nIIII\n')
+    return tmp_path
+
+
+def test_run_bowtie2_command(pipeline, bowtie2):
+    run_bowtie2(str(pipeline), 'A_', 'GRCh38/GRCh38', threads=6)
+
+    args = bowtie2()[0]['args']
+    assert len(bowtie2()) == 1
+    assert args[:6] == ['--mm', '-p', '6', '-x', 'GRCh38/GRCh38', '-1']
+    assert args[args.index('-1') + 1] == str(pipeline / 'fastp' / 'A_1.fastq')
+    assert args[args.index('-2') + 1] == str(pipeline / 'fastp' / 'A_2.fastq')
+    assert args[args.index('--un-conc') + 1] == str(pipeline / 'removed-human' / 'A_.%.tmp')
+    assert args[-2:] == ['-S', os.devnull]
+    assert sorted(os.listdir(pipeline / 'removed-human')) == ['A_1.fastq', 'A_2.fastq']
+    assert (pipeline / 'removed-human' / 'A_2.fastq').read_text() == '@A_r/2\nACGT\n+\nIIII\n'
+
+    ## a sample with both outputs is not aligned again
+    run_bowtie2(str(pipeline), 'A_', 'GRCh38/GRCh38', threads=6)
+    assert len(bowtie2()) == 1
+
+
+def test_run_bowtie2_gzip(pipeline, bowtie2):
+    for mate in (1, 2):
+        with gzip.open(pipeline / 'fastp' / f'D_{mate}.fastq.gz', 'wt') as handle:
+            handle.write(f'@D/{mate}\nACGT\n+\nIIII\n')
+
+    run_bowtie2(str(pipeline), 'D_', 'index')
+
+    args = bowtie2()[0]['args']
+    assert args[args.index('--un-conc-gz') + 1] == str(pipeline / 'removed-human' / 'D_.%.tmp')
+    with gzip.open(pipeline / 'removed-human' / 'D_1.fastq.gz', 'rt') as handle:
+        assert handle.read() == '@D/1\nACGT\n+\nIIII\n'
+
+
+@pytest.mark.parametrize('threads, concurrent, per_sample', [(8, 3, 2), (2, 3, 1), (8, 1, 8)])
+def test_remove_human_batch_splits_threads(pipeline, bowtie2, monkeypatch, threads, concurrent, per_sample):
+    monkeypatch.setenv('BOWTIE2_CONCURRENT', str(concurrent))
+
+    remove_human_batch(str(pipeline), ['A_', 'B_', 'C_'], 'index', threads=threads, concurrent=concurrent)
+
+    runs = bowtie2()
+    assert [run['args'][run['args'].index('-1') + 1].split('/')[-1] for run in runs] == ['A_1.fastq', 'B_1.fastq', 'C_1.fastq']
+    assert {run['args'][run['args'].index('-p') + 1] for run in runs} == {str(per_sample)}
+    ## every run waited for the others of its group to start
+    assert min(run['started'] for run in runs) >= concurrent
+    assert len(os.listdir(pipeline / 'removed-human')) == 6
+
+
+def test_remove_human_submits_batches(pipeline, monkeypatch):
+    jobs = []
+    monkeypatch.setattr(human_read_removal, 'slurm', lambda commands, name, **kwargs: jobs.append((commands, name, kwargs)))
+    for mate in (1, 2):
+        (pipeline / 'removed-human' / f'B_{mate}.fastq').write_text('')
+
+    remove_human(str(pipeline), 'index', threads=8, batch_size=2, concurrent=2, prefilter='human', min_hits=2)
+    remove_human(str(pipeline), 'index', threads=4, compress=True)
+
+    assert [(commands, name) for commands, name, _ in jobs] == [
+        ([f'python human_read_removal.py {pipeline} index -t 8 --samples A_,C_ --concurrent 2 --prefilter human --min-hits 2'],
+         'A__remove_human_batch2'),
+        ## B only has uncompressed outputs
+        ([f'python human_read_removal.py {pipeline} index -t 4 --samples A_ --concurrent 1 --compress'], 'A__remove_human'),
+        ([f'python human_read_removal.py {pipeline} index -t 4 --samples B_ --concurrent 1 --compress'], 'B__remove_human'),
+        ([f'python human_read_removal.py {pipeline} index -t 4 --samples C_ --concurrent 1 --compress'], 'C__remove_human')]
+    assert jobs[0][2] == {'hours': 1, 'days': 0, 'memory': 14, 'threads_per_task': 8}
@@ -0,0 +1,45 @@
+import random
+import numpy as np
+from kmer_prefilter import INVALID, encode, kmer_hashes, minimizers, build_filter, KmerFilter
+
+
+def reverse_complement(seq):
+    return seq[::-1].translate(bytes.maketrans(b'ACGT', b'TGCA'))
+
+
+def test_kmer_hashes_are_canonical_and_skip_n():
+    seq = b'ACGTTGCAAGGCTTAC'
+    forward = kmer_hashes(encode(seq), 5)
+    reverse = kmer_hashes(encode(reverse_complement(seq)), 5)
+    assert np.array_equal(forward, reverse[::-1])
+
+    hashes = kmer_hashes(encode(b'ACGTNACGTACG'), 4)
+    assert np.all(hashes[1:5] == INVALID)
+    assert np.all(hashes[5:] != INVALID)
+
+
+def test_minimizers_of_short_sequence_use_the_minimum():
+    hashes = np.array([5, 3, INVALID, 9], dtype=np.uint64)
+    assert minimizers(hashes, 8).tolist() == [3]
+    assert len(minimizers(np.array([INVALID], dtype=np.uint64), 8)) == 0
+    assert len(minimizers(np.empty(0, dtype=np.uint64), 8)) == 0
+
+
+def test_minimizers_are_window_minima():
+    hashes = np.array([7, 4, 9, 6, 8, 1, 3], dtype=np.uint64)
+    assert minimizers(hashes, 3).tolist() == [1, 4, 6]
+
+
+def test_filter_finds_reference_reads(tmp_path):
+    rng = random.Random(0)
+    genome = ''.join(rng.choice('ACGT') for _ in range(20000))
+    (tmp_path / 'human.fasta').write_text(f'>chr\n{genome}\n')
+    build_filter(str(tmp_path / 'human.fasta'), str(tmp_path / 'human'), k=21, w=5)
+
+    kmer_filter = KmerFilter(str(tmp_path / 'human'))
+    human = [genome[i:i + 100] for i in range(0, 10000, 1000)]
+    other = [''.join(rng.choice('ACGT') for _ in range(100)) for _ in range(10)]
+    hits = kmer_filter.read_hits(human + [reverse_complement(read.encode()) for read in human] + other)
+
+    assert np.all(hits[:20] > 0)
+    assert np.sum(hits[20:] > 0) <= 1
@@ -0,0 +1,93 @@
+import os
+import pytest
+from merge_results import SPLIT_DIR, concat_reports, merge_results, read_manifest
+
+
+def write_report(pipeline, chunk_file, rows, header='query\ttaxid\n'):
+    report_dir = pipeline / 'seqscreen' / 'fast' / chunk_file / 'report_generation'
+    report_dir.mkdir(parents=True)
+    (report_dir / f'{chunk_file.split(".fasta")[0]}_seqscreen_report.tsv').write_text(header + rows)
+
+
+@pytest.fixture
+def pipeline(tmp_path):
+    (tmp_path / 'fasta').mkdir()
+    (tmp_path / 'fasta' / 'A.fasta').write_text('')
+    (tmp_path / SPLIT_DIR).mkdir(parents=True)
+    (tmp_path / 'seqscreen' / 'final').mkdir(parents=True)
+    return tmp_path
+
+
+def test_read_manifest_orders_chunks(tmp_path):
+    manifest = tmp_path / 'A.manifest.tsv'
+    manifest.write_text('chunk\tfile\tsequences\n2\tA_2.fasta.gz\t5\n10\tA_10.fasta.gz\t5\n1\tA_1.fasta.gz\t5\n'
+                        + ''.join(f'{i}\tA_{i}.fasta.gz\t5\n' for i in range(3, 10)))
+    assert read_manifest(str(manifest)) == [f'A_{i}.fasta.gz' for i in range(1, 11)]
+
+    manifest.write_text('chunk\tfile\tsequences\n1\tA_1.fasta\t5\n3\tA_3.fasta\t5\n')
+    with pytest.raises(ValueError):
+        read_manifest(str(manifest))
+
+
+def test_concat_reports(tmp_path):
+    (tmp_path / 'a.tsv').write_text('query\ttaxid\nr1\t1\nr2\t2\n')
+    (tmp_path / 'b.tsv').write_text('query\ttaxid\nr3\t3')
+
+    rows = concat_reports([str(tmp_path / 'a.tsv'), str(tmp_path / 'b.tsv')], str(tmp_path / 'out.tsv'))
+
+    assert rows == 3
+    assert (tmp_path / 'out.tsv').read_text() == '\tquery\ttaxid\n0\tr1\t1\n1\tr2\t2\n2\tr3\t3\n'
+    assert sorted(os.listdir(tmp_path)) == ['a.tsv', 'b.tsv', 'out.tsv']
+
+
+def test_concat_reports_rejects_mismatched_header(tmp_path):
+    (tmp_path / 'a.tsv').write_text('query\ttaxid\nr1\t1\n')
+    (tmp_path / 'b.tsv').write_text('query\tname\nr2\tx\n')
+
+    with pytest.raises(ValueError):
+        concat_reports([str(tmp_path / 'a.tsv'), str(tmp_path / 'b.tsv')], str(tmp_path / 'out.tsv'))
+    assert not (tmp_path / 'out.tsv').exists() and not (tmp_path / 'out.tsv.tmp').exists()
+
+
+def test_merge_results_from_manifest(pipeline):
+    (pipeline / SPLIT_DIR / 'A.manifest.tsv').write_text('chunk\tfile\tsequences\n1\tA_1.fasta.gz\t1\n2\tA_2.fasta.gz\t1\n')
+    write_report(pipeline, 'A_2.fasta.gz', 'r2\t2\n')
+    write_report(pipeline, 'A_1.fasta.gz', 'r1\t1\n')
+
+    merge_results(str(pipeline), 2)
+
+    assert (pipeline / 'seqscreen' / 'final' / 'A.tsv').read_text() == '\tquery\ttaxid\n0\tr1\t1\n1\tr2\t2\n'
+
+
+def test_merge_results_finds_gzipped_chunks_without_manifest(pipeline):
+    for i in (1, 2, 10):
+        (pipeline / SPLIT_DIR / f'A_{i}.fasta.gz').write_text('')
+        write_report(pipeline, f'A_{i}.fasta.gz', f'r{i}\t{i}\n')
+    ## another sample with the same prefix is not a chunk of A
+    (pipeline / SPLIT_DIR / 'A_1_1.fasta.gz').write_text('')
+
+    merge_results(str(pipeline), 3)
+
+    assert (pipeline / 'seqscreen' / 'final' / 'A.tsv').read_text() == '\tquery\ttaxid\n0\tr1\t1\n1\tr2\t2\n2\tr10\t10\n'
+
+
+def test_merge_results_fails_on_missing_chunk(pipeline):
+    (pipeline / 'fasta' / 'B.fasta').write_text('')
+    (pipeline / SPLIT_DIR / 'A.manifest.tsv').write_text('chunk\tfile\tsequences\n1\tA_1.fasta\t1\n2\tA_2.fasta\t1\n')
+    write_report(pipeline, 'A_1.fasta', 'r1\t1\n')
+    (pipeline / SPLIT_DIR / 'B.manifest.tsv').write_text('chunk\tfile\tsequences\n1\tB_1.fasta\t1\n2\tB_2.fasta\t1\n')
+    write_report(pipeline, 'B_1.fasta', 'r1\t1\n')
+    write_report(pipeline, 'B_2.fasta', 'r2\t2\n')
+
+    with pytest.raises(RuntimeError, match='A_2.fasta'):
+        merge_results(str(pipeline), 2)
+    assert not (pipeline / 'seqscreen' / 'final' / 'A.tsv').exists()
+    assert (pipeline / 'seqscreen' / 'final' / 'B.tsv').exists()
+
+
+def test_merge_results_fails_on_chunk_count(pipeline):
+    (pipeline / SPLIT_DIR / 'A.manifest.tsv').write_text('chunk\tfile\tsequences\n1\tA_1.fasta\t1\n')
+    write_report(pipeline, 'A_1.fasta', 'r1\t1\n')
+
+    with pytest.raises(RuntimeError, match='1 chunks, expected 2'):
+        merge_results(str(pipeline), 2)
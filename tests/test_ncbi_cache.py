@@ -0,0 +1,128 @@
+import json
+import os
+import time
+import pytest
+import seqscreen_reference_inference as sri
+
+## datasets stand-in: genomes are the taxids listed in $DATASETS_STATE/genomes, a taxid summary fails
+## (no json) while $DATASETS_STATE/fail_[taxid] counts down, every call is logged to $DATASETS_STATE/calls
+DATASETS = '''import json, os, sys
+state = os.environ['DATASETS_STATE']
+args = sys.argv[1:]
+with open(os.path.join(state, 'calls'), 'a') as handle:
+    handle.write(' '.join(args[:4]) + '\\n')
+if args[0] == 'summary':
+    taxid = args[3]
+    fail = os.path.join(state, f'fail_{taxid}')
+    failures = int(open(fail).read()) if os.path.exists(fail) else 0
+    if failures:
+        open(fail, 'w').write(str(failures - 1))
+        sys.exit(1)
+    genomes = open(os.path.join(state, 'genomes')).read().split()
+    if taxid not in genomes:
+        print(json.dumps({'total_count': 0}))
+    else:
+        print(json.dumps({'total_count': 1, 'assemblies': [{'assembly': {
+            'assembly_accession': f'GCF_{taxid}.1', 'annotation_metadata': {'source': 'RefSeq'},
+            'assembly_level': 'Complete Genome', 'org': {'sci_name': f'species {taxid}', 'strain': 'K-12'}}}]}))
+elif args[0] == 'download':
+    with open(args[args.index('--filename') + 1], 'w') as handle:
+        handle.write(args[3])
+'''
+
+
+@pytest.fixture
+def datasets(tmp_path, stub_bin, monkeypatch):
+    state = tmp_path / 'state'
+    state.mkdir()
+    (state / 'genomes').write_text('562\n')
+    monkeypatch.setenv('DATASETS_STATE', str(state))
+    monkeypatch.setattr(sri, 'DATASETS', stub_bin('datasets', DATASETS))
+    monkeypatch.setattr(sri.time, 'sleep', lambda seconds: None)
+
+    def calls():
+        return (state / 'calls').read_text().splitlines() if (state / 'calls').exists() else []
+    return state, calls
+
+
+def working_dir(tmp_path, name):
+    os.makedirs(tmp_path / name)
+    return str(tmp_path / name)
+
+
+def test_cache_hit(tmp_path, datasets):
+    _, calls = datasets
+    cache = str(tmp_path / 'cache')
+
+    first = sri.acquire_reference_genome(562, working_dir(tmp_path, 'w1'), cache)
+    queried = len(calls())
+    second = sri.acquire_reference_genome(562, working_dir(tmp_path, 'w2'), cache)
+
+    assert first == second == (562, 'GCF_562.1', 'RefSeq', True, 'Complete Genome', 'species 562', 'K-12', True)
+    assert queried == 2 and calls()[-1] == 'download genome accession GCF_562.1'
+    assert len(calls()) == queried
+    assert (tmp_path / 'w2' / '562.zip').read_text() == 'GCF_562.1'
+
+
+def test_retry_after_failure(tmp_path, datasets):
+    state, calls = datasets
+    (state / 'fail_562').write_text('2')
+
+    result = sri.acquire_reference_genome(562, working_dir(tmp_path, 'w1'), str(tmp_path / 'cache'), retries=3)
+
+    assert result[-1]
+    assert calls().count('summary genome taxon 562') == 3
+
+
+def test_retries_exhausted_are_not_cached(tmp_path, datasets):
+    state, calls = datasets
+    (state / 'fail_562').write_text('2')
+    cache = str(tmp_path / 'cache')
+
+    assert sri.acquire_reference_genome(562, working_dir(tmp_path, 'w1'), cache, retries=2) == \
+        (562, None, None, None, None, None, None, False)
+    assert not os.path.exists(os.path.join(cache, '562'))
+    ## the next sample tries again
+    assert sri.acquire_reference_genome(562, working_dir(tmp_path, 'w2'), cache, retries=2)[-1]
+
+
+def test_retry_without_cache(tmp_path, datasets):
+    state, calls = datasets
+    (state / 'fail_562').write_text('1')
+
+    assert sri.acquire_reference_genome(562, working_dir(tmp_path, 'w1'), retries=2)[-1]
+    assert calls().count('summary genome taxon 562') == 2
+
+
+def test_negative_result_expires(tmp_path, datasets):
+    state, calls = datasets
+    cache = str(tmp_path / 'cache')
+
+    assert sri.acquire_reference_genome(1000, working_dir(tmp_path, 'w1'), cache, negative_days=7)[1] is None
+    ## the summary cascade of a taxid without assemblies
+    assert len(calls()) == 6
+    (state / 'genomes').write_text('562\n1000\n')
+
+    ## a negative result younger than negative_days is still used
+    assert sri.acquire_reference_genome(1000, working_dir(tmp_path, 'w2'), cache, negative_days=7)[1] is None
+    assert len(calls()) == 6
+
+    metadata_file = os.path.join(cache, '1000', 'metadata.json')
+    stamp = time.time() - 8 * 86400
+    os.utime(metadata_file, (stamp, stamp))
+    result = sri.acquire_reference_genome(1000, working_dir(tmp_path, 'w3'), cache, negative_days=7)
+
+    assert result[1] == 'GCF_1000.1' and result[-1]
+    with open(metadata_file) as handle:
+        assert json.load(handle)[-1] is True
+
+
+def test_positive_result_does_not_expire(tmp_path, datasets):
+    _, calls = datasets
+    cache = str(tmp_path / 'cache')
+    sri.acquire_reference_genome(562, working_dir(tmp_path, 'w1'), cache)
+    stamp = time.time() - 30 * 86400
+    os.utime(os.path.join(cache, '562', 'metadata.json'), (stamp, stamp))
+
+    assert sri.acquire_reference_genome(562, working_dir(tmp_path, 'w2'), cache, negative_days=7)[-1]
+    assert len(calls()) == 2
@@ -0,0 +1,126 @@
+import json
+import os
+import subprocess
+import threading
+import pytest
+from preprocess import preprocess_sample, release_fifo, Worker
+
+## fastp stand-in: copies both mates to -o/-O and writes the -j summary, or exits 1 with $FASTP_FAIL
+FASTP = '''import json, os, shutil, sys
+args = sys.argv[1:]
+if os.environ.get('FASTP_FAIL'):
+    sys.exit(1)
+reads = 0
+for source, dest in (('-i', '-o'), ('-I', '-O')):
+    with open(args[args.index(source) + 1]) as handle, open(args[args.index(dest) + 1], 'w') as out:
+        data = handle.read()
+        out.write(data)
+    reads += data.count('\\n') // 4
+with open(args[args.index('-j') + 1], 'w') as handle:
+    json.dump({'summary': {'before_filtering': {'total_reads': reads}, 'after_filtering': {'total_reads': reads}}}, handle)
+'''
+
+## bowtie2 stand-in: reads both mates and writes the first pair as aligned, the rest to --un-conc;
+## $BOWTIE2_MODE fail exits 1 before opening the inputs, fail_late after reading them,
+## truncate writes a truncated record to mate 1
+BOWTIE2 = '''import os, sys
+args = sys.argv[1:]
+mode = os.environ.get('BOWTIE2_MODE', '')
+if mode == 'fail':
+    sys.exit(1)
+mates = []
+for flag in ('-1', '-2'):
+    with open(args[args.index(flag) + 1]) as handle:
+        mates.append(handle.readlines())
+if mode == 'fail_late':
+    sys.exit(1)
+pairs = len(mates[0]) // 4
+sys.stderr.write(f'{pairs} reads; of these:\\n  {pairs - 1} (50.00%) aligned concordantly 0 times\\n')
+unconc = args[args.index('--un-conc') + 1]
+for mate, lines in zip('12', mates):
+    with open(unconc.replace('%', mate), 'w') as out:
+        out.writelines(lines[4:] if not (mode == 'truncate' and mate == '1') else lines[4:6])
+'''
+
+FASTQ = ''.join(f'@r{i}/MATE\nACGT\n+\nIIII\n' for i in range(3))
+
+
+@pytest.fixture
+def pipeline(tmp_path, stub_bin):
+    stub_bin('fastp', FASTP)
+    stub_bin('bowtie2', BOWTIE2)
+    for directory in ('fastq', 'fastp', 'removed-human', 'fasta', 'output', 'tmp'):
+        os.makedirs(tmp_path / directory)
+    for mate in (1, 2):
+        (tmp_path / 'fastq' / f'A_{mate}.fastq').write_text(FASTQ.replace('MATE', str(mate)))
+    return tmp_path
+
+
+def run_sample(pipeline, checkpoint=False, timeout=30):
+    '''preprocess_sample in a thread, failing the test instead of hanging on a blocked fifo'''
+    outcome = {}
+
+    def target():
+        try:
+            preprocess_sample(str(pipeline), 'A_', 'index', checkpoint=checkpoint, tmp=str(pipeline / 'tmp'))
+        except BaseException as err:
+            outcome['error'] = err
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'preprocess_sample hung'
+    if 'error' in outcome:
+        raise outcome['error']
+
+
+def leftover_outputs(pipeline):
+    return [name for directory in ('fasta', 'fastp', 'removed-human', 'tmp') for name in os.listdir(pipeline / directory)]
+
+
+@pytest.mark.parametrize('checkpoint', [False, True])
+def test_preprocess_sample(pipeline, checkpoint):
+    run_sample(pipeline, checkpoint)
+
+    assert (pipeline / 'fasta' / 'A_1.fasta').read_text() == '>r1/1\nACGT\n>r2/1\nACGT\n'
+    assert (pipeline / 'fasta' / 'A_2.fasta').read_text() == '>r1/2\nACGT\n>r2/2\nACGT\n'
+    assert (pipeline / 'output' / 'preprocess' / 'A_read_counts.tsv').read_text() == \
+        'step\treads\nraw\t6\nfastp\t6\nbowtie2_input\t6\nremoved_human\t4\nfasta_r1\t2\nfasta_r2\t2\n'
+    if checkpoint:
+        assert (pipeline / 'fastp' / 'A_1.fastq').read_text() == FASTQ.replace('MATE', '1')
+        assert (pipeline / 'removed-human' / 'A_2.fastq').read_text() == FASTQ.replace('MATE', '2').split('\n', 4)[4]
+    assert os.listdir(pipeline / 'tmp') == []
+
+
+@pytest.mark.parametrize('checkpoint', [False, True])
+@pytest.mark.parametrize('failing, mode', [('fastp', None), ('bowtie2', 'fail'), ('bowtie2', 'fail_late')])
+def test_failing_stage_does_not_hang(pipeline, monkeypatch, checkpoint, failing, mode):
+    ## the other stages are left blocked on fifos that the failed stage never opens
+    if failing == 'fastp':
+        monkeypatch.setenv('FASTP_FAIL', '1')
+    else:
+        monkeypatch.setenv('BOWTIE2_MODE', mode)
+
+    with pytest.raises(subprocess.CalledProcessError) as err:
+        run_sample(pipeline, checkpoint)
+
+    assert err.value.cmd == failing
+    assert leftover_outputs(pipeline) == []
+
+
+def test_failing_worker_is_raised(pipeline, monkeypatch):
+    monkeypatch.setenv('BOWTIE2_MODE', 'truncate')
+
+    with pytest.raises(ValueError, match='Truncated fastq record'):
+        run_sample(pipeline)
+    assert leftover_outputs(pipeline) == []
+
+
+def test_release_fifo(tmp_path):
+    fifo = str(tmp_path / 'fifo')
+    os.mkfifo(fifo)
+    reader = Worker(lambda path: open(path).read(), (fifo,))
+    reader.start()
+    while reader.is_alive():
+        release_fifo(fifo)
+        reader.join(0.1)
+    assert reader.result == ''
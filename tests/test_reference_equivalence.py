@@ -0,0 +1,231 @@
+'''The vectorized depth, read count and ANI code against the line by line implementations it replaced'''
+import os
+from collections import defaultdict
+import pytest
+from Bio import SeqIO
+import seqscreen_reference_inference as sri
+
+## samtools on sam text: view -F, stats "reads mapped" (primary, mapped) of a contig or all, faidx
+SAMTOOLS = '''import sys
+command, args = sys.argv[1], sys.argv[2:]
+def records(path, exclude, contig=None):
+    with open(path) as handle:
+        for line in handle:
+            fields = line.split('\\t')
+            if not int(fields[1]) & exclude and contig in (None, fields[2]):
+                yield line
+if command == 'view':
+    sys.stdout.writelines(records(args[-1], int(args[args.index('-F') + 1], 16)))
+elif command == 'stats':
+    mapped = sum(1 for _ in records(args[0], 0x904, args[1] if len(args) > 1 else None))
+    print(f'SN\\traw total sequences:\\t0\\nSN\\treads mapped:\\t{mapped}\\t# comment')
+elif command == 'faidx':
+    offset = 0
+    entries = []
+    with open(args[0], 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                entries.append([line[1:].split()[0].decode(), 0, offset + len(line), 0, 0])
+            else:
+                entry = entries[-1]
+                entry[3] = entry[3] or len(line.rstrip(b'\\n'))
+                entry[4] = entry[4] or len(line)
+                entry[1] += len(line.rstrip(b'\\n'))
+            offset += len(line)
+    with open(args[0] + '.fai', 'w') as out:
+        out.writelines('\\t'.join(map(str, entry)) + '\\n' for entry in entries)
+'''
+
+REFERENCES = {'A': {'a1': 'ACGTACGTACGT', 'a2': 'GGGGCCCC'}, 'B': {'b1': 'TTTTTAAAAA'},
+              'C': {'c1': 'ACACAC'}, 'D': {'d1': 'CCCCCCC'}}
+
+## a1 has zero depth positions and a gap, a2 and c1 have no reads, d1 only a secondary alignment,
+## x9 is in no assembly
+DEPTH = [('a1', pos, depth) for pos, depth in [(1, 2), (2, 2), (3, 3), (4, 0), (5, 0), (6, 4), (7, 4), (8, 1), (11, 5), (12, 5)]] + \
+        [('b1', pos, depth) for pos, depth in [(1, 1), (2, 1), (3, 1), (4, 2), (9, 7)]] + \
+        [('d1', 1, 3), ('d1', 2, 3), ('x9', 1, 9)]
+
+## flags: 0x100 secondary, 0x800 supplementary and 0x4 unmapped (placed on a contig) are not counted
+SAM = [('r1', 0, 'a1'), ('r2', 16, 'a1'), ('r3', 256, 'a1'), ('r4', 2048, 'a1'), ('r5', 0, 'a1'),
+       ('r6', 4, 'a2'), ('r7', 0, 'b1'), ('r1', 99, 'b1'), ('r8', 256, 'd1'), ('r9', 0, 'x9'), ('r10', 68, 'b1')]
+
+
+def write_fasta(path, contigs, width):
+    with open(path, 'w') as handle:
+        for name, sequence in contigs.items():
+            handle.write(f'>{name} description\n')
+            handle.write(''.join(sequence[i:i + width] + '\n' for i in range(0, len(sequence), width)))
+
+
+def write_alignment(directory, alignment_id, depth, sam):
+    os.makedirs(directory / 'depth_files', exist_ok=True)
+    os.makedirs(directory / 'bam_files', exist_ok=True)
+    (directory / 'depth_files' / f'{alignment_id}.depth').write_text(''.join(f'{c}\t{p}\t{d}\n' for c, p, d in depth))
+    (directory / 'bam_files' / f'{alignment_id}.sorted.bam').write_text(
+        ''.join(f'{read}\t{flag}\t{contig}\t1\t60\t4M\t*\t0\t0\tACGT\tIIII\n'
+                for read, flag, contig in sorted(sam, key=lambda record: record[2])))
+
+
+@pytest.fixture
+def working_directory(tmp_path, stub_bin):
+    stub_bin('samtools', SAMTOOLS)
+    os.makedirs(tmp_path / 'reference_genomes')
+    for assembly_id, contigs in REFERENCES.items():
+        write_fasta(tmp_path / 'reference_genomes' / f'{assembly_id}.fasta', contigs, 5)
+    sri.merge_reference_fasta(list(REFERENCES), str(tmp_path))
+    write_alignment(tmp_path, 'merged', DEPTH, SAM)
+    write_alignment(tmp_path, 'A', [line for line in DEPTH if line[0] in ('a1', 'x9')],
+                    [record for record in SAM if record[2] in ('a1', 'a2', 'x9')])
+    return str(tmp_path)
+
+
+def baseline_depth_counts(depth_file, min_depth):
+    pos_count = defaultdict(int)
+    totol_count = defaultdict(int)
+    with open(depth_file, "r") as depth:
+        for line in depth.readlines():
+            genome_id = line.split("\t")[0]
+            depth = int(line.strip().split("\t")[2])
+            if depth >= min_depth:
+                pos_count[genome_id] += 1
+                totol_count[genome_id] += depth
+    return dict(pos_count), dict(totol_count)
+
+
+def baseline_calculate_depth(assembly_id, output_directory, min_depth=1):
+    depth_file = os.path.join(output_directory, 'depth_files', f"{assembly_id}.depth")
+    genome_length, genome_ids = sri.parse_reference_fasta(assembly_id, output_directory)
+    reads_mapped = sri.get_mapping_stats(assembly_id, output_directory)['reads mapped']
+
+    genome_pos_count = 0
+    genome_totol_count = 0
+    with open(depth_file, "r") as depth:
+        for line in depth.readlines():
+            genome_id = line.split("\t")[0]
+            depth = int(line.strip().split("\t")[2])
+            if depth >= min_depth and genome_id in genome_ids:
+                genome_pos_count += 1
+                genome_totol_count += depth
+
+    if genome_totol_count == 0 or reads_mapped == 0:
+        return 0, 0, 0
+    expected_breadth_coverage, _ = sri.get_expected_coverage(genome_length, reads_mapped, genome_totol_count)
+    return genome_pos_count/genome_length, genome_totol_count/genome_pos_count, expected_breadth_coverage
+
+
+def baseline_calculate_depth_merged(assembly_ids, output_directory, min_depth=1):
+    genome_id_pos_count, genome_id_totol_count = baseline_depth_counts(
+        os.path.join(output_directory, 'depth_files', 'merged.depth'), min_depth)
+    genome_id_pos_count = defaultdict(int, genome_id_pos_count)
+    genome_id_totol_count = defaultdict(int, genome_id_totol_count)
+
+    breadth_coverage_dict = defaultdict(float)
+    depth_coverage_dict = defaultdict(float)
+    reads_mapped_dict = defaultdict(int)
+    expected_breadth_coverage_dict = defaultdict(float)
+    for assembly_id in assembly_ids:
+        genome_length, genome_ids = sri.parse_reference_fasta(assembly_id, output_directory)
+        genome_pos_count = 0
+        genome_totol_count = 0
+        for genome_id in genome_ids:
+            genome_pos_count += genome_id_pos_count[genome_id]
+            genome_totol_count += genome_id_totol_count[genome_id]
+            if genome_id_pos_count[genome_id] > 0:
+                reads_mapped_dict[assembly_id] += sri.get_mapping_stats('merged', output_directory, genome_id)['reads mapped']
+
+        if genome_totol_count > 0 and reads_mapped_dict[assembly_id] > 0:
+            breadth_coverage_dict[assembly_id] = genome_pos_count/genome_length
+            depth_coverage_dict[assembly_id] = genome_totol_count/genome_pos_count
+            expected_breadth_coverage_dict[assembly_id] = sri.get_expected_coverage(
+                genome_length, reads_mapped_dict[assembly_id], genome_totol_count)[0]
+        elif genome_totol_count > 0 and reads_mapped_dict[assembly_id] == 0:
+            print("WARNING: Inconsistency between samtools depth and samtools stats for:", assembly_id)
+            print("Genome ID", "\t", "Stats Mapped Read Count", "\t", "# of Covered Positions")
+            for genome_id in genome_ids:
+                print(genome_id, "\t", sri.get_mapping_stats('merged', output_directory, genome_id)['reads mapped'],
+                      "\t", genome_id_totol_count[genome_id])
+    return breadth_coverage_dict, depth_coverage_dict, expected_breadth_coverage_dict
+
+
+def baseline_cal_ani(assembly_id, output_directory, consensus_record_dict, ignore_del=False, del_count_as_match=False):
+    reference_fasta = os.path.join(output_directory, 'reference_genomes', f'{assembly_id}.fasta')
+    total_count = 0
+    matched_count = 0
+    with open(reference_fasta, "r") as handle:
+        for record in SeqIO.parse(handle, "fasta"):
+            if record.id in consensus_record_dict:
+                for idx, base in enumerate(record.seq):
+                    if consensus_record_dict[record.id][idx] != 'N':
+                        if consensus_record_dict[record.id][idx] == '*' and ignore_del:
+                            continue
+                        elif consensus_record_dict[record.id][idx] == '*':
+                            total_count += 1
+                            if del_count_as_match:
+                                matched_count += 1
+                        else:
+                            total_count += 1
+                            if consensus_record_dict[record.id][idx] == base:
+                                matched_count += 1
+    return matched_count/total_count if total_count != 0 else 0
+
+
+@pytest.mark.parametrize('min_depth', [1, 3])
+def test_depth_counts_match_baseline(working_directory, min_depth):
+    depth_file = os.path.join(working_directory, 'depth_files', 'merged.depth')
+    expected = baseline_depth_counts(depth_file, min_depth)
+
+    pos_count, totol_count = sri.read_depth(depth_file, min_depth, chunksize=3)
+    assert (pos_count.to_dict(), totol_count.to_dict()) == expected
+
+    pos_count, totol_count = sri.coverage_counts(sri.rle_coverage(depth_file), min_depth)
+    assert (pos_count.to_dict(), totol_count.to_dict()) == expected
+
+
+@pytest.mark.parametrize('min_depth', [1, 3])
+def test_calculate_depth_matches_baseline(working_directory, min_depth):
+    expected = baseline_calculate_depth('A', working_directory, min_depth)
+    coverage = sri.rle_coverage(os.path.join(working_directory, 'depth_files', 'A.depth'))
+
+    assert sri.calculate_depth('A', working_directory, min_depth) == expected
+    assert sri.calculate_depth('A', working_directory, min_depth, coverage=coverage) == expected
+
+
+def test_contig_read_counts_match_samtools_stats(working_directory):
+    counts = sri.get_contig_read_counts('merged', working_directory)
+
+    contigs = [contig for contigs in REFERENCES.values() for contig in contigs] + ['x9']
+    assert {contig: float(counts[contig]) for contig in contigs} == \
+        {contig: sri.get_mapping_stats('merged', working_directory, contig)['reads mapped'] for contig in contigs}
+
+
+@pytest.mark.parametrize('min_depth', [1, 3])
+def test_calculate_depth_merged_matches_baseline(working_directory, min_depth, capsys):
+    assembly_ids = list(REFERENCES)
+    expected = baseline_calculate_depth_merged(assembly_ids, working_directory, min_depth)
+    expected_output = capsys.readouterr().out
+    coverage = sri.rle_coverage(os.path.join(working_directory, 'depth_files', 'merged.depth'))
+
+    assert sri.calculate_depth_merged(assembly_ids, working_directory, min_depth) == expected
+    assert capsys.readouterr().out == expected_output
+    assert sri.calculate_depth_merged(assembly_ids, working_directory, min_depth, coverage=coverage) == expected
+    ## d1 only has a secondary alignment, which the warning reports
+    assert 'Inconsistency between samtools depth and samtools stats for: D' in expected_output
+    assert expected[0]['A'] > 0 and 'D' not in expected[0]
+
+
+@pytest.mark.parametrize('ignore_del', [False, True])
+@pytest.mark.parametrize('del_count_as_match', [False, True])
+def test_cal_ani_matches_baseline(working_directory, ignore_del, del_count_as_match):
+    ## mismatches, N, deletions, a consensus longer than the reference and wrapped differently, a2 not called
+    consensus = {'a1': 'ACGAN*GTAC*NTTT', 'b1': 'TTTTTAAAAA', 'c1': 'NNNNNN', 'd1': '*C*CACC'}
+    consensus_fasta = os.path.join(working_directory, 'merged_consensus.fasta')
+    write_fasta(consensus_fasta, consensus, 4)
+    consensus_record_dict = SeqIO.to_dict(SeqIO.parse(consensus_fasta, 'fasta'))
+    consensus_index = sri.load_fasta_index(consensus_fasta)
+
+    for name, sequence in consensus.items():
+        assert bytes(sri.fetch_contig(consensus_index, name)).decode() == sequence
+    assert sri.fetch_contig(consensus_index, 'a2') is None
+    assert sri.cal_ani_all(list(REFERENCES), working_directory, consensus_index, ignore_del, del_count_as_match) == \
+        {assembly_id: baseline_cal_ani(assembly_id, working_directory, consensus_record_dict, ignore_del, del_count_as_match)
+         for assembly_id in REFERENCES}
@@ -0,0 +1,70 @@
+import os
+import pickle
+import seqscreen_reference_inference
+from seqscreen_reference_inference import load_sequence_index, local_taxid_fetch, sequence_index_prefix
+
+
+def write_database(tmp_path, records, mapping):
+    sequences_db = tmp_path / 'seqs.fna'
+    sequences_db.write_text(''.join(f'>{sequence_id} description\n{sequence}\n' for sequence_id, sequence in records))
+    mapping_f = tmp_path / 'taxid2seqid.pickle'
+    mapping_f.write_bytes(pickle.dumps(mapping) if mapping is not None else b'')
+    return str(sequences_db), str(mapping_f)
+
+
+def touch_after(path, reference):
+    stamp = os.path.getmtime(reference) + 10
+    os.utime(path, (stamp, stamp))
+
+
+def fetched(taxid, output_directory):
+    with open(os.path.join(output_directory, 'reference_genomes', f'taxid_{taxid}.fasta')) as handle:
+        return handle.read()
+
+
+def test_sequence_index_fetches_mapped_records(tmp_path):
+    sequences_db, mapping_f = write_database(tmp_path, [('s1', 'AAAA'), ('s2', 'CCCC'), ('s3', 'GGGG'), ('s1', 'TTTT')],
+                                             {10: ['s3', 's1'], 20: ['s9']})
+
+    index = load_sequence_index(sequences_db, mapping_f, str(tmp_path / 'index'))
+
+    ## s2 is not mapped to a taxid, so it is not indexed
+    assert len(index['offsets']) == 2
+    assert local_taxid_fetch(10, str(tmp_path), index)[-1]
+    assert fetched(10, tmp_path) == '>s3 description\nGGGG\n>s1 description\nAAAA\n'
+    assert not local_taxid_fetch(20, str(tmp_path), index)[-1]
+
+
+def test_sequence_index_rebuilt_when_database_changes(tmp_path):
+    sequences_db, mapping_f = write_database(tmp_path, [('s1', 'AAAA')], {10: ['s1']})
+    load_sequence_index(sequences_db, mapping_f, str(tmp_path / 'index'))
+
+    write_database(tmp_path, [('s0', 'CCCCCCCC'), ('s1', 'GGGG')], {10: ['s1']})
+    touch_after(sequences_db, tmp_path / 'index.rows.npy')
+    index = load_sequence_index(sequences_db, mapping_f, str(tmp_path / 'index'))
+
+    local_taxid_fetch(10, str(tmp_path), index)
+    assert fetched(10, tmp_path) == '>s1 description\nGGGG\n'
+
+
+def test_sequence_index_prefix_skips_stale_index(tmp_path, monkeypatch):
+    sequences_db, mapping_f = write_database(tmp_path, [('s1', 'AAAA')], {10: ['s1']})
+    load_sequence_index(sequences_db, mapping_f, str(tmp_path / 'seqs.fna'))
+    monkeypatch.setattr(os, 'access', lambda path, mode: False)
+    monkeypatch.setattr(seqscreen_reference_inference, 'CACHE_DIR', str(tmp_path / 'cache'))
+    assert sequence_index_prefix(sequences_db, mapping_f) == str(tmp_path / 'seqs.fna')
+
+    touch_after(mapping_f, tmp_path / 'seqs.fna.rows.npy')
+    assert sequence_index_prefix(sequences_db, mapping_f).startswith(str(tmp_path / 'cache'))
+
+
+def test_sequence_index_of_empty_database_or_mapping(tmp_path):
+    sequences_db, mapping_f = write_database(tmp_path, [], {10: ['s1']})
+    index = load_sequence_index(sequences_db, mapping_f, str(tmp_path / 'index'))
+    assert len(index['taxids']) == 0
+    assert not local_taxid_fetch(10, str(tmp_path), index)[-1]
+
+    write_database(tmp_path, [('s1', 'AAAA')], None)
+    touch_after(mapping_f, tmp_path / 'index.rows.npy')
+    index = load_sequence_index(sequences_db, mapping_f, str(tmp_path / 'index'))
+    assert len(index['offsets']) == 0 and len(index['rows']) == 0
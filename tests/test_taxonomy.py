@@ -0,0 +1,48 @@
+import numpy as np
+import pandas as pd
+from taxonomy import default_store, load_taxonomy
+
+
+def test_lookups(taxonomy):
+    assert taxonomy.lineage(11) == [1, 2, 10, 11]
+    assert taxonomy.lineage(99) == [1, 2, 10, 12]
+    assert taxonomy.lineage(5) == []
+    assert taxonomy.name(99) == 'Bacillus beta'
+    assert taxonomy.rank(10) == 'genus'
+    assert taxonomy.name(1000) is None
+
+
+def test_lca_pairs(taxonomy):
+    first = [11, 11, 11, 99, 5, 5, 0, 30]
+    second = [11, 12, 30, 11, 11, 5, -1, 3]
+    assert taxonomy.lca_pairs(first, second).tolist() == [11, 10, 1, 10, 11, 0, 0, 3]
+    assert taxonomy.lca([11, 99, 5]) == 10
+
+
+def test_lca_strings(taxonomy):
+    values = pd.Series(['11,12', '-', np.nan, '11.0', '30,11', '5,abc', '99, 11'], index=[4, 4, 3, 2, 1, 0, 7])
+    result = taxonomy.lca_strings(values)
+    assert result.index.tolist() == values.index.tolist()
+    assert result.fillna(0).tolist() == [10, 0, 0, 11, 1, 0, 10]
+
+
+def test_lineage_strings(taxonomy):
+    lineages, ranks = taxonomy.lineage_strings([11, 1, 5])
+    assert lineages.tolist()[:2] == ['Bacteria;Bacillus;Bacillus alpha', 'root']
+    assert ranks.tolist()[:2] == ['superkingdom;genus;species', 'no rank']
+    assert np.isnan(lineages[2]) and np.isnan(ranks[2])
+
+
+def test_ancestors_at_rank(taxonomy):
+    assert taxonomy.ancestors_at_rank([11, 99, 30, 2], 'genus').tolist() == [10, 10, 0, 0]
+    assert taxonomy.ancestors_at_rank([11], 'order').tolist() == [0]
+
+
+def test_default_store(taxdump, tmp_path, monkeypatch):
+    monkeypatch.delenv('TAXONOMY_STORE_DIR', raising=False)
+    assert default_store(taxdump) == f'{taxdump}/taxonomy.bin'
+
+    monkeypatch.setenv('TAXONOMY_STORE_DIR', str(tmp_path / 'stores'))
+    store = default_store(taxdump)
+    assert store.startswith(str(tmp_path / 'stores')) and store.endswith('.taxonomy.bin')
+    assert load_taxonomy(taxdump).store == store
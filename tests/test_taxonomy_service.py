@@ -0,0 +1,63 @@
+import socket
+import threading
+import numpy as np
+import pytest
+from taxonomy_service import RemoteTaxonomy, TaxonomyServer, answer, connect_taxonomy, recv_message, send_message
+
+
+@pytest.fixture
+def server(taxonomy, tmp_path):
+    socket_path = str(tmp_path / 'taxonomy.sock')
+    server = TaxonomyServer(socket_path, taxonomy)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield socket_path
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_message_round_trip():
+    first, second = socket.socketpair()
+    with first, second:
+        send_message(first, {'op': 'lca_pairs'}, [[1, 2, 3], np.array([], dtype=np.int32)])
+        send_message(first, {'op': 'info'})
+        header, arrays = recv_message(second)
+        assert header == {'op': 'lca_pairs', 'sizes': [3, 0]}
+        assert [array.tolist() for array in arrays] == [[1, 2, 3], []]
+        assert recv_message(second) == ({'op': 'info', 'sizes': []}, [])
+
+
+def test_answer(taxonomy):
+    assert answer(taxonomy, {'op': 'lca_pairs'}, [np.array([11, 11]), np.array([12, 30])])[1][0].tolist() == [10, 1]
+    assert answer(taxonomy, {'op': 'names'}, [np.array([99, 5])]) == ({'values': ['Bacillus beta', None]}, [])
+    assert answer(taxonomy, {'op': 'lineage_strings'}, [np.array([11, 5])])[0]['values'] == \
+        [['Bacteria;Bacillus;Bacillus alpha', None], ['superkingdom;genus;species', None]]
+    with pytest.raises(ValueError):
+        answer(taxonomy, {'op': 'unknown'}, [])
+
+
+def test_remote_matches_in_process(taxonomy, server):
+    remote = RemoteTaxonomy(server)
+    try:
+        taxids = np.array([11, 12, 99, 30, 5, 1])
+        assert remote.resolve(taxids).tolist() == taxonomy.resolve(taxids).tolist()
+        assert remote.lca_pairs(taxids, 11).tolist() == taxonomy.lca_pairs(taxids, [11] * 6).tolist()
+        assert remote.ancestors_at_rank(taxids, 'genus').tolist() == taxonomy.ancestors_at_rank(taxids, 'genus').tolist()
+        assert remote.lineage(99) == taxonomy.lineage(99)
+        assert (remote.name(30), remote.rank(30)) == (taxonomy.name(30), taxonomy.rank(30))
+        assert remote.lca([11, 12, 5]) == taxonomy.lca([11, 12, 5])
+        for remote_values, local_values in zip(remote.lineage_strings(taxids), taxonomy.lineage_strings(taxids)):
+            assert remote_values.fillna('').tolist() == local_values.fillna('').tolist()
+        with pytest.raises(ValueError):
+            remote.query('unknown')
+    finally:
+        remote.close()
+
+
+def test_connect_taxonomy(taxdump, taxonomy, server, tmp_path):
+    remote = connect_taxonomy(taxdump, server, taxonomy.store)
+    assert isinstance(remote, RemoteTaxonomy)
+    remote.close()
+    ## a daemon serving another store is not used
+    assert not isinstance(connect_taxonomy(taxdump, server, str(tmp_path / 'other.bin')), RemoteTaxonomy)